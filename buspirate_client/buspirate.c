@@ -299,10 +299,11 @@ static void buspirate_bulk(struct buspirate_s *bp, unsigned char *pre,
   }
 }
 
-static void i2c_cmd8(struct buspirate_s *bp, int addr,
-		     unsigned char *tx_data, int m,
-		     unsigned char *rx_data, int n) {
-  unsigned char rx_buf[n + 1];
+/* Sends a write then read command, the answer is collected by
+   i2c_cmd8_rx: several commands can be sent before reading their
+   answers, saving a USB round trip each. */
+static int i2c_cmd8_tx(struct buspirate_s *bp, int addr,
+		       unsigned char *tx_data, int m, int n) {
   unsigned char tx_buf[1 + 2 + 2 + 1 + m];
   int tx_len = 0;
 
@@ -323,37 +324,49 @@ static void i2c_cmd8(struct buspirate_s *bp, int addr,
   tx_buf[3] = (n >> 8) & 0xff;
   tx_buf[4] = n & 0xff;
   tx_buf[5] = addr;
-  if (write_n(bp, tx_buf, tx_len))
-    return;
+  return write_n(bp, tx_buf, tx_len);
+}
+
+static int i2c_cmd8_rx(struct buspirate_s *bp, unsigned char *rx_data, int n) {
+  unsigned char rx_buf[n + 1];
+
   if (read_n(bp, rx_buf, 1, 100))
-    return;
-  if (rx_buf[0] != 1) {
-    bp->err = ERR_NACK;
-    return;
-  }
+    return bp->err;
+  if (rx_buf[0] != 1)
+    return (bp->err = ERR_NACK);
   if (n > 0)  {
     if (read_n(bp, &rx_buf[1], n, 100))
-      return;
+      return bp->err;
     if (rx_data)
       memcpy(rx_data, &rx_buf[1], n);
   }
+  return 0;
+}
+
+static void i2c_cmd8(struct buspirate_s *bp, int addr,
+		     unsigned char *tx_data, int m,
+		     unsigned char *rx_data, int n) {
+  if (i2c_cmd8_tx(bp, addr, tx_data, m, n))
+    return;
+  i2c_cmd8_rx(bp, rx_data, n);
 }
 
-void i2c_send(struct i2c_s *i2c, int addr, unsigned char *data, int n) {
+int i2c_send(struct i2c_s *i2c, int addr, unsigned char *data, int n) {
   struct buspirate_s *bp = (struct buspirate_s *) i2c;
   unsigned char abuf = (addr << 1);
 
   bp->err = 0;
   if (bp->fast) {
     i2c_cmd8(bp, addr << 1, data, n, NULL, 0);
-    return;
+    return bp->err;
   }
   buspirate_aux(bp, I2C_START_BIT);
   buspirate_bulk(bp, &abuf, data, n);
   buspirate_aux(bp, I2C_STOP_BIT);
+  return bp->err;
 }
 
-void i2c_cmd_recv(struct i2c_s *i2c, int addr, unsigned char cmd,
+int i2c_cmd_recv(struct i2c_s *i2c, int addr, unsigned char cmd,
 		  unsigned char *data, int n) {
   struct buspirate_s *bp = (struct buspirate_s *) i2c;
   unsigned char abuf = (addr << 1);
@@ -363,7 +376,7 @@ void i2c_cmd_recv(struct i2c_s *i2c, int addr, unsigned char cmd,
   bp->err = 0;
   if (bp->fast) {
     i2c_cmd8(bp, (addr << 1), &cbuf, 1, data, n);
-    return;
+    return bp->err;
   }
   buspirate_aux(bp, I2C_START_BIT);
   buspirate_bulk(bp, &abuf, &cbuf, 1);
@@ -377,9 +390,10 @@ void i2c_cmd_recv(struct i2c_s *i2c, int addr, unsigned char cmd,
   }
   buspirate_aux(bp, I2C_SEND_NACK);
   buspirate_aux(bp, I2C_STOP_BIT);
+  return bp->err;
 }
 
-void i2c_recv(struct i2c_s *i2c, int addr,
+int i2c_recv(struct i2c_s *i2c, int addr,
 		  unsigned char *data, int n) {
   struct buspirate_s *bp = (struct buspirate_s *) i2c;
   unsigned char abuf = (addr << 1) | 1;
@@ -388,7 +402,7 @@ void i2c_recv(struct i2c_s *i2c, int addr,
   bp->err = 0;
   if (bp->fast) {
     i2c_cmd8(bp, (addr << 1) | 1, NULL, 0, data, n);
-    return;
+    return bp->err;
   }
   buspirate_aux(bp, I2C_START_BIT);
   buspirate_bulk(bp, &abuf, NULL, 0);
@@ -399,6 +413,7 @@ void i2c_recv(struct i2c_s *i2c, int addr,
   }
   buspirate_aux(bp, I2C_SEND_NACK);
   buspirate_aux(bp, I2C_STOP_BIT);
+  return bp->err;
 }
 
 void i2c_pin(struct i2c_s *i2c, int aux, int cs) {
@@ -415,3 +430,183 @@ void i2c_fast(struct i2c_s *i2c, int fast) {
 
   bp->fast = fast > 0;
 }
+
+/* AMS virtual registers, as in the AS726x: the device has only the
+   status, write and read registers and the others are reached through
+   them. Everything is done with the write then read command, the
+   status read that follows a write or a read is sent with it. */
+#define VREG_STATUS 0x00
+#define VREG_WRITE 0x01
+#define VREG_READ 0x02
+#define VREG_TX_VALID 0x02
+#define VREG_RX_VALID 0x01
+#define VREG_POLLS 1000
+
+/* Sends cmd, reading one byte into rx if not NULL, and a status read
+   right after it, then collects both answers. */
+static int vreg_step(struct buspirate_s *bp, int addr, unsigned char *cmd,
+		     int m, unsigned char *rx, unsigned char *status) {
+  unsigned char st = VREG_STATUS;
+
+  if (i2c_cmd8_tx(bp, addr, cmd, m, rx ? 1 : 0) ||
+      i2c_cmd8_tx(bp, addr, &st, 1, 1) ||
+      i2c_cmd8_rx(bp, rx, rx ? 1 : 0) ||
+      i2c_cmd8_rx(bp, status, 1))
+    return bp->err;
+  return 0;
+}
+
+static int vreg_poll(struct buspirate_s *bp, int addr, unsigned char *status,
+		     unsigned char mask, unsigned char want) {
+  unsigned char st = VREG_STATUS;
+  int i;
+
+  for (i = 0; (*status & mask) != want; i++) {
+    if (i == VREG_POLLS)
+      return (bp->err = ETIMEDOUT);
+    i2c_cmd8(bp, addr, &st, 1, status, 1);
+    if (bp->err)
+      return bp->err;
+  }
+  return 0;
+}
+
+static int vreg_start(struct buspirate_s *bp, int addr, unsigned char *status) {
+  unsigned char cmd = VREG_STATUS, stale;
+  int i;
+
+  bp->err = 0;
+  if (!bp->fast)
+    return (bp->err = EINVAL);
+  i2c_cmd8(bp, addr, &cmd, 1, status, 1);
+  /* Drop stale data. */
+  cmd = VREG_READ;
+  for (i = 0; !bp->err && (*status & VREG_RX_VALID); i++) {
+    if (i == VREG_POLLS)
+      return (bp->err = ETIMEDOUT);
+    vreg_step(bp, addr, &cmd, 1, &stale, status);
+  }
+  return bp->err;
+}
+
+int i2c_vreg_read(struct i2c_s *i2c, int addr, unsigned char *regs,
+		  unsigned char *data, int n) {
+  struct buspirate_s *bp = (struct buspirate_s *) i2c;
+  unsigned char status, cmd[2] = {VREG_WRITE, 0}, rd = VREG_READ;
+  int i;
+
+  addr <<= 1;
+  if (vreg_start(bp, addr, &status))
+    return bp->err;
+  for (i = 0; i < n; i++) {
+    cmd[1] = regs[i];
+    if (vreg_poll(bp, addr, &status, VREG_TX_VALID, 0) ||
+	vreg_step(bp, addr, cmd, 2, NULL, &status) ||
+	vreg_poll(bp, addr, &status, VREG_RX_VALID, VREG_RX_VALID) ||
+	vreg_step(bp, addr, &rd, 1, &data[i], &status))
+      return bp->err;
+  }
+  return 0;
+}
+
+int i2c_vreg_write(struct i2c_s *i2c, int addr, unsigned char *regs,
+		   unsigned char *data, int n) {
+  struct buspirate_s *bp = (struct buspirate_s *) i2c;
+  unsigned char status, cmd[2] = {VREG_WRITE, 0};
+  int i;
+
+  addr <<= 1;
+  if (vreg_start(bp, addr, &status))
+    return bp->err;
+  for (i = 0; i < n; i++) {
+    cmd[1] = regs[i] | 0x80;
+    if (vreg_poll(bp, addr, &status, VREG_TX_VALID, 0) ||
+	vreg_step(bp, addr, cmd, 2, NULL, &status))
+      return bp->err;
+    cmd[1] = data[i];
+    if (vreg_poll(bp, addr, &status, VREG_TX_VALID, 0) ||
+	vreg_step(bp, addr, cmd, 2, NULL, &status))
+      return bp->err;
+  }
+  return 0;
+}
+
+int i2c_vreg_wait(struct i2c_s *i2c, int addr, unsigned char reg,
+		  unsigned char mask, int timeout_ms) {
+  struct buspirate_s *bp = (struct buspirate_s *) i2c;
+  struct timespec start, now;
+  unsigned char val;
+
+  clock_gettime(CLOCK_MONOTONIC, &start);
+  for (;;) {
+    if (i2c_vreg_read(i2c, addr, &reg, &val, 1))
+      return bp->err;
+    if (val & mask)
+      return 0;
+    clock_gettime(CLOCK_MONOTONIC, &now);
+    if ((now.tv_sec - start.tv_sec) * 1000 +
+	(now.tv_nsec - start.tv_nsec) / 1000000 > timeout_ms)
+      return (bp->err = ETIMEDOUT);
+  }
+}
+
+/* A list of write then read operations in one call. Each operation in
+   ops is the 7 bit address, the number of bytes to write and to read
+   (16 bit, big endian) and the bytes to write; the bytes read go one
+   after the other in rx. Up to depth operations are sent before
+   waiting for their answers: more saves USB round trips, but the Bus
+   Pirate has to keep up with the serial line while it is busy on the
+   bus. Returns the number of operations done, all of them unless
+   there was an error (i2c_error() tells which). Needs fast mode. */
+#define OP_W(p) (((p)[1] << 8) | (p)[2])
+#define OP_R(p) (((p)[3] << 8) | (p)[4])
+#define OP_NEXT(p) ((p) + 5 + OP_W(p))
+
+int i2c_transaction(struct i2c_s *i2c, unsigned char *ops, int len,
+		    unsigned char *rx, int depth) {
+  struct buspirate_s *bp = (struct buspirate_s *) i2c;
+  unsigned char *sp = ops, *rp = ops, *end = ops + len;
+  int sent = 0, done = 0, err;
+
+  bp->err = 0;
+  if (!bp->fast) {
+    bp->err = EINVAL;
+    return 0;
+  }
+  if (depth < 1)
+    depth = 1;
+  while (rp < end) {
+    while (sp < end && sent - done < depth) {
+      if (end - sp < 5 || end - sp < 5 + OP_W(sp)) {
+	bp->err = EINVAL;
+	break;
+      }
+      if (OP_W(sp))
+	i2c_cmd8_tx(bp, sp[0] << 1, sp + 5, OP_W(sp), OP_R(sp));
+      else
+	i2c_cmd8_tx(bp, (sp[0] << 1) | 1, NULL, 0, OP_R(sp));
+      if (bp->err)
+	break;
+      sp = OP_NEXT(sp);
+      sent++;
+    }
+    if (bp->err || done == sent)
+      break;
+    if (i2c_cmd8_rx(bp, rx, OP_R(rp))) {
+      /* Its answer is over. */
+      rp = OP_NEXT(rp);
+      break;
+    }
+    rx += OP_R(rp);
+    rp = OP_NEXT(rp);
+    done++;
+  }
+  /* Collect the answers still on their way. */
+  err = bp->err;
+  if (err) {
+    for (; rp < sp && err != ETIMEDOUT; rp = OP_NEXT(rp))
+      i2c_cmd8_rx(bp, NULL, OP_R(rp));
+    bp->err = err;
+  }
+  return done;
+}
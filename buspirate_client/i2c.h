@@ -36,9 +36,21 @@ struct i2c_s;
 struct i2c_s *i2c_new(char *type, int speed);
 void i2c_free(struct i2c_s *i2c);
 int i2c_error(struct i2c_s *i2c);
-void i2c_send(struct i2c_s *i2c, int addr, unsigned char *data, int n);
-void i2c_cmd_recv(struct i2c_s *i2c, int addr, unsigned char cmd,
-		  unsigned char *data, int n);
+int i2c_send(struct i2c_s *i2c, int addr, unsigned char *data, int n);
+int i2c_cmd_recv(struct i2c_s *i2c, int addr, unsigned char cmd,
+		 unsigned char *data, int n);
+int i2c_recv(struct i2c_s *i2c, int addr, unsigned char *data, int n);
 void i2c_pin(struct i2c_s *i2c, int aux, int cs);
 void i2c_fast(struct i2c_s *i2c, int fast);
+/* AMS virtual registers (AS726x), each call is a whole sequence of
+   status polls, writes and reads. They need fast mode. */
+int i2c_vreg_read(struct i2c_s *i2c, int addr, unsigned char *regs,
+		  unsigned char *data, int n);
+int i2c_vreg_write(struct i2c_s *i2c, int addr, unsigned char *regs,
+		   unsigned char *data, int n);
+int i2c_vreg_wait(struct i2c_s *i2c, int addr, unsigned char reg,
+		  unsigned char mask, int timeout_ms);
+/* Write then read operations, see buspirate.c. Needs fast mode. */
+int i2c_transaction(struct i2c_s *i2c, unsigned char *ops, int len,
+		    unsigned char *rx, int depth);
 #endif
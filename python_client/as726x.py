@@ -1,9 +1,12 @@
 #!/usr/bin/python3
 
 import buspirate as bp
+import collections
 import re
 import serial
+import shadow
 import struct
+import threading
 import time
 
 
@@ -24,23 +27,29 @@ class AS726x_I2C:
     READ_REG = 0x02
     TX_VALID = 0x02
     RX_VALID = 0x01
+    # CONTROL_SETUP: RST and DATA_RDY change on their own.
+    VOLATILE = {CONTROL_SETUP: (1 << 7) | (1 << 1)}
     DEBUG = False
 
-    def __init__(self, port: str):
+    # i2c is a bp.I2C shared with other sensors, at their speed.
+    def __init__(self, port: str, i2c: bp.I2C = None):
         self.addr = self.ADDR
-        self.i2c = bp.I2C(port, bp.I2C_SPEED_400KHZ)
+        self.i2c = i2c or bp.I2C(port, bp.I2C_SPEED_400KHZ)
         self.i2c.set_fast(1)
+        self.regs = shadow.ShadowRegisters(self.read_reg, self.write_reg,
+                                           self.VOLATILE)
         self.hard_reset()
         self.ver = self.read_reg(self.HW_VERSION)
         if (self.ver != self.SENSORTYPE_AS7262 and
            self.ver != self.SENSORTYPE_AS7263):
             raise IOError("Cannot communicate")
-        self.set_bulb_current(0b00)
-        self.set_bulb(0)
-        self.set_indicator_current(0b11)
-        self.set_indicator(0)
-        self.set_gain(3)
-        self.set_mode(3)
+        with self.regs.batch():
+            self.set_bulb_current(0b00)
+            self.set_bulb(0)
+            self.set_indicator_current(0b11)
+            self.set_indicator(0)
+            self.set_gain(3)
+            self.set_mode(3)
 
     def read_reg_(self, reg: int):
         # You need newer Buspirate FW for this to work:
@@ -87,16 +96,10 @@ class AS726x_I2C:
     def set_bulb_current(self, current: int):
         if current > 0b11:
             current = 0b11
-        value = self.read_reg(self.LED_CONTROL)
-        value &= 0b11001111
-        value |= (current << 4)
-        self.write_reg(self.LED_CONTROL, value)
+        self.regs.update(self.LED_CONTROL, 0b00110000, current << 4)
 
     def set_bulb(self, val: int):
-        value = self.read_reg(self.LED_CONTROL)
-        value &= ~(1 << 3)
-        value |= (val << 3)
-        self.write_reg(self.LED_CONTROL, value)
+        self.regs.update(self.LED_CONTROL, 1 << 3, val << 3)
 
     def get_temperature(self):
         return self.read_reg(self.DEVICE_TEMP)
@@ -105,16 +108,10 @@ class AS726x_I2C:
     def set_indicator_current(self, current: int):
         if current > 0b11:
             current = 0b11
-        value = self.read_reg(self.LED_CONTROL)
-        value &= 0b11111001
-        value |= (current << 1)
-        self.write_reg(self.LED_CONTROL, value)
+        self.regs.update(self.LED_CONTROL, 0b00000110, current << 1)
 
     def set_indicator(self, val: int):
-        value = self.read_reg(self.LED_CONTROL)
-        value &= ~(1 << 0)
-        value |= (val << 0)
-        self.write_reg(self.LED_CONTROL, value)
+        self.regs.update(self.LED_CONTROL, 1 << 0, val << 0)
 
     # Gain 0: 1x (power-on default)
     # Gain 1: 3.7x
@@ -123,25 +120,46 @@ class AS726x_I2C:
     def set_gain(self, gain: int):
         if gain > 0b11:
             gain = 0b11
-        value = self.read_reg(self.CONTROL_SETUP)
-        value &= 0b11001111
-        value |= (gain << 4)
-        self.write_reg(self.CONTROL_SETUP, value)
+        self.regs.update(self.CONTROL_SETUP, 0b00110000, gain << 4)
 
     # Give this function a byte from 0 to 255.
     # Time will be 2.8ms * [integration value]
     def set_integration(self, val: int):
-        self.write_reg(self.INT_T, val)
+        self.regs.set(self.INT_T, val)
 
     def set_integration_ms(self, val: float):
         self.set_integration(int(val / 2.8))
 
-    def measure(self):
-        self.clear_data()
-        self.set_mode(3)
+    # fast does the whole measure in two library calls: one write that
+    # clears the data ready bit and starts the one-shot reading, and a
+    # wait for the data ready bit.
+    def measure(self, fast: bool = False, timeout_ms: int = 2000):
+        if fast:
+            self.start_sample()
+            self.i2c.vreg_wait(self.addr, self.CONTROL_SETUP, 1 << 1,
+                               timeout_ms)
+            return
+        with self.regs.batch():
+            self.clear_data()
+            self.set_mode(3)
         while not self.has_data():
             pass
 
+    # Sensor interface of scheduler.py: the fast measure() split in its
+    # start and its wait, and get_all_values(fast=True).
+    def start_sample(self):
+        value = self.regs.get(self.CONTROL_SETUP, 0)
+        value = (value & 0b11110011) | (3 << 2)
+        self.i2c.vreg_write(self.addr, [self.CONTROL_SETUP], [value])
+        self.regs.written(self.CONTROL_SETUP, value)
+        return time.monotonic() + self.regs.get(self.INT_T) * 0.0028
+
+    def sample_ready(self):
+        return self.i2c.vreg_read(self.addr, [self.CONTROL_SETUP])[0] & (1 << 1)
+
+    def read_sample(self):
+        return self.get_all_values(True)
+
     def get_channel(self, addr: int):
         data = self.read_reg(addr) << 8
         data |= self.read_reg(addr + 1)
@@ -158,22 +176,19 @@ class AS726x_I2C:
                 self.read_reg(addr + 3)))[0]
 
     def has_data(self):
-        value = self.read_reg(self.CONTROL_SETUP)
-        return value & (1 << 1)
+        return self.regs.get(self.CONTROL_SETUP, 1 << 1) & (1 << 1)
 
     def clear_data(self):
-        value = self.read_reg(self.CONTROL_SETUP)
-        value &= ~(1 << 1)
-        self.write_reg(self.CONTROL_SETUP, value)
+        self.regs.update(self.CONTROL_SETUP, 1 << 1, 0)
 
     def soft_reset(self):
-        value = self.read_reg(self.CONTROL_SETUP)
-        value |= (1 << 7)
-        self.write_reg(self.CONTROL_SETUP, value)
+        self.regs.update(self.CONTROL_SETUP, 1 << 7, 1 << 7)
+        self.regs.invalidate()
         time.sleep(1)
 
     # Reset must be wired to Buspirate CS
     def hard_reset(self):
+        self.regs.invalidate()
         self.i2c.set_pin(0, 0)
         time.sleep(1)
         self.i2c.set_pin(1, 1)
@@ -186,12 +201,13 @@ class AS726x_I2C:
     def set_mode(self, mode: int):
         if mode > 0b11:
             mode = 0b11
-        value = self.read_reg(self.CONTROL_SETUP)
-        value &= 0b11110011
-        value |= (mode << 2)
-        self.write_reg(self.CONTROL_SETUP, value)
+        self.regs.update(self.CONTROL_SETUP, 0b00001100, mode << 2)
 
-    def get_all_values(self):
+    # fast reads the 24 bytes of the calibrated values in one library call.
+    def get_all_values(self, fast: bool = False):
+        if fast:
+            raw = self.i2c.vreg_read(self.addr, list(range(0x14, 0x2c)))
+            return list(struct.unpack(">6f", bytes(raw)))
         return [
             self.get_calibrated(0x14),
             self.get_calibrated(0x18),
@@ -201,12 +217,45 @@ class AS726x_I2C:
             self.get_calibrated(0x28)]
 
 
+class ATError(IOError):
+    """Unexpected answer to an AT command."""
+
+    def __init__(self, command: str, answer: str):
+        super().__init__("%s: unexpected answer: %r" % (command, answer))
+        self.command = command
+        self.answer = answer
+
+
 class AS726x_SERIAL:
 
-    DEBUG = True
+    DEBUG = False
     FLOAT = r" *([-+]?\d*\.\d+|\d+)"
     HEX = r"([0-9A-F][0-9A-F])"
     HEXD = r"[0-9A-F][0-9A-F]"
+    # Answers, compiled once.
+    OK = re.compile("OK")
+    ANY_OK = re.compile(r".*OK")
+    VERSION = re.compile(HEXD + HEX + "x OK")
+    HEX_OK = re.compile(HEX + "x OK")
+    RESULT = re.compile(r"(\d+), (\d+), (\d+), (\d+), (\d+), (\d+)")
+    RESULT_BYTES = re.compile(rb"(\d+), (\d+), (\d+), (\d+), (\d+), (\d+)")
+    FLOAT_OK = re.compile(FLOAT + " OK")
+    FLOAT2_OK = re.compile(", ".join((FLOAT,) * 2) + " OK")
+    FLOAT3_OK = re.compile(", ".join((FLOAT,) * 3) + " OK")
+    FLOAT4_OK = re.compile(", ".join((FLOAT,) * 4) + " OK")
+    FLOAT6_OK = re.compile(", ".join((FLOAT,) * 6) + " OK")
+    # AS7261 derived values: name, command, answer.
+    COLOR = (
+        ("XYZ", "ATXYZC", FLOAT3_OK),
+        ("lux", "ATLUXC", FLOAT_OK),
+        ("cct", "ATCCTC", FLOAT_OK),
+        ("xy", "ATSMALLXYC", FLOAT2_OK),
+        ("uv", "ATUVPRIMEC", FLOAT4_OK),
+        ("duv", "ATDUVC", FLOAT_OK),
+    )
+    # Continuous burst.
+    BURST_FOREVER = 255
+    RING = 1024
     AS7261 = 0x3D
     AS7262 = 0x3E
     AS7263 = 0x3F
@@ -216,19 +265,23 @@ class AS726x_SERIAL:
 
     def __init__(self, port: str):
         self.ser = serial.Serial(port, 115200, timeout=1)
-        self.chat("AT", "OK")
-        ver = self.chat(
-            "ATVERHW",
-            self.HEXD + self.HEX + "x OK")[1]
+        # Registers are the AT commands: ATLEDC, ATGAIN...
+        self.regs = shadow.ShadowRegisters(self.read_at, self.write_at)
+        self.reader = None
+        self.chat("AT", self.OK)
+        ver = self.chat("ATVERHW", self.VERSION)[1]
         self.ver = int(ver, 16)
-        self.chat("ATTCSMD=2", "OK")
+        self.chat("ATTCSMD=2", self.OK)
         if self.ver == self.AS7261:
             self.set_interval(255)
 
     def get_version(self):
         return self.ver
 
-    def chat(self, tx: str, match: str):
+    # match is a compiled pattern, or a string for the odd command.
+    def chat(self, tx: str, match):
+        if self.reader is not None:
+            raise IOError("Streaming, call stop_stream() first")
         if tx is not None:
             if self.DEBUG:
                 print("TX:", tx)
@@ -238,23 +291,152 @@ class AS726x_SERIAL:
         rx = rx.decode("utf-8")
         if self.DEBUG:
             print("RX:", rx, end='')
-        m = re.match(match, rx)
+        if isinstance(match, str):
+            match = re.compile(match)
+        m = match.match(rx)
         if m is None:
-            if re.match(r".*OK", rx):
+            if self.ANY_OK.match(rx):
                 return None
             raise IOError("Unexpected answer: %s" % rx)
         return m
 
+    # Sends the (command, pattern) pairs back to back, keeping depth of
+    # them (all if None) waiting for their answer, and returns the
+    # matches in order, None for an OK without the expected value as
+    # chat() does. All the answers are read before raising ATError for
+    # the first wrong one, so the line stays in sync. After a timeout the
+    # answers still due are waited for and dropped, see drain().
+    def pipeline(self, commands, depth: int = None):
+        if self.reader is not None:
+            raise IOError("Streaming, call stop_stream() first")
+        depth = min(depth or len(commands), len(commands))
+        if self.DEBUG:
+            for tx, _ in commands:
+                print("TX:", tx)
+        self.ser.write("".join(tx + "\n" for tx, _ in commands[:depth]).encode("utf-8"))
+        sent = depth
+        ret = []
+        error = None
+        for tx, match in commands:
+            rx = self.ser.read_until().decode("utf-8")
+            if self.DEBUG:
+                print("RX:", rx, end='')
+            if not rx:
+                self.drain(sent - len(ret))
+                raise ATError(tx, rx)
+            m = match.match(rx)
+            if m is None and not self.ANY_OK.match(rx) and error is None:
+                error = ATError(tx, rx)
+            ret.append(m)
+            if sent < len(commands):
+                self.ser.write((commands[sent][0] + "\n").encode("utf-8"))
+                sent += 1
+        if error is not None:
+            raise error
+        return ret
+
+    # Reads and drops up to n answers, till the line is quiet for the
+    # serial timeout, then whatever partial line is left: the next
+    # command gets its own answer and not one that came late.
+    def drain(self, n: int):
+        for _ in range(n):
+            rx = self.ser.read_until()
+            if self.DEBUG:
+                print("RX (dropped):", rx.decode("utf-8"), end='')
+            if not rx:
+                break
+        self.ser.reset_input_buffer()
+
+    def read_at(self, cmd: str):
+        return int(self.chat(cmd, self.HEX_OK)[1], 16)
+
+    def write_at(self, cmd: str, val: int):
+        self.chat("%s=%d" % (cmd, val), self.OK)
+
     def measure(self):
         # If you enable double read, ser_interval to 1!
         # self.chat("ATBURST=2", "OK")
         # self.chat(None, r"(\d+), (\d+), (\d+), (\d+), (\d+), (\d+)")
         # r = self.chat(None, r"(\d+), (\d+), (\d+), (\d+), (\d+), (\d+)")
-        self.chat("ATBURST=1", "OK")
-        r = self.chat(None, r"(\d+), (\d+), (\d+), (\d+), (\d+), (\d+)")
-        self.chat("ATBURST=0", ".*OK")
+        self.start_sample()
+        return self.read_sample()
+
+    # Sensor interface of scheduler.py: measure() split in the burst
+    # request and the reading. The module answers when it is done, so
+    # waiting costs nothing on the line.
+    def start_sample(self):
+        self.chat("ATBURST=1", self.OK)
+        return time.monotonic() + self.regs.cached("ATINTTIME", 0) * 0.0028
+
+    def sample_ready(self):
+        return self.ser.in_waiting > 0
+
+    def read_sample(self):
+        r = self.chat(None, self.RESULT)
+        self.chat("ATBURST=0", self.ANY_OK)
         return [int(r[i]) for i in range(1, 7)]
 
+    # Continuous acquisition: the sensor sends every reading, at its own
+    # rate, and a thread keeps the last size of them, with their time,
+    # for stream(). When the ring is full the oldest are lost and
+    # counted in dropped. chat() is not allowed till stop_stream().
+    def start_stream(self, size: int = RING):
+        if self.reader is not None:
+            return
+        self.chat("ATBURST=%d" % self.BURST_FOREVER, self.OK)
+        self.ring = collections.deque(maxlen=size)
+        self.cond = threading.Condition()
+        self.dropped = 0
+        self.received = 0
+        self.stopping = False
+        self.stream_start = time.time()
+        self.reader = threading.Thread(target=self.read_stream)
+        self.reader.daemon = True
+        self.reader.start()
+
+    def read_stream(self):
+        match = self.RESULT_BYTES.match
+        while True:
+            rx = self.ser.read_until()
+            m = match(rx)
+            if m is not None:
+                sample = (time.time(), [int(v) for v in m.groups()])
+                with self.cond:
+                    if len(self.ring) == self.ring.maxlen:
+                        self.dropped += 1
+                    self.ring.append(sample)
+                    self.received += 1
+                    self.cond.notify()
+            elif self.stopping and (b"OK" in rx or not rx):
+                break
+        with self.cond:
+            self.stopping = None
+            self.cond.notify_all()
+
+    def stop_stream(self):
+        if self.reader is None:
+            return
+        with self.cond:
+            self.stopping = True
+        self.ser.write(b"ATBURST=0\n")
+        self.reader.join()
+        self.reader = None
+
+    def stream(self, timeout: float = None):
+        """Yields (time, channels) till stop_stream() or timeout s without data."""
+        while True:
+            with self.cond:
+                if not self.ring and self.stopping is not None:
+                    self.cond.wait(timeout)
+                if not self.ring:
+                    return
+                sample = self.ring.popleft()
+            yield sample
+
+    def stream_rate(self):
+        """Readings per second received since start_stream()."""
+        return self.received / (time.time() - self.stream_start)
+
     # 0: 12.5mA
     # 1: 25mA
     # 2: 50mA
@@ -262,29 +444,23 @@ class AS726x_SERIAL:
     def set_bulb_current(self, current: int):
         if current > 0b11:
             current = 0b11
-        v = int(self.chat("ATLEDC", self.HEX + "x OK")[1], 16)
-        v &= ~(3 << 4)
-        v |= (current << 4)
-        self.chat("ATLEDC=%d" % v, "OK")
+        self.regs.update("ATLEDC", 3 << 4, current << 4)
 
     def set_bulb(self, val: int):
         if val != 0:
             val = 100
-        self.chat("ATLED1=%d" % val, "OK")
+        self.regs.set("ATLED1", val)
 
     def set_indicator(self, val: int):
         if val != 0:
             val = 100
-        self.chat("ATLED0=%d" % val, "OK")
+        self.regs.set("ATLED0", val)
 
     # Max 8mA = 0b11
     def set_indicator_current(self, current: int):
         if current > 0b11:
             current = 0b11
-        v = int(self.chat("ATLEDC", self.HEX + "x OK")[1], 16)
-        v &= ~(3 << 0)
-        v |= (current << 0)
-        self.chat("ATLEDC=%d" % v, "OK")
+        self.regs.update("ATLEDC", 3 << 0, current << 0)
 
     # Gain 0: 1x (power-on default)
     # Gain 1: 3.7x
@@ -293,85 +469,101 @@ class AS726x_SERIAL:
     def set_gain(self, gain: int):
         if gain > 0b11:
             gain = 0b11
-        self.chat("ATGAIN=%d" % gain, "OK")
+        self.regs.set("ATGAIN", gain)
 
     # Give this function a byte from 0 to 255.
     # Time will be 2.8ms * [integration value]
     def set_integration(self, val: int):
-        self.chat("ATINTTIME=%d" % val, "OK")
+        self.regs.set("ATINTTIME", val)
 
     def set_integration_ms(self, val: float):
         self.set_integration(int(val / 2.8))
 
     def set_interval(self, val: int):
-        self.chat("ATINTRVL=%d" % val, "OK")
+        self.regs.set("ATINTRVL", val)
 
     def soft_reset(self):
-        self.chat("ATSRST", "OK")
+        self.chat("ATSRST", self.OK)
+        self.regs.invalidate()
 
     def get_temperature(self):
-        return float(self.chat("ATTEMP", self.FLOAT + " OK")[1])
+        return float(self.chat("ATTEMP", self.FLOAT_OK)[1])
 
     def get_XYZ(self):
-        r = self.chat("ATXYZC", ", ".join((self.FLOAT,) * 3) + " OK")
+        r = self.chat("ATXYZC", self.FLOAT3_OK)
         if r is None:
             return None
         return [float(r[i]) for i in range(1, 4)]
 
     def get_lux(self):
-        r = self.chat("ATLUXC", self.FLOAT + " OK")
+        r = self.chat("ATLUXC", self.FLOAT_OK)
         if r is None:
             return None
         return float(r[1])
 
     def get_cct(self):
-        r = self.chat("ATCCTC", self.FLOAT + " OK")
+        r = self.chat("ATCCTC", self.FLOAT_OK)
         if r is None:
             return None
         return float(r[1])
 
     def get_xy(self):
-        r = self.chat("ATSMALLXYC", ", ".join((self.FLOAT,) * 2) + " OK")
+        r = self.chat("ATSMALLXYC", self.FLOAT2_OK)
         if r is None:
             return None
         return [float(r[i]) for i in range(1, 3)]
 
     def get_uv(self):
-        r = self.chat("ATUVPRIMEC", ", ".join((self.FLOAT,) * 4) + " OK")
+        r = self.chat("ATUVPRIMEC", self.FLOAT4_OK)
         if r is None:
             return None
         return [float(r[i]) for i in range(1, 5)]
 
     def get_duv(self):
-        r = self.chat("ATDUVC", self.FLOAT + " OK")
+        r = self.chat("ATDUVC", self.FLOAT_OK)
         if r is None:
             return None
         return float(r[1])
 
+    # All the AS7261 derived values of get_XYZ() ... get_duv() with one
+    # pipeline: a dict by COLOR name, floats or lists of floats.
+    def get_color(self, depth: int = None):
+        ms = self.pipeline([(cmd, match) for _, cmd, match in self.COLOR], depth)
+        ret = {}
+        for (name, _, _), m in zip(self.COLOR, ms):
+            if m is None:
+                ret[name] = None
+            elif len(m.groups()) == 1:
+                ret[name] = float(m[1])
+            else:
+                ret[name] = [float(v) for v in m.groups()]
+        return ret
+
     def get_all_values(self):
-        r = self.chat("ATCDATA", ", ".join((self.FLOAT,) * 6) + " OK")
+        r = self.chat("ATCDATA", self.FLOAT6_OK)
         if r is None:
             return None
         return [float(r[i]) for i in range(1, 7)]
 
 
-as726x = AS726x_SERIAL("/dev/ttyUSB0")
-as726x.set_bulb_current(0)
-as726x.set_indicator_current(0)
-as726x.set_bulb(1)
-as726x.set_indicator(1)
-as726x.set_gain(3)
-as726x.set_integration_ms(100)
-print(as726x.measure())
-print(as726x.get_temperature())
-if as726x.get_version() == as726x.AS7261:
-    print(as726x.get_XYZ())
-    print(as726x.get_lux())
-    print(as726x.get_cct())
-    print(as726x.get_xy())
-    print(as726x.get_uv())
-    print(as726x.get_duv())
-else:
-    print(as726x.get_all_values())
-as726x.set_bulb(0)
-as726x.set_indicator(0)
+if __name__ == '__main__':
+    as726x = AS726x_SERIAL("/dev/ttyUSB0")
+    as726x.set_bulb_current(0)
+    as726x.set_indicator_current(0)
+    as726x.set_bulb(1)
+    as726x.set_indicator(1)
+    as726x.set_gain(3)
+    as726x.set_integration_ms(100)
+    print(as726x.measure())
+    print(as726x.get_temperature())
+    if as726x.get_version() == as726x.AS7261:
+        print(as726x.get_XYZ())
+        print(as726x.get_lux())
+        print(as726x.get_cct())
+        print(as726x.get_xy())
+        print(as726x.get_uv())
+        print(as726x.get_duv())
+    else:
+        print(as726x.get_all_values())
+    as726x.set_bulb(0)
+    as726x.set_indicator(0)
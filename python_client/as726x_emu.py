@@ -0,0 +1,141 @@
+#!/usr/bin/python3
+
+# AS726x AT command module (SparkFun AS7262/AS7263 UART mode) on a pty,
+# to run AS726x_SERIAL without hardware.
+#
+# The sensor integrates all the time, one integration every
+# ATINTTIME * 2.8 ms. ATBURST=n restarts the integration and sends the
+# raw channels at the end of the next n integrations (255: until
+# ATBURST=0). Every burst of commands from the host costs latency_s,
+# a USB round trip, every command command_s and every answer its bytes
+# at 115200 baud. An AS7261 (version 0x3D) also has the derived values
+# (ATXYZC, ATLUXC...).
+
+AS7261 = 0x3D
+AS7262 = 0x3E
+
+import os
+import select
+import threading
+import time
+import tty
+
+BAUD_BYTE_S = 10.0 / 115200
+
+
+class ATModule:
+
+    DERIVED = {
+        'ATXYZC': '120.50, 100.25, 80.75',
+        'ATLUXC': '100.25',
+        'ATCCTC': '5200.00',
+        'ATSMALLXYC': '0.40, 0.33',
+        'ATUVPRIMEC': '0.21, 0.47, 0.20, 0.46',
+        'ATDUVC': '0.0031',
+    }
+
+    def __init__(self, channels=(1000, 2000, 3000, 4000, 5000, 6000),
+                 version=AS7262, latency_s=0.001, command_s=0.0005,
+                 byte_s=BAUD_BYTE_S):
+        self.channels = channels
+        self.latency_s = latency_s
+        self.command_s = command_s
+        self.byte_s = byte_s
+        self.regs = {
+            'ATVERHW': version, 'ATTCSMD': 2, 'ATINTTIME': 20, 'ATGAIN': 1,
+            'ATINTRVL': 1, 'ATLEDC': 0, 'ATLED0': 0, 'ATLED1': 0}
+        self.burst = 0
+        self.commands = 0
+        # Extra seconds some commands take to answer, by command.
+        self.slow = {}
+        self.samples = 0
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+        self.buf = bytearray()
+        self.rfd, self.wfd = os.pipe()
+        self.start = time.monotonic()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        os.write(self.wfd, b'\0')
+        self.thread.join()
+        for fd in (self.master, self.slave, self.rfd, self.wfd):
+            os.close(fd)
+
+    def period(self):
+        return max(self.regs['ATINTTIME'], 1) * 0.0028
+
+    def next_end(self, now):
+        # End of the integration running at now.
+        n = int((now - self.start) / self.period()) + 1
+        return self.start + n * self.period()
+
+    def send(self, line, command_s=0.0):
+        data = (line + '\n').encode('ascii')
+        time.sleep(command_s + len(data) * self.byte_s)
+        os.write(self.master, data)
+
+    def reading(self):
+        gain = (1.0, 3.7, 16.0, 64.0)[self.regs['ATGAIN'] & 3]
+        scale = gain * self.regs['ATINTTIME'] / 20.0
+        return ', '.join('%d' % min(int(c * scale), 65535) for c in self.channels)
+
+    def answer(self, cmd):
+        self.commands += 1
+        if '=' in cmd:
+            name, value = cmd.split('=', 1)
+            if name == 'ATBURST':
+                self.burst = int(value)
+                self.start = time.monotonic()
+                self.due = self.start + self.period()
+            elif name in self.regs:
+                self.regs[name] = int(value)
+            else:
+                return 'ERROR'
+            return 'OK'
+        if cmd == 'AT':
+            return 'OK'
+        if cmd == 'ATVERHW':
+            return '40%02Xx OK' % self.regs['ATVERHW']
+        if cmd == 'ATLEDC':
+            return '%02Xx OK' % self.regs['ATLEDC']
+        if cmd == 'ATTEMP':
+            return '25 OK'
+        if cmd == 'ATDATA':
+            return self.reading() + ' OK'
+        if cmd == 'ATCDATA':
+            return ', '.join('%.2f' % (c / 10.0) for c in self.channels) + ' OK'
+        if cmd in self.DERIVED and self.regs['ATVERHW'] == AS7261:
+            return self.DERIVED[cmd] + ' OK'
+        if cmd == 'ATSRST':
+            self.burst = 0
+            return 'OK'
+        return 'ERROR'
+
+    def run(self):
+        while True:
+            timeout = None
+            if self.burst:
+                timeout = max(self.due - time.monotonic(), 0.0)
+            r, _, _ = select.select((self.master, self.rfd), (), (), timeout)
+            if self.rfd in r:
+                return
+            if self.master in r:
+                self.buf += os.read(self.master, 4096)
+                time.sleep(self.latency_s)
+                while b'\n' in self.buf:
+                    line, _, rest = bytes(self.buf).partition(b'\n')
+                    self.buf = bytearray(rest)
+                    cmd = line.decode('ascii').strip()
+                    if cmd:
+                        self.send(self.answer(cmd),
+                                  self.command_s + self.slow.get(cmd, 0.0))
+            if self.burst and time.monotonic() >= self.due:
+                self.samples += 1
+                self.send(self.reading())
+                self.due = self.next_end(time.monotonic())
+                if self.burst != 255:
+                    self.burst -= 1
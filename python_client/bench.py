@@ -0,0 +1,1318 @@
+#!/usr/bin/python3
+
+# Benchmarks of the client hot paths, they need no hardware.
+# Run them all with ./bench.py or pick some: ./bench.py lux_batch
+#
+# --save FILE keeps the results as a baseline, --compare FILE prints the
+# change of every result against it and exits with 1 if some result got
+# worse than the tolerance or some check failed. Results are compared by
+# their name, see direction(): rates, speedups and counts of what was
+# found should not go down, times, round trips, bytes, errors and misses
+# should not go up, and true checks should stay true. A numeric result
+# without a direction is an error. Timings vary with the load of the
+# machine: they have a --time-tolerance of their own, changes under a
+# floor per unit are ignored (see timing() and floor()), and they may be
+# slower by as much as calibrate() says the machine is slower than when
+# the baseline was taken.
+# --repeat runs every benchmark more times and keeps the best of each
+# result, --runs runs all of them more times and keeps the median of the
+# best results. bench_baseline.json is the baseline of this tree:
+#
+#   ./bench.py --runs 5 --repeat 3 --save bench_baseline.json
+#   ./bench.py --repeat 3 --compare bench_baseline.json
+#
+# The benchmarks of the Bus Pirate drivers are skipped when
+# ../buspirate_client/libbuspirate.so is not built.
+
+import argparse
+import asyncio
+import collections
+import ctypes
+import json
+import math
+import os
+import queue
+import random
+import re
+import select
+import struct
+import sys
+import tempfile
+import time
+
+import blm_async
+import blm_exposure
+import blm_lux
+import blm_packet
+import blm_record
+import blm_ring
+import blm_server
+import blm_sim
+import blm_stats
+from blm_thread import BLMThread, Processor
+
+BENCHES = collections.OrderedDict()
+
+
+def bench(fn):
+    BENCHES[fn.__name__] = fn
+    return fn
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    ret = fn(*args)
+    return time.perf_counter() - start, ret
+
+
+def calibrate(n=20000):
+    """ns per iteration of a fixed Python loop, best of 5: how fast the
+    machine runs Python right now."""
+
+    def loop():
+        d = {}
+        x = 0.0
+        for i in range(n):
+            x += i * 0.5
+            d[i & 255] = x
+        return x
+
+    return 1e9 * min(timed(loop)[0] for _ in range(5)) / n
+
+
+def skipped(e):
+    # The Bus Pirate drivers load ../buspirate_client/libbuspirate.so
+    # when imported: without it their benchmarks are skipped.
+    return collections.OrderedDict((('skipped', str(e)),))
+
+
+def random_samples(n, seed=0):
+    rnd = random.Random(seed)
+    ch0 = [rnd.choice((0, 0xffff, rnd.randint(1, 0xfffe))) for _ in range(n)]
+    ch1 = [min(int(c * rnd.random() * 1.5), 0xffff) for c in ch0]
+    mode = [rnd.randint(0, 3) for _ in range(n)]
+    int_time = [rnd.randint(1, 3000) for _ in range(n)]
+    higain = [rnd.random() < 0.5 for _ in range(n)]
+    return ch0, ch1, mode, int_time, higain
+
+
+@bench
+def lux_batch(n=1000000):
+    ch0, ch1, mode, int_time, higain = random_samples(n)
+
+    def loop():
+        ret = []
+        for c0, c1, m, t, h in zip(ch0, ch1, mode, int_time, higain):
+            ret.append(blm_lux.lux(c0, c1, blm_lux.integration_ms(m, t), h))
+        return ret
+
+    # Recorded data is already in arrays.
+    arrays = [blm_lux.np.array(v) for v in (ch0, ch1, mode, int_time, higain)]
+
+    def batch():
+        a0, a1, amode, aint_time, ahigain = arrays
+        ms = blm_lux.integration_ms_batch(amode, aint_time)
+        return blm_lux.lux_batch(a0, a1, ms, ahigain)
+
+    t_loop, ref = timed(loop)
+    t_batch, (lux, ev, saturated) = timed(batch)
+    err = max(abs(a - b) for a, b in zip(ref, lux.tolist()))
+    return collections.OrderedDict((
+        ('samples', n),
+        ('loop_ns_per_sample', 1e9 * t_loop / n),
+        ('batch_ns_per_sample', 1e9 * t_batch / n),
+        ('speedup', t_loop / t_batch),
+        ('max_abs_diff', err)))
+
+
+class ListWindow:
+    # The list based window BLMThread.calc_max_lux used before WindowStats.
+
+    def __init__(self, length_s):
+        self.length_s = length_s
+        self.med = []
+
+    def add(self, now, lux):
+        self.med.append((now, lux))
+        i = 0
+        while self.med[i][0] < now - self.length_s:
+            i += 1
+        self.med = self.med[i:]
+        all_lux = [x[1] for x in self.med]
+        return max(all_lux), sum(all_lux) / float(len(all_lux))
+
+
+@bench
+def window_stats(n=100000, length_s=3.0, period_s=0.0137):
+    rnd = random.Random(0)
+    lux = [rnd.uniform(0.0, 1000.0) for _ in range(n)]
+
+    def run_list():
+        w = ListWindow(length_s)
+        return [w.add(i * period_s, v) for i, v in enumerate(lux)]
+
+    def run_stats():
+        w = blm_stats.WindowStats(length_s)
+        ret = []
+        for i, v in enumerate(lux):
+            w.add(i * period_s, v)
+            ret.append((w.max(), w.mean()))
+        return ret
+
+    t_list, ref = timed(run_list)
+    t_stats, out = timed(run_stats)
+    return collections.OrderedDict((
+        ('samples', n),
+        ('window', int(length_s / period_s)),
+        ('list_us_per_sample', 1e6 * t_list / n),
+        ('stats_us_per_sample', 1e6 * t_stats / n),
+        ('speedup', t_list / t_stats),
+        ('max_equal', all(a[0] == b[0] for a, b in zip(ref, out))),
+        ('max_mean_rel_diff', max(abs(a[1] - b[1]) / max(abs(a[1]), 1e-300)
+                                  for a, b in zip(ref, out)))))
+
+
+def random_packets(n, seed=0):
+    # A slowly varying light with a mode change every 1000 packets, the
+    # run byte counts the packets like the firmware does.
+    rnd = random.Random(seed)
+    ch0 = 1000
+    ret = []
+    for i in range(n):
+        ch0 = max(0, min(0xffff, ch0 + rnd.randint(-20, 20)))
+        ch1 = ch0 // 3 + rnd.randint(0, 5)
+        mode = (i // 1000) % 3
+        ret.append(bytearray(struct.pack('<BBHHBH', 0x11, i & 0xff, ch0, ch1, mode, 0)))
+    return ret
+
+
+@bench
+def record(n=200000, period_s=0.0137):
+    packets = random_packets(n)
+    fd, path = tempfile.mkstemp(suffix='.blmr')
+    os.close(fd)
+    os.unlink(path)
+    try:
+        def write():
+            r = blm_record.Recorder(path)
+            for i, p in enumerate(packets):
+                r.append(1e9 + i * period_s, p)
+            r.close()
+
+        def replay():
+            dev = blm_record.Replay(path, realtime=False)
+            n = 0
+            try:
+                while True:
+                    dev.read_raw()
+                    n += 1
+            except EOFError:
+                pass
+            dev.close()
+            return n
+
+        t_write, _ = timed(write)
+        t_replay, count = timed(replay)
+        ok = [p for _, p in blm_record.Reader(path)] == packets
+        size = os.path.getsize(path)
+    finally:
+        os.unlink(path)
+    day = 86400 / period_s
+    return collections.OrderedDict((
+        ('packets', n),
+        ('record_us_per_packet', 1e6 * t_write / n),
+        ('replay_us_per_packet', 1e6 * t_replay / n),
+        ('bytes_per_packet', float(size) / n),
+        ('replay_day_s', t_replay / n * day),
+        ('roundtrip_ok', ok and count == n)))
+
+
+def dict_decode(raw):
+    # blm_packet.decode before Sample.
+    if raw[0] == 0x11:
+        return {
+            'ch0' : raw[2] + raw[3] * 256,
+            'ch1' : raw[4] + raw[5] * 256,
+            'mode': raw[6] & 0x3,
+            'higain': (raw[6] & 0x10) > 0,
+            'int_time': raw[7] + raw[8] * 256}
+
+
+@bench
+def decode(n=200000):
+    # Per sample cost of decoding, of keeping the samples in memory and
+    # of pickling what BLMThread publishes, dicts against Sample. Pickling
+    # is only for multiprocessing.Queue users, which there are none of
+    # now: blm_ring packs the readings to the GUI with a struct and the
+    # daemon queue is between threads. A Sample pickles as its class
+    # and its fields, the class reference is most of the cost.
+    import pickle
+    import tracemalloc
+    packets = random_packets(n)
+    ret = collections.OrderedDict()
+    decoders = (('dict', dict_decode), ('struct', blm_packet.decode))
+
+    def stream(fn):
+        # Decoded and dropped, like the acquisition loop does.
+        for p in packets:
+            fn(p)
+
+    # Best of runs taking turns, both see the same load.
+    best = {}
+    for _ in range(5):
+        for name, fn in decoders:
+            best[name] = min(best.get(name, float('inf')), timed(stream, fn)[0])
+    for name, fn in decoders:
+        ret[name + '_decode_ns_per_sample'] = 1e9 * best[name] / n
+        states = [fn(p) for p in packets]
+        tracemalloc.start()
+        kept = [fn(p) for p in packets[:10000]]
+        ret[name + '_bytes_per_sample'] = tracemalloc.get_traced_memory()[0] / 10000.0
+        tracemalloc.stop()
+        del kept
+        data = [{'time': 0.0, 'lux': 1.0, 'max_lux': 1.0, 'med_lux': 1.0,
+                 'min_lux': 1.0, 'var_lux': 0.0, 'state': s} for s in states[:10000]]
+        t, pickled = timed(lambda: [pickle.dumps(d, pickle.HIGHEST_PROTOCOL) for d in data])
+        ret[name + '_pickle_ns_per_sample'] = 1e9 * t / len(data)
+        ret[name + '_pickle_bytes'] = len(pickled[0])
+    buf = b''.join(bytes(p) for p in packets)
+    t, array = timed(blm_packet.decode_array, buf)
+    ret['array_decode_ns_per_sample'] = 1e9 * t / n
+    ret['array_bytes_per_sample'] = array.itemsize
+    ret['array_ok'] = array['ch0'].tolist() == [s['ch0'] for s in states]
+    return ret
+
+
+@bench
+def batch(duration=60.0, loss=0.05):
+    # 13.7 ms integrations sent one (0x11) or three (0x12) per packet,
+    # dropping some packets here: the decoder must find exactly the
+    # samples missing between the first and the last received.
+    ret = collections.OrderedDict()
+    rnd = random.Random(0)
+    for size in (1, blm_packet.BATCH_MAX):
+        sim = blm_sim.Simulator(blm_sim.Constant(1000.0), duration=duration,
+                                start=0.0, batch=size)
+        sim.write({'mode': 0})
+        decoder = blm_packet.Decoder()
+        packets = samples = 0
+        sent = []
+        t = 0.0
+        try:
+            while True:
+                raw = sim.read_raw()
+                n = raw[1] if size > 1 else 1
+                if rnd.random() < loss:
+                    sent.append((n, False))
+                    continue
+                sent.append((n, True))
+                packets += 1
+                start = time.perf_counter()
+                samples += len(decoder.decode(raw))
+                t += time.perf_counter() - start
+        except EOFError:
+            pass
+        received = [i for i, (n, ok) in enumerate(sent) if ok]
+        lost = sum(n for n, ok in sent[received[0]:received[-1]] if not ok)
+        name = 'batch%d' % size
+        ret[name + '_packets_per_s'] = packets / duration
+        ret[name + '_samples_per_s'] = samples / duration
+        ret[name + '_lost'] = decoder.lost
+        ret[name + '_lost_ok'] = decoder.lost == lost
+        ret[name + '_gaps'] = decoder.gaps
+        ret[name + '_us_per_packet'] = 1e6 * t / packets
+    return ret
+
+
+class Sink:
+    # Stands for the lux queue, keeps everything with the device time.
+
+    def __init__(self, device):
+        self.device = device
+        self.data = []
+
+    def put_nowait(self, data):
+        self.data.append((self.device.clock(), data))
+
+
+def run_pipeline(light, duration, profile='all', ratio=0.3):
+    sim = blm_sim.Simulator(light, ratio=ratio, duration=duration, start=0.0)
+    sink = Sink(sim)
+    bt = BLMThread(queue.Queue(), sink, lambda: sim)
+    bt.profile = profile
+    t, _ = timed(bt.run)
+    return t, sink.data
+
+
+def settle_time(data, at, profile='all'):
+    # Time after at until the counters of an integration started after
+    # at are in the profile range.
+    p = BLMThread.PROFILES[profile]
+    for t, d in data:
+        s = d['state']
+        start = t - blm_lux.integration_ms(s['mode'], s['int_time']) / 1000.0
+        if start >= at and p['min'] <= s['ch0'] <= p['max'] and p['min'] <= s['ch1'] <= p['max']:
+            return t - at
+    return float('inf')
+
+
+@bench
+def pipeline(duration=600.0):
+    light = blm_sim.Noise(blm_sim.Ramp(1.0, 50000.0, duration), 0.02, seed=0)
+    t, data = run_pipeline(light, duration, 'fast')
+    return collections.OrderedDict((
+        ('simulated_s', duration),
+        ('samples', len(data)),
+        ('us_per_sample', 1e6 * t / len(data)),
+        ('faster_than_realtime', duration / t)))
+
+
+@bench
+def autorange(profiles=('all', 'predict')):
+    ret = collections.OrderedDict()
+    for profile in profiles:
+        for name, before, after in (('dark_to_sun', 20.0, 20000.0),
+                                    ('sun_to_dark', 20000.0, 20.0),
+                                    ('room_to_office', 100.0, 500.0),
+                                    ('night_to_sun', 5.0, 50000.0),
+                                    ('sun_to_night', 50000.0, 5.0)):
+            light = blm_sim.Step(before, after, 10.0)
+            t, data = run_pipeline(light, 30.0, profile)
+            ret['%s_%s_settle_s' % (profile, name)] = settle_time(data, 10.0, profile)
+    return ret
+
+
+@bench
+def flash(duration=12.0):
+    # Flashes of 200000 lux over 50 lux every second from 2 s, shorter,
+    # about as long and longer than an integration.
+    ret = collections.OrderedDict()
+    for ms in (1.0, 10.0, 30.0):
+        truth = (200000.0 - 50.0) * ms / 1000.0
+        light = blm_sim.Noise(blm_sim.Flash(50.0, 200000.0, 2.0, ms / 1000.0, 1.0),
+                              0.02, seed=0)
+        t, data = run_pipeline(light, duration, 'flash')
+        flashes = [(clock, d['flash']) for clock, d in data if 'flash' in d]
+        name = 'flash_%gms' % ms
+        ret[name + '_flashes'] = int(duration - 2.0)
+        ret[name + '_found'] = len(flashes)
+        ret[name + '_exposure_err_percent'] = max(
+            abs(f['exposure'] - truth) / truth * 100.0 for _, f in flashes)
+        # From the end of the flash to the result.
+        ret[name + '_latency_ms'] = max(
+            1000.0 * (clock - (2.0 + round(f['time'] - 2.0) + ms / 1000.0))
+            for clock, f in flashes)
+        # What the window maximum gives, as lux s over one integration.
+        ret[name + '_max_lux_err_percent'] = 100.0 * abs(
+            data[-1][1]['max_lux'] * blm_lux.MODE_MS[0] / 1000.0 - truth) / truth
+    # Processor.capture_flash() alone, on the samples of ten flash runs
+    # one after the other, by a new Processor every time.
+    _, data = run_pipeline(light, duration, 'flash')
+    samples = [(clock + i * duration, d['lux'])
+               for i in range(10) for clock, d in data]
+
+    def processor():
+        proc = Processor()
+        proc.ch0, proc.ch1, proc.higain = 100, 30, False
+        proc.ms = blm_lux.MODE_MS[0]
+        return proc
+
+    def capture(proc):
+        for clock, lux in samples:
+            proc.capture_flash(lux, clock)
+
+    t = min(timed(capture, processor())[0] for _ in range(5))
+    ret['capture_overhead_us_per_sample'] = 1e6 * t / len(samples)
+    return ret
+
+
+async def run_core(n, duration, realtime):
+    core = blm_async.Core(profile='manual')
+    for i in range(n):
+        sim = blm_sim.Simulator(blm_sim.Constant(1000.0), duration=duration)
+        sim.write({'mode': 0})
+        core.add('sim%d' % i, blm_async.SimMeter(sim, realtime))
+    count = 0
+    latency = 0.0
+    async for data in core.stream():
+        count += 1
+        latency += time.time() - data['time']
+    return count, latency / max(count, 1)
+
+
+@bench
+def async_core(counts=(1, 8, 64, 256), duration=2.0):
+    # Simulated meters at 13.7 ms, in real time to see the CPU load and
+    # the latency, then as fast as possible for the throughput.
+    ret = collections.OrderedDict()
+    for n in counts:
+        cpu = time.process_time()
+        wall, (samples, latency) = timed(asyncio.run, run_core(n, duration, True))
+        cpu = time.process_time() - cpu
+        ret['%d_meters_samples_per_s' % n] = samples / wall
+        ret['%d_meters_cpu_percent' % n] = 100.0 * cpu / wall
+        ret['%d_meters_latency_ms' % n] = 1000.0 * latency
+        wall, (samples, _) = timed(asyncio.run, run_core(n, duration, False))
+        ret['%d_meters_max_samples_per_s' % n] = samples / wall
+    return ret
+
+
+def ring_producer(ring, n):
+    for i in range(n):
+        # Every field from i: a torn record does not add up.
+        ring.put_nowait({'time': float(i), 'lux': float(i), 'max_lux': 0.0,
+                         'med_lux': 0.0, 'min_lux': 0.0, 'var_lux': 0.0,
+                         'state': blm_packet.Sample(1, 2, 0, False, 0,
+                                                    i & 0xffff)})
+
+
+def ring_record_ok(d):
+    return d['time'] == d['lux'] and d['state'].seq == int(d['lux']) & 0xffff
+
+
+@bench
+def ring(n=200000):
+    # A producer process as fast as it can, the consumer waiting on the
+    # wakeup pipe like the GUI does.
+    import multiprocessing
+    ret = collections.OrderedDict()
+    for policy in blm_ring.POLICIES:
+        r = blm_ring.Ring(policy=policy)
+        p = multiprocessing.Process(target=ring_producer, args=(r, n))
+        start = time.perf_counter()
+        p.start()
+        got = []
+        torn = 0
+        while p.is_alive() or r.pending():
+            select.select([r], [], [], 0.1)
+            for d in r.get_all():
+                got.append(d['lux'])
+                torn += not ring_record_ok(d)
+        t = time.perf_counter() - start
+        p.join()
+        in_order = all(a < b for a, b in zip(got, got[1:]))
+        ret[policy + '_samples_per_s'] = len(got) / t
+        ret[policy + '_received'] = len(got)
+        ret[policy + '_dropped'] = r.dropped()
+        ret[policy + '_coalesced'] = r.coalesced()
+        ret[policy + '_accounted'] = (len(got) + r.dropped() + r.coalesced() == n
+                                      and in_order and not torn)
+    # Idle: no CPU used waiting for samples.
+    r = blm_ring.Ring()
+    cpu = time.process_time()
+    select.select([r], [], [], 0.5)
+    ret['idle_cpu_s'] = time.process_time() - cpu
+    return ret
+
+
+class StringCalculator:
+    # The GUI exposure calculator before blm_exposure: string tuples
+    # parsed and scanned on every sample.
+
+    AVc = ('1', '1.4', '2', '2.8', '4', '5.6', '8', '11', '16', '22', '32')
+    TVc = ('30', '15', '8', '4', '2', '1', '1/2', '1/4', '1/8', '1/15', '1/30', '1/60', '1/125', '1/250', '1/500', '1/1000', '1/2000', '1/4000', '1/8000')
+
+    def make_float(self, v):
+        if v.startswith('1/'):
+            return 1.0 / float(v[2:])
+        return float(v)
+
+    def find_nearer(self, val, l):
+        min = 1e10
+        ret = l[0]
+        for i in l:
+            diff = math.fabs(self.make_float(i) - val)
+            if diff < min:
+                ret = i
+                min = diff
+        return ret
+
+    def calc_ev(self, av, tv):
+        return math.log(math.pow(av, 2.0) / tv, 2.0)
+
+    def calc_tv(self, ev, av, iso):
+        delta_ev = math.log(iso / 100.0, 2.0)
+        ev += delta_ev
+        tvn = self.find_nearer(math.pow(av, 2.0) / math.pow(2.0, ev), self.TVc)
+        return tvn, self.calc_ev(av, self.make_float(tvn)) - delta_ev
+
+
+@bench
+def exposure(n=100000):
+    # Shutter time for Av and ISO at every sample, as calc_goal does.
+    rnd = random.Random(0)
+    evs = [rnd.uniform(-6.0, 20.0) for _ in range(n)]
+    old = StringCalculator()
+    av, iso = 5.6, 400.0
+    av_stop, iso_stop = blm_exposure.av_stop(av), blm_exposure.iso_stop(iso)
+    tv = blm_exposure.TV['full']
+
+    def strings():
+        return [old.calc_tv(ev, av, iso)[0] for ev in evs]
+
+    def stops():
+        return [tv.labels[blm_exposure.solve_tv(ev, av_stop, iso_stop)[0]]
+                for ev in evs]
+
+    t_old, ref = timed(strings)
+    t_new, got = timed(stops)
+    ret = collections.OrderedDict((
+        ('samples', n),
+        ('find_nearer_ns_per_sample', 1e9 * t_old / n),
+        ('bisect_ns_per_sample', 1e9 * t_new / n),
+        ('speedup', t_old / t_new),
+        # find_nearer is nearest in seconds, not in stops.
+        ('same_result', sum(a == b for a, b in zip(ref, got)) / float(n))))
+    for steps in blm_exposure.STEPS:
+        scales = (blm_exposure.AV[steps], blm_exposure.TV[steps],
+                  blm_exposure.ISO[steps])
+        t, g = timed(blm_exposure.grid, evs[:1000], *scales)
+        ret['%s_grid_cells' % steps] = g[0].size
+        ret['%s_grid_us' % steps] = 1e6 * t / 1000
+    return ret
+
+
+def fanout_readers(path, n, conn):
+    # Subscribers in their own process, so they do not share the GIL
+    # with the server. Each line is a reading, latency is measured on
+    # the last one of each chunk.
+    import socket
+    socks = []
+    for _ in range(n):
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        s.connect(path)
+        socks.append(s)
+    poll = select.poll()
+    tails = {}
+    for s in socks:
+        poll.register(s, select.POLLIN)
+        tails[s.fileno()] = b''
+    conn.send('ready')
+    received = 0
+    latency = []
+    last_seq = dict.fromkeys(tails, -1)
+    while tails:
+        for fd, _ in poll.poll():
+            chunk = os.read(fd, 1 << 16)
+            if not chunk:
+                poll.unregister(fd)
+                del tails[fd]
+                continue
+            buf = tails[fd] + chunk
+            end = buf.rfind(b'\n')
+            if end < 0:
+                tails[fd] = buf
+                continue
+            received += buf.count(b'\n', 0, end + 1)
+            start = buf.rfind(b'\n', 0, end) + 1
+            data = json.loads(buf[start:end].decode())
+            latency.append(time.time() - data['time'])
+            last_seq[fd] = data['seq']
+            tails[fd] = buf[end + 1:]
+    conn.send((received, latency, list(last_seq.values())))
+
+
+@bench
+def fanout(counts=(100, 500), rate=2000.0, duration=3.0):
+    # One producer at rate readings/s, far more than the meter does, n
+    # subscribers reading everything and one that never reads: it must
+    # not slow down the others.
+    import multiprocessing
+    import socket
+    ret = collections.OrderedDict()
+    state = blm_packet.Sample(1, 2, 0, False, 0)
+    for n in counts:
+        path = os.path.join(tempfile.mkdtemp(), 'blm.sock')
+        server = blm_server.Server('unix:' + path, max_buffer=1 << 16)
+        conn, child = multiprocessing.Pipe()
+        p = multiprocessing.Process(target=fanout_readers, args=(path, n, child))
+        p.start()
+        conn.recv()
+        stuck = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stuck.connect(path)
+        time.sleep(0.1)
+        total = int(rate * duration)
+        start = time.time()
+        puts = []
+        for i in range(total):
+            delay = start + i / rate - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            t = time.perf_counter()
+            server.put_nowait({'time': time.time(), 'lux': float(i),
+                               'max_lux': 0.0, 'med_lux': 0.0, 'min_lux': 0.0,
+                               'var_lux': 0.0, 'state': state})
+            puts.append(time.perf_counter() - t)
+        # Let the last batch go out, then close to end the readers.
+        time.sleep(0.5)
+        dropped = server.dropped()
+        server.close()
+        received, latency, last_seq = conn.recv()
+        p.join()
+        stuck.close()
+        latency.sort()
+        ret['%d_clients_samples_per_s' % n] = received / duration
+        ret['%d_clients_lossless' % n] = last_seq == [total - 1] * n and received == n * total
+        ret['%d_clients_median_latency_ms' % n] = 1000.0 * latency[len(latency) // 2]
+        ret['%d_clients_p99_latency_ms' % n] = 1000.0 * latency[int(len(latency) * 0.99)]
+        # One CPU here: the max is mostly the producer being preempted.
+        puts.sort()
+        ret['%d_clients_median_put_us' % n] = 1e6 * puts[len(puts) // 2]
+        ret['%d_clients_p99_put_us' % n] = 1e6 * puts[int(len(puts) * 0.99)]
+        ret['%d_clients_max_put_us' % n] = 1e6 * puts[-1]
+        ret['%d_clients_slow_dropped' % n] = dropped
+        ret['%d_clients_unlinked' % n] = not os.path.exists(path)
+    return ret
+
+
+@bench
+def as726x(n=20, integration=1):
+    # AS726x_I2C on the Bus Pirate emulator: readings/s and USB round
+    # trips of measure() and get_all_values(), one by one register or
+    # with the virtual register transactions of libbuspirate.
+    try:
+        import as726x
+    except OSError as e:
+        return skipped(e)
+    import buspirate_emu
+    ret = collections.OrderedDict()
+    sensor = buspirate_emu.AS726x()
+    pirate = buspirate_emu.BusPirate([sensor])
+    dev = as726x.AS726x_I2C(pirate.port)
+    dev.set_integration(integration)
+    for fast in (False, True):
+        mode = 'fast' if fast else 'slow'
+
+        def reading():
+            dev.measure(fast)
+            return dev.get_all_values(fast)
+
+        pirate.reset_counters()
+        dt, values = timed(lambda: [reading() for _ in range(n)])
+        ret[mode + '_readings_per_s'] = n / dt
+        ret[mode + '_round_trips'] = pirate.bursts / n
+        ret[mode + '_commands'] = pirate.commands / n
+        pirate.reset_counters()
+        dt, values = timed(lambda: [dev.get_all_values(fast) for _ in range(n)])
+        ret[mode + '_values_ms'] = 1000.0 * dt / n
+        ret[mode + '_values_round_trips'] = pirate.bursts / n
+        ret[mode + '_ok'] = values[-1] == values[0] and values[0][0] > 0.0
+    # A reconfiguration: first read of the registers, then from the
+    # shadow, then with the writes merged.
+
+    def configure():
+        dev.set_gain(2)
+        dev.set_bulb_current(1)
+        dev.set_indicator(1)
+        dev.set_mode(3)
+
+    def configure_batch():
+        with dev.regs.batch():
+            configure()
+
+    for name, fn in (('config_cold', configure), ('config_cached', configure),
+                     ('config_batch', configure_batch)):
+        if name == 'config_cold':
+            dev.regs.invalidate()
+        pirate.reset_counters()
+        dt, _ = timed(fn)
+        ret[name + '_ms'] = 1000.0 * dt
+        ret[name + '_round_trips'] = pirate.bursts
+    pirate.close()
+    return ret
+
+
+@bench
+def as726x_serial(integrations=(5, 20, 100), duration=2.0):
+    # AS726x_SERIAL on the AT module emulator: readings/s of measure() in
+    # a loop and of the continuous stream, against the sensor rate.
+    try:
+        import as726x
+    except OSError as e:
+        return skipped(e)
+    import as726x_emu
+    ret = collections.OrderedDict()
+    module = as726x_emu.ATModule()
+    dev = as726x.AS726x_SERIAL(module.port)
+    for it in integrations:
+        dev.set_integration(it)
+        name = '%.0fms' % (it * 2.8)
+        ret[name + '_sensor_per_s'] = 1.0 / module.period()
+        start = time.time()
+        n = 0
+        while time.time() - start < duration:
+            dev.measure()
+            n += 1
+        ret[name + '_loop_per_s'] = n / (time.time() - start)
+        dev.start_stream()
+        for t, _ in dev.stream():
+            if t - dev.stream_start > duration:
+                break
+        ret[name + '_stream_per_s'] = dev.stream_rate()
+        dev.stop_stream()
+        ret[name + '_stream_dropped'] = dev.dropped
+    module.close()
+    return ret
+
+
+@bench
+def as726x_color(latencies=(0.001, 0.016), n=20):
+    # The six AS7261 derived values one chat() at a time and pipelined,
+    # with the USB latency of a CH340 like adapter and of an FTDI one
+    # (16 ms latency timer).
+    try:
+        import as726x
+    except OSError as e:
+        return skipped(e)
+    import as726x_emu
+    ret = collections.OrderedDict()
+    for latency in latencies:
+        module = as726x_emu.ATModule(version=as726x_emu.AS7261, latency_s=latency)
+        dev = as726x.AS726x_SERIAL(module.port)
+
+        def sequential():
+            return {'XYZ': dev.get_XYZ(), 'lux': dev.get_lux(),
+                    'cct': dev.get_cct(), 'xy': dev.get_xy(),
+                    'uv': dev.get_uv(), 'duv': dev.get_duv()}
+
+        name = '%.0fms_latency' % (latency * 1000.0)
+        dt, seq = timed(lambda: [sequential() for _ in range(n)])
+        ret[name + '_sequential_ms'] = 1000.0 * dt / n
+        dt, pipe = timed(lambda: [dev.get_color() for _ in range(n)])
+        ret[name + '_pipelined_ms'] = 1000.0 * dt / n
+        ret[name + '_same'] = seq[-1] == pipe[-1]
+        try:
+            dev.pipeline([('ATLUXC', dev.FLOAT_OK), ('ATNOPE', dev.OK),
+                          ('ATCCTC', dev.FLOAT_OK)])
+            ret[name + '_error_command'] = None
+        except as726x.ATError as e:
+            ret[name + '_error_command'] = e.command
+        ret[name + '_in_sync'] = dev.get_lux() == pipe[-1]['lux']
+        # An answer past the serial timeout, with more pipelined after it.
+        timeout = dev.ser.timeout
+        dev.ser.timeout = 0.2
+        module.slow['ATCCTC'] = 0.3
+        try:
+            dev.pipeline([('ATLUXC', dev.FLOAT_OK), ('ATCCTC', dev.FLOAT_OK),
+                          ('ATDUVC', dev.FLOAT_OK), ('ATXYZC', dev.FLOAT3_OK)])
+            ret[name + '_timeout_command'] = None
+        except as726x.ATError as e:
+            ret[name + '_timeout_command'] = e.command
+        del module.slow['ATCCTC']
+        dev.ser.timeout = timeout
+        ret[name + '_in_sync_after_timeout'] = dev.get_lux() == pipe[-1]['lux']
+        module.close()
+    return ret
+
+
+@bench
+def tcs34725(n=40, integration_ms=24, duration=1.0):
+    # TCS34725 on the Bus Pirate emulator, at 50 and 400 kHz: stream()
+    # against calling read_crgb() in a loop, which spins on STATUS and
+    # returns the same integration many times. I2C bytes are per
+    # integration of the sensor. stream() also runs with the sensor
+    # oscillator 3% slow and 3% fast (*_slow_*, *_fast_*): it must
+    # neither return an integration twice (repeats) nor skip one, it
+    # resyncs instead.
+    try:
+        import buspirate as bp
+    except OSError as e:
+        return skipped(e)
+    import buspirate_emu
+    import tcs34725
+    ret = collections.OrderedDict()
+    sensor = buspirate_emu.TCS34725()
+    pirate = buspirate_emu.BusPirate([sensor])
+    for speed, name in ((bp.I2C_SPEED_50KHZ, '50khz'),
+                        (bp.I2C_SPEED_400KHZ, '400khz')):
+        for skew, prefix in ((1.03, name + '_slow'), (0.97, name + '_fast'),
+                             (1.0, name)):
+            sensor.skew = skew
+            dev = tcs34725.TCS34725(pirate.port, speed)
+            dev.power_on()
+            dev.integration_ms(integration_ms)
+            dev.start()
+            ret[prefix + '_sensor_per_s'] = 1.0 / sensor.period()
+            pirate.reset_counters()
+            first = sensor.integrations()
+            dt, readings = timed(lambda: [c for _, c in dev.stream(n)])
+            integrations = sensor.integrations() - first
+            ret[prefix + '_stream_per_s'] = n / dt
+            ret[prefix + '_stream_missed'] = dev.missed
+            ret[prefix + '_stream_repeats'] = sum(
+                a == b for a, b in zip(readings, readings[1:]))
+            ret[prefix + '_stream_resyncs'] = dev.resyncs
+            ret[prefix + '_stream_bytes'] = pirate.bus_bytes / integrations
+        pirate.reset_counters()
+        first = sensor.integrations()
+        start = time.time()
+        calls = 0
+        while time.time() - start < duration:
+            dev.read_crgb()
+            calls += 1
+        integrations = sensor.integrations() - first
+        ret[name + '_spin_calls_per_integration'] = calls / integrations
+        ret[name + '_spin_bytes'] = pirate.bus_bytes / integrations
+    pirate.close()
+    return ret
+
+
+def list_send_args(data):
+    # buspirate.I2C.send before the buffer protocol.
+    raw = (ctypes.c_ubyte * len(data))()
+    for i, v in enumerate(data):
+        raw[i] = data[i]
+    return raw
+
+
+class NullLib:
+    # libbuspirate with every function replaced by libc abs(), called
+    # with the argument conversions of the real one: the NULL handle is
+    # the first argument, so it returns 0 and does nothing.
+
+    def __init__(self, lib):
+        libc = ctypes.CDLL(None)
+        address = ctypes.cast(libc.abs, ctypes.c_void_p).value
+        for name in ('i2c_cmd_recv', 'i2c_send', 'i2c_recv'):
+            fn = getattr(lib, name)
+            setattr(self, name, ctypes.CFUNCTYPE(ctypes.c_int, *fn.argtypes)(address))
+
+
+@bench
+def buspirate(n=100000, ops=16, calls=200):
+    # Python cost per call of the buspirate.py wrappers, with a library
+    # that does nothing, then reads of a TCS34725 register on the Bus
+    # Pirate emulator one call each or in a transaction().
+    try:
+        import buspirate as bp
+    except OSError as e:
+        return skipped(e)
+    import buspirate_emu
+    ret = collections.OrderedDict()
+    data = [0xa0, 3, 0, 0, 0, 0, 0, 0]
+    raw = bytes(data)
+    buf = bytearray(8)
+    array = bp.new_buffer(8)
+    null = bp.I2C.__new__(bp.I2C)
+    null.b = None
+
+    def per_call(fn, *args):
+        def loop():
+            for _ in range(n):
+                fn(*args)
+        return 1e6 * timed(loop)[0] / n
+
+    lib = bp.lib
+    bp.lib = NullLib(lib)
+    try:
+        ret['send_list_old_us'] = per_call(
+            lambda d: bp.lib.i2c_send(None, 0x29, list_send_args(d), len(d)), data)
+        ret['send_list_us'] = per_call(null.send, 0x29, data)
+        ret['send_bytes_us'] = per_call(null.send, 0x29, raw)
+        ret['send_bytearray_us'] = per_call(null.send, 0x29, buf)
+        ret['send_array_us'] = per_call(null.send, 0x29, array)
+        ret['recv_old_us'] = per_call(null.cmd_recv, 0x29, 0xb4, 8)
+        ret['recv_into_bytearray_us'] = per_call(null.cmd_recv_into, 0x29, 0xb4, buf)
+        ret['recv_into_array_us'] = per_call(null.cmd_recv_into, 0x29, 0xb4, array)
+    finally:
+        bp.lib = lib
+    sensor = buspirate_emu.TCS34725()
+    pirate = buspirate_emu.BusPirate([sensor])
+    dev = bp.I2C(pirate.port, bp.I2C_SPEED_400KHZ)
+    status = [(sensor.ADDR, b'\xb3', 1)] * ops
+    for name, fn in (
+            ('cmd_recv', lambda: [dev.cmd_recv(sensor.ADDR, 0xb3, 1) for _ in range(ops)]),
+            ('cmd_recv_into', lambda: [dev.cmd_recv_into(sensor.ADDR, 0xb3, buf, 1)
+                                       for _ in range(ops)]),
+            ('transaction', lambda: dev.transaction(status)),
+            ('transaction_depth_%d' % ops, lambda: dev.transaction(status, ops))):
+        pirate.reset_counters()
+        dt, _ = timed(lambda: [fn() for _ in range(calls // ops)])
+        reads = (calls // ops) * ops
+        ret[name + '_reads_per_s'] = reads / dt
+        ret[name + '_round_trips'] = pirate.bursts / reads
+    pirate.close()
+    return ret
+
+
+@bench
+def scheduler(n=5):
+    # A TSL2561, a TCS34725 and an AS7262 on one emulated Bus Pirate and
+    # an AS7262 AT module, all integrating about 100 ms: the sensors one
+    # after the other against Scheduler overlapping them.
+    try:
+        import as726x
+    except OSError as e:
+        return skipped(e)
+    import as726x_emu
+    import buspirate as bp
+    import buspirate_emu
+    import scheduler
+    import tcs34725
+    import tsl2561
+    ret = collections.OrderedDict()
+    pirate = buspirate_emu.BusPirate([buspirate_emu.TSL2561(),
+                                      buspirate_emu.TCS34725(),
+                                      buspirate_emu.AS726x()])
+    module = as726x_emu.ATModule()
+    i2c = bp.I2C(pirate.port, bp.I2C_SPEED_400KHZ)
+    sensors = collections.OrderedDict()
+    sensors['tcs34725'] = tcs34725.TCS34725(i2c=i2c)
+    sensors['tcs34725'].power_on()
+    sensors['tcs34725'].integration_ms(100)
+    sensors['tsl2561'] = tsl2561.TSL2561(i2c=i2c)
+    sensors['tsl2561'].set_mode(1, tsl2561.TSL2561.MODE_101MS)
+    sensors['as7262_i2c'] = as726x.AS726x_I2C(None, i2c)
+    sensors['as7262_i2c'].set_integration_ms(100)
+    sensors['as7262_serial'] = as726x.AS726x_SERIAL(module.port)
+    sensors['as7262_serial'].set_integration_ms(100)
+    alone = {name: scheduler.Scheduler({name: s}) for name, s in sensors.items()}
+    for name in sensors:
+        dt, _ = timed(lambda: [alone[name].sample() for _ in range(n)])
+        ret[name + '_ms'] = 1000.0 * dt / n
+
+    def sequential():
+        return {name: alone[name].sample()[name] for name in sensors}
+
+    dt, seq = timed(lambda: [sequential() for _ in range(n)])
+    ret['sequential_ms'] = 1000.0 * dt / n
+    sched = scheduler.Scheduler(sensors)
+    pirate.reset_counters()
+    dt, over = timed(lambda: list(sched.run(n)))
+    ret['overlapped_ms'] = 1000.0 * dt / n
+    ret['overlapped_round_trips'] = pirate.bursts / n
+    ret['overlapped_polls'] = sched.polls / n
+    ret['same'] = over[-1][1] == seq[-1]
+    module.close()
+    pirate.close()
+    return ret
+
+
+@bench
+def processor(n=100000, period_s=0.0137):
+    # Per sample cost of the work BLMThread does on every reading:
+    # calc_lux(), calc_max_lux() and next_step() of the step and of the
+    # predictive autorange.
+    ch0, ch1, mode, int_time, higain = random_samples(n)
+    states = [(c0, c1, blm_lux.integration_ms(m, t), h)
+              for c0, c1, m, t, h in zip(ch0, ch1, mode, int_time, higain)]
+    proc = Processor()
+
+    def calc_lux():
+        for c0, c1, ms, h in states:
+            proc.ch0, proc.ch1, proc.ms, proc.higain = c0, c1, ms, h
+            proc.calc_lux()
+
+    def calc_max_lux():
+        for i, (c0, _, _, _) in enumerate(states):
+            proc.calc_max_lux(c0 * 0.1, i * period_s)
+
+    def next_step():
+        for i, (c0, c1, ms, h) in enumerate(states):
+            proc.ch0, proc.ch1, proc.ms, proc.higain = c0, c1, ms, h
+            proc.next_step(i * period_s)
+
+    ret = collections.OrderedDict((('samples', n),))
+    ret['calc_lux_us_per_sample'] = 1e6 * timed(calc_lux)[0] / n
+    ret['calc_max_lux_us_per_sample'] = 1e6 * timed(calc_max_lux)[0] / n
+    for profile in ('all', 'predict'):
+        proc.profile = profile
+        ret['next_step_%s_us_per_sample' % profile] = 1e6 * timed(next_step)[0] / n
+    return ret
+
+
+class PacketBus:
+    # The fake bluetoothd of test_blm_bluez, with every main loop
+    # iteration delivering the next packet as a GATT notification.
+
+    def __init__(self, packets):
+        import test_blm_bluez
+        self.bus = test_blm_bluez.Bus()
+        self.packets = iter(packets)
+        self.bus.iteration = self.iteration
+
+    def iteration(self, block):
+        self.bus.notify(next(self.packets))
+        self.bus.events.popleft()()
+
+
+@bench
+def blm_read(n=200000):
+    # BLM.read() of blm_bluez on notifications, per packet: the signal
+    # handler, read_raw() and the decoding. The BLM is made by its
+    # constructor, connected through the fake D-Bus of test_blm_bluez.
+    import test_blm_bluez
+    packets = [bytes(p) for p in random_packets(n)]
+    fake = PacketBus(packets)
+    fd, cache = tempfile.mkstemp(suffix='.json')
+    os.close(fd)
+    try:
+        blm = test_blm_bluez.connect(fake.bus, cache)
+    finally:
+        os.unlink(cache)
+    t, states = timed(lambda: [blm.read() for _ in range(n)])
+    return collections.OrderedDict((
+        ('packets', n),
+        ('read_us_per_packet', 1e6 * t / n),
+        ('ok', blm.notify_ and [s[0].ch0 for s in states] ==
+         [blm_packet.decode(p).ch0 for p in packets])))
+
+
+class FakeSerial:
+    # pyserial as seen by AS726x_SERIAL: every line written queues its
+    # answer from answers, ERROR for the unknown ones.
+
+    def __init__(self, answers):
+        self.answers = answers
+        self.buf = bytearray()
+
+    def write(self, data):
+        for cmd in data.decode('ascii').splitlines():
+            self.buf += self.answers.get(cmd, 'ERROR\n').encode('ascii')
+        return len(data)
+
+    def read_until(self):
+        i = self.buf.find(b'\n') + 1
+        line = bytes(self.buf[:i])
+        del self.buf[:i]
+        return line
+
+
+@bench
+def chat(n=20000):
+    # AS726x_SERIAL.chat() and pipeline() on a fake serial port: the
+    # Python cost per call of formatting, matching and converting the
+    # answers, with the line and the module taking no time.
+    try:
+        import as726x
+    except OSError as e:
+        return skipped(e)
+    import as726x_emu
+    answers = {'AT': 'OK\n', 'ATVERHW': '403Dx OK\n', 'ATLEDC': '00x OK\n',
+               'ATTCSMD=2': 'OK\n', 'ATINTRVL=255': 'OK\n',
+               'ATBURST=1': 'OK\n1000, 2000, 3000, 4000, 5000, 6000\n',
+               'ATBURST=0': 'OK\n',
+               'ATCDATA': '100.00, 200.00, 300.00, 400.00, 500.00, 600.00 OK\n'}
+    for cmd, answer in as726x_emu.ATModule.DERIVED.items():
+        answers[cmd] = answer + ' OK\n'
+    port = as726x.serial.Serial
+    as726x.serial.Serial = lambda *args, **kwargs: FakeSerial(answers)
+    try:
+        dev = as726x.AS726x_SERIAL('fake')
+    finally:
+        as726x.serial.Serial = port
+    ret = collections.OrderedDict()
+    for name, fn in (('ok', lambda: dev.chat('AT', dev.OK)),
+                     ('version', lambda: dev.chat('ATVERHW', dev.VERSION)),
+                     ('read_at', lambda: dev.read_at('ATLEDC')),
+                     ('measure', dev.measure),
+                     ('all_values', dev.get_all_values),
+                     ('color', dev.get_color)):
+        t, _ = timed(lambda: [fn() for _ in range(n)])
+        ret[name + '_us'] = 1e6 * t / n
+    ret['ok'] = (dev.measure() == [1000, 2000, 3000, 4000, 5000, 6000] and
+                 dev.get_color()['lux'] == 100.25)
+    return ret
+
+
+# Direction of every numeric result, by its name: 1 when higher is
+# better, -1 when lower is, 0 for the arguments of the benchmark, the
+# properties of its input and what depends on how the OS schedules the
+# processes (drops, coalescing, resyncs, polls and the worst put); their
+# correctness is checked by the accounted, lossless, missed and repeats
+# results instead.
+FIXED = re.compile(r'^(samples|packets|simulated_s|window)$|'
+                   r'(sensor_per_s|_grid_cells|_flashes|_lost|_gaps|_received|'
+                   r'_dropped|_coalesced|_resyncs|_polls|_max_put_us)$')
+UP = re.compile(r'(_per_s|speedup|faster_than_realtime|_found|'
+                r'same_result)$')
+DOWN = re.compile(r'(^|_)(ns|us|ms|s)(_|$)|'
+                  r'(round_trips|commands|bytes|bytes_per_\w+|_per_integration|'
+                  r'_err_percent|_diff|_cpu_percent|_missed|_repeats)$')
+# Timings and what is computed from them change with the load of the
+# machine and are compared with --time-tolerance, but the times on the
+# clock of a simulation do not. A change smaller than the floor of the
+# unit of a timing is never a regression.
+TIMING = re.compile(r'(^|_)(ns|us|ms|s)(_|$)|'
+                    r'(_per_s|speedup|faster_than_realtime|_cpu_percent)$')
+SIMULATED = re.compile(r'(_settle_s|^flash_\w+_latency_ms)$')
+UNIT = re.compile(r'(^|_)(ns|us|ms|s|percent)(_|$)')
+FLOORS = {'ns': 10.0, 'us': 0.1, 'ms': 0.5, 's': 0.005, 'percent': 1.0}
+
+
+def direction(key):
+    """1, -1 or 0 as above, None for a result with no direction yet."""
+    if FIXED.search(key):
+        return 0
+    if UP.search(key):
+        return 1
+    if DOWN.search(key):
+        return -1
+    return None
+
+
+def timing(key):
+    return bool(TIMING.search(key)) and not SIMULATED.search(key)
+
+
+def floor(key):
+    unit = UNIT.search(key)
+    if not timing(key) or not unit or key.endswith('_per_s'):
+        return 0.0
+    return FLOORS[unit.group(2)]
+
+
+def plain(v):
+    # numpy scalars as Python ones, for json.
+    return v.item() if hasattr(v, 'item') else v
+
+
+def best(a, b):
+    """Best of two runs of a benchmark, result by result."""
+    if a is None:
+        return b
+    ret = collections.OrderedDict()
+    for k, v in b.items():
+        old = a.get(k, v)
+        d = direction(k)
+        if isinstance(v, bool) or not isinstance(v, (int, float)) or not d:
+            ret[k] = v
+        else:
+            ret[k] = max(old, v) if d > 0 else min(old, v)
+    return ret
+
+
+def compare(key, new, old, tolerance, time_tolerance, slowdown=1.0):
+    """Change of new against old and whether it is a regression. Timings
+    are allowed to be slowdown times slower."""
+    if isinstance(new, bool) or isinstance(old, bool):
+        return '', bool(old) and not new
+    if not isinstance(new, (int, float)) or not isinstance(old, (int, float)):
+        return '', False
+    d = direction(key)
+    if not d or old == new:
+        return '', False
+    allowed = old
+    if timing(key):
+        tolerance = time_tolerance
+        allowed = old * slowdown if d < 0 else old / slowdown
+    worse = d * (new - allowed) < -(tolerance * abs(allowed) + floor(key))
+    if not old or math.isinf(old) or math.isinf(new):
+        return ' (was %s)' % old, worse
+    return ' (%+.1f%%)' % (100.0 * (new - old) / abs(old)), worse
+
+
+def median(values):
+    values = sorted(values)
+    half = len(values) // 2
+    if len(values) % 2:
+        return values[half]
+    return (values[half - 1] + values[half]) / 2.0
+
+
+def merge(runs):
+    """Median of every result over runs of the suite, checks must pass
+    in all of them."""
+    ret = collections.OrderedDict()
+    for name, result in runs[-1].items():
+        ret[name] = collections.OrderedDict()
+        for k, v in result.items():
+            values = [r[name][k] for r in runs if k in r.get(name, {})]
+            if isinstance(v, bool):
+                v = all(values)
+            elif isinstance(v, (int, float)) and direction(k):
+                v = median(values)
+            ret[name][k] = v
+    return ret
+
+
+def show(v):
+    return ('%.3f' % v) if isinstance(v, float) else v
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Runs client benchmarks.')
+    parser.add_argument('names', nargs='*', help='Benchmarks to run, all if empty.')
+    parser.add_argument('--save', type=str, help='Save the results to this JSON file.')
+    parser.add_argument('--compare', type=str, help='Compare with the results in this JSON file.')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Relative change that is a regression.')
+    parser.add_argument('--time-tolerance', type=float, default=0.5,
+                        help='Relative change of a timing that is a regression.')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='Runs of each benchmark, the best result is kept.')
+    parser.add_argument('--runs', type=int, default=1,
+                        help='Runs of all the benchmarks, the median result is kept.')
+    args = parser.parse_args()
+    baseline = {}
+    old_calibration = {}
+    if args.compare:
+        with open(args.compare) as f:
+            saved = json.load(f)
+        baseline = saved['benches']
+        old_calibration = saved.get('calibration_ns', {})
+    regressions = []
+    not_run = []
+
+    def report(name, result, calibration):
+        slowdown = 1.0
+        if name in old_calibration:
+            slowdown = max(calibration / old_calibration[name], 1.0)
+        if slowdown > 1.0:
+            print('%s (Python %.2fx slower than for the baseline)' % (name, slowdown))
+        else:
+            print(name)
+        if 'skipped' in result:
+            not_run.append(name)
+        for k, v in result.items():
+            if (isinstance(v, (int, float)) and not isinstance(v, bool) and
+                    direction(k) is None):
+                regressions.append('%s.%s (no direction)' % (name, k))
+        old = baseline.get(name, {})
+        for k, v in result.items():
+            change, worse = '', False
+            if k in old:
+                change, worse = compare(k, v, old[k], args.tolerance,
+                                        args.time_tolerance, slowdown)
+            if worse:
+                regressions.append('%s.%s' % (name, k))
+            print('  %s: %s%s%s' % (k, show(v), change, ' REGRESSION' if worse else ''))
+
+    runs = []
+    calibrations = []
+    for run in range(args.runs):
+        results = collections.OrderedDict()
+        calibration = collections.OrderedDict()
+        for name in args.names or BENCHES:
+            if args.runs > 1:
+                print('run %d/%d: %s' % (run + 1, args.runs, name))
+            result = None
+            # The speed of the machine while the benchmark runs, to
+            # tell a slower machine from a slower benchmark.
+            calibration[name] = float('inf')
+            for _ in range(args.repeat):
+                calibration[name] = min(calibration[name], calibrate())
+                result = best(result, collections.OrderedDict(
+                    (k, plain(v)) for k, v in BENCHES[name]().items()))
+            results[name] = result
+            if args.runs == 1:
+                report(name, result, calibration[name])
+        runs.append(results)
+        calibrations.append(calibration)
+    results = runs[0]
+    calibration = calibrations[0]
+    if args.runs > 1:
+        results = merge(runs)
+        calibration = collections.OrderedDict(
+            (name, median([c[name] for c in calibrations])) for name in results)
+        for name, result in results.items():
+            report(name, result, calibration[name])
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'python': sys.version.split()[0], 'calibration_ns': calibration,
+                       'benches': results}, f, indent=1)
+    if not_run:
+        print('Skipped: %s' % ', '.join(not_run))
+    if regressions:
+        print('Regressions: %s' % ', '.join(regressions))
+        sys.exit(1)
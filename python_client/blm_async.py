@@ -0,0 +1,257 @@
+#!/usr/bin/python3
+
+# Single process acquisition from many BlueLightMeters with asyncio.
+#
+# Core runs one task per meter. Each meter has its own Processor (lux,
+# window statistics and autorange) and all the results go to a single
+# queue, so stream() is the merged, timestamped stream of all of them.
+# Devices are the asynchronous version of the BLMThread ones: read_raw()
+# and write(conf) are coroutines, clock() and close() are not.
+# BlueZMeter uses dbus-next and shares one system bus connection among
+# all the meters, SimMeter wraps blm_sim.Simulator.
+
+import argparse
+import asyncio
+import time
+
+import blm_lux
+import blm_packet
+import blm_sim
+from blm_thread import Processor
+
+BLUEZ = 'org.bluez'
+GATT_CHAR = 'org.bluez.GattCharacteristic1'
+# RFduino characteristics: read/notify and write.
+READ_UUID = '00002221-0000-1000-8000-00805f9b34fb'
+WRITE_UUID = '00002222-0000-1000-8000-00805f9b34fb'
+
+
+class SimMeter:
+
+    def __init__(self, sim, realtime=True):
+        self.sim = sim
+        self.realtime = realtime
+        self.sim.realtime = False
+
+    async def read_raw(self):
+        raw = self.sim.read_raw()
+        if self.realtime:
+            delay = self.sim.clock() - time.time()
+            await asyncio.sleep(max(delay, 0.0))
+        else:
+            await asyncio.sleep(0)
+        return raw
+
+    def clock(self):
+        return self.sim.clock()
+
+    async def write(self, conf):
+        self.sim.write(conf)
+
+    def close(self):
+        self.sim.close()
+
+
+class BlueZMeter:
+    """A BlueLightMeter connected through BlueZ, receiving notifications."""
+
+    def __init__(self, bus, path):
+        self.bus = bus
+        self.path = path
+        self.packets = asyncio.Queue()
+        self.start = time.time()
+        self.first_reading_s = None
+
+    async def interface(self, path, name):
+        introspection = await self.bus.introspect(BLUEZ, path)
+        obj = self.bus.get_proxy_object(BLUEZ, path, introspection)
+        return obj.get_interface(name)
+
+    async def connect(self, timeout=10.0):
+        dev = await self.interface(self.path, 'org.bluez.Device1')
+        self.dev = dev
+        dev_props = await self.interface(self.path, 'org.freedesktop.DBus.Properties')
+        resolved = asyncio.Event()
+
+        def changed(interface, values, invalidated):
+            if (interface == 'org.bluez.Device1' and
+                    'ServicesResolved' in values and values['ServicesResolved'].value):
+                resolved.set()
+
+        dev_props.on_properties_changed(changed)
+        await dev.call_connect()
+        try:
+            if not await dev.get_services_resolved():
+                await asyncio.wait_for(resolved.wait(), timeout)
+        except asyncio.TimeoutError:
+            raise IOError('%s: services not resolved' % self.path)
+        finally:
+            dev_props.off_properties_changed(changed)
+        manager = await self.interface('/', 'org.freedesktop.DBus.ObjectManager')
+        chars = {}
+        for path, interfaces in (await manager.call_get_managed_objects()).items():
+            char = interfaces.get(GATT_CHAR)
+            if char is not None and path.startswith(self.path + '/'):
+                chars[char['UUID'].value.lower()] = path
+        if READ_UUID not in chars or WRITE_UUID not in chars:
+            raise IOError('%s: characteristics not found' % self.path)
+        self.gatt_read = await self.interface(chars[READ_UUID], GATT_CHAR)
+        self.gatt_write = await self.interface(chars[WRITE_UUID], GATT_CHAR)
+        props = await self.interface(chars[READ_UUID],
+                                     'org.freedesktop.DBus.Properties')
+        props.on_properties_changed(self.properties_changed)
+        await self.gatt_read.call_start_notify()
+        return self
+
+    def properties_changed(self, interface, changed, invalidated):
+        if interface == GATT_CHAR and 'Value' in changed:
+            self.packets.put_nowait(bytearray(changed['Value'].value))
+
+    async def read_raw(self):
+        raw = await self.packets.get()
+        if self.first_reading_s is None:
+            self.first_reading_s = time.time() - self.start
+            print('%s: first reading after %.2f s' % (self.path, self.first_reading_s))
+        return raw
+
+    def clock(self):
+        return time.time()
+
+    async def write(self, conf):
+        await self.gatt_write.call_write_value(
+            bytes(blm_packet.encode_config(conf)), {})
+
+    def close(self):
+        asyncio.ensure_future(self.dev.call_disconnect())
+
+
+async def system_bus():
+    from dbus_next import BusType
+    from dbus_next.aio import MessageBus
+    return await MessageBus(bus_type=BusType.SYSTEM).connect()
+
+
+class Core:
+
+    def __init__(self, mean_time_s=Processor.MEAN_TIME_S, profile='all',
+                 maxsize=0):
+        self.mean_time_s = mean_time_s
+        self.profile = profile
+        self.meters = {}
+        # Name of the meter of each task still running.
+        self.tasks = {}
+        self.errors = {}
+        self.out = asyncio.Queue(maxsize)
+
+    def add(self, name, device):
+        proc = Processor(self.mean_time_s)
+        proc.profile = self.profile
+        self.meters[name] = (device, proc)
+        self.tasks[asyncio.ensure_future(self.run_meter(name))] = name
+
+    def set(self, name, cmd):
+        # Same as the 'set' command of BLMThread.
+        device, proc = self.meters[name]
+        proc.profile = cmd.get('profile', 'manual')
+        if proc.profile == 'manual':
+            return asyncio.ensure_future(device.write(cmd))
+
+    async def run_meter(self, name):
+        device, proc = self.meters[name]
+        decoder = blm_packet.Decoder()
+        try:
+            while True:
+                raw = await device.read_raw()
+                now = device.clock()
+                states = decoder.decode(raw)
+                if not states:
+                    continue
+                for i, state in enumerate(states):
+                    t = now - (len(states) - 1 - i) * blm_lux.integration_ms(
+                        state.mode, state.int_time) / 1000.0
+                    data = proc.process(state, t)
+                    data['meter'] = name
+                    await self.out.put(data)
+                next_state = proc.next_step(now)
+                if next_state:
+                    await device.write(next_state)
+        except EOFError:
+            pass
+        finally:
+            device.close()
+
+    async def stream(self):
+        """Yields the results of all the meters until they all stop."""
+        get = None
+        try:
+            while self.tasks or not self.out.empty():
+                if not self.out.empty():
+                    yield self.out.get_nowait()
+                    continue
+                get = asyncio.ensure_future(self.out.get())
+                done, _ = await asyncio.wait(set(self.tasks) | {get},
+                                             return_when=asyncio.FIRST_COMPLETED)
+                for task in done - {get}:
+                    self.finished(task)
+                if get.done():
+                    yield get.result()
+                else:
+                    get.cancel()
+                get = None
+        finally:
+            if get is not None:
+                get.cancel()
+            self.stop()
+        if self.errors:
+            raise next(iter(self.errors.values()))
+
+    def finished(self, task):
+        name = self.tasks.pop(task)
+        if not task.cancelled() and task.exception() is not None:
+            self.errors[name] = task.exception()
+            print('%s: dropped: %r' % (name, task.exception()))
+
+    def stop(self):
+        for t in self.tasks:
+            t.cancel()
+
+
+async def main(args):
+    core = Core(args.mean_time, args.profile)
+    if args.mac_address:
+        bus = await system_bus()
+        hci_path = '/org/bluez/' + args.hci_interface
+        for mac in args.mac_address:
+            path = hci_path + '/dev_' + mac.replace(':', '_')
+            core.add(mac, await BlueZMeter(bus, path).connect(args.timeout))
+    for i, light in enumerate(args.simulate or []):
+        sim = blm_sim.Simulator(blm_sim.parse_light(light))
+        core.add('sim%d' % i, SimMeter(sim))
+    async for data in core.stream():
+        s = data['state']
+        print('%.3f %s lux: %.2f med: %.2f max: %.2f ch: %d,%d mode: %d %s' %
+              (data['time'], data['meter'], data['lux'], data['med_lux'],
+               data['max_lux'], s['ch0'], s['ch1'], s['mode'],
+               ('lo', 'hi')[s['higain']]))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Handles many BlueLightMeters.',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--mac_address', '-m', type=str, action='append',
+                        help='MAC address of a BlueLightMeter, can be repeated.')
+    parser.add_argument('--hci_interface', '-i', type=str, default='hci0',
+                        help='HCI interface to use.')
+    parser.add_argument('--timeout', '-t', type=float, default=10.0,
+                        help='Timeout for connect.')
+    parser.add_argument('--simulate', '-s', type=str, action='append',
+                        help='Add a simulated BlueLightMeter with this light script.')
+    parser.add_argument('--profile', type=str, default='all',
+                        help='Autorange profile: manual, all, fast, logain, predict or flash.')
+    parser.add_argument('--mean_time', '-w', type=float, default=3.0,
+                        help='Length in seconds of the window for mean and max.')
+    args = parser.parse_args()
+    try:
+        asyncio.run(main(args))
+    except KeyboardInterrupt:
+        pass
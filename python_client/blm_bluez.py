@@ -0,0 +1,306 @@
+# Copyright 2016 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Bluetooth LE access to the BlueLightMeter through bluetoothd.
+
+import collections
+import json
+import time
+
+import dbus
+import dbus.mainloop.glib
+try:
+    import gobject
+except ImportError:
+    from gi.repository import GLib as gobject
+
+import blm_packet
+
+
+class BLM:
+
+    BLUEZ_PATH = '/org/bluez'
+    BLUEZ = 'org.bluez'
+    # Wake up the main loop this often while waiting for notifications.
+    NOTIFY_TICK_MS = 500
+    # Fall back to a ReadValue if no notification arrives in this time.
+    NOTIFY_TIMEOUT_S = 2.0
+    # RFduino characteristics: read/notify and write.
+    READ_UUID = '00002221-0000-1000-8000-00805f9b34fb'
+    WRITE_UUID = '00002222-0000-1000-8000-00805f9b34fb'
+
+    def __init__(self, args):
+        self.args = args
+        self.start_ = time.time()
+        self.first_reading_s = None
+        self.decoder_ = blm_packet.Decoder()
+        hci_path = self.BLUEZ_PATH + '/' + self.args.hci_interface
+        # Needed for signals, must be set before the bus is created.
+        dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+        bus = dbus.SystemBus(self.BLUEZ)
+        hci = bus.get_object(self.BLUEZ, hci_path)
+        self.context_ = gobject.MainLoop().get_context()
+
+        if self.args.mac_address == None:
+            print('Scanning for BlueLightMeter')
+            path = self.find(bus, hci, hci_path)
+            if not path:
+                raise IOError('BlueLightMeter not found')
+            print('Found: %s' % path.split('/')[-1][4:].replace('_', ':'))
+        else:
+            print('Connecting to BlueLightMeter with MAC %s' % self.args.mac_address)
+            hci.StartDiscovery(dbus_interface='org.bluez.Adapter1')
+            path = hci_path +'/dev_' + self.args.mac_address.replace(':', '_')
+        self.path_ = path
+        self.blm_ = bus.get_object(self.BLUEZ, path)
+        self.blmp_ = dbus.Interface(self.blm_, 'org.freedesktop.DBus.Properties')
+        self.blmd_ = dbus.Interface(self.blm_, 'org.bluez.Device1')
+
+        try:
+            self.blmd_.Connect()
+            self.connected_ = self.wait_props(bus, {'Connected': True,
+                                                    'ServicesResolved': True})
+        finally:
+            if self.args.mac_address != None:
+                # Connected or given up, scanning is only a waste now.
+                self.stop_discovery(hci)
+        if not self.connected_:
+            print('Failed to connect')
+            self.blmd_.Disconnect()
+            raise IOError('Cannot connect to %s' % path)
+        print('Connected')
+
+        address = self.prop_get('Address')
+        chars = self.resolve_chars(bus, address)
+        if not chars:
+            self.blmd_.Disconnect()
+            raise IOError('BlueLightMeter characteristics not found')
+        gatt_read_path, gatt_write_path = chars
+
+        gatt_read = bus.get_object(self.BLUEZ, gatt_read_path)
+        self.gatt_read_ = dbus.Interface(gatt_read, 'org.bluez.GattCharacteristic1')
+
+        gatt_write = bus.get_object(self.BLUEZ, gatt_write_path)
+        self.gatt_write_ = dbus.Interface(gatt_write, 'org.bluez.GattCharacteristic1')
+
+        self.notify_ = False
+        if not self.args.poll:
+            self.start_notify(bus, gatt_read_path)
+        self.save_device(address, chars)
+
+    def stop_discovery(self, hci):
+        try:
+            hci.StopDiscovery(dbus_interface='org.bluez.Adapter1')
+        except dbus.exceptions.DBusException as e:
+            print('Cannot stop discovery: %s' % e)
+
+    def load_cache(self):
+        # {'addresses': {name: [address, ...]},
+        #  'characteristics': {address: [read path, write path]}}
+        try:
+            with open(self.args.cache) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def save_device(self, address, chars):
+        cache = self.load_cache()
+        known = cache.setdefault('addresses', {}).setdefault(self.args.name, [])
+        if address in known:
+            known.remove(address)
+        known.insert(0, address)
+        cache.setdefault('characteristics', {})[address] = list(chars)
+        try:
+            with open(self.args.cache, 'w') as f:
+                json.dump(cache, f)
+        except IOError as e:
+            print('Cannot save %s: %s' % (self.args.cache, e))
+
+    def wait_props(self, bus, wanted):
+        # Waits for the device properties to get the wanted values,
+        # properties missing in this version of BlueZ are not waited for.
+        props = {}
+
+        def changed(interface, values, invalidated):
+            for k in wanted:
+                if k in values:
+                    props[k] = values[k]
+
+        receiver = bus.add_signal_receiver(changed, signal_name='PropertiesChanged',
+                                           dbus_interface='org.freedesktop.DBus.Properties',
+                                           path=self.path_, arg0='org.bluez.Device1')
+        for k, v in wanted.items():
+            try:
+                props.setdefault(k, self.prop_get(k))
+            except dbus.exceptions.DBusException:
+                props[k] = v
+        tick = gobject.timeout_add(self.NOTIFY_TICK_MS, lambda: True)
+        start = time.time()
+        while (time.time() < start + self.args.timeout and
+               any(props[k] != v for k, v in wanted.items())):
+            self.context_.iteration(True)
+        gobject.source_remove(tick)
+        receiver.remove()
+        return all(props[k] == v for k, v in wanted.items())
+
+    def resolve_chars(self, bus, address):
+        # Returns the read and write characteristic paths, looked up by
+        # UUID as handle numbers depend on the BlueZ version.
+        cached = self.load_cache().get('characteristics', {}).get(address)
+        if cached:
+            try:
+                uuids = [bus.get_object(self.BLUEZ, p).Get(
+                    'org.bluez.GattCharacteristic1', 'UUID',
+                    dbus_interface='org.freedesktop.DBus.Properties')
+                         for p in cached]
+                if [str(u).lower() for u in uuids] == [self.READ_UUID, self.WRITE_UUID]:
+                    return cached
+            except dbus.exceptions.DBusException:
+                pass
+        found = {}
+
+        def check(path, interfaces):
+            char = interfaces.get('org.bluez.GattCharacteristic1')
+            if char is not None and path.startswith(self.path_ + '/'):
+                found[str(char['UUID']).lower()] = str(path)
+
+        receiver = bus.add_signal_receiver(check, signal_name='InterfacesAdded',
+                                           dbus_interface='org.freedesktop.DBus.ObjectManager')
+        manager = dbus.Interface(bus.get_object(self.BLUEZ, '/'),
+                                 'org.freedesktop.DBus.ObjectManager')
+        for path, interfaces in manager.GetManagedObjects().items():
+            check(path, interfaces)
+        # Without ServicesResolved they can still be coming.
+        tick = gobject.timeout_add(self.NOTIFY_TICK_MS, lambda: True)
+        start = time.time()
+        while (time.time() < start + self.args.timeout and
+               not (self.READ_UUID in found and self.WRITE_UUID in found)):
+            self.context_.iteration(True)
+        gobject.source_remove(tick)
+        receiver.remove()
+        if self.READ_UUID in found and self.WRITE_UUID in found:
+            return found[self.READ_UUID], found[self.WRITE_UUID]
+        return None
+
+    def is_blm(self, dev):
+        if dev.get('Name', dev.get('Alias')) == self.args.name:
+            return True
+        # Also look for the name in the advertised data.
+        name = bytearray(self.args.name.encode('utf-8'))
+        for data in ('ManufacturerData', 'ServiceData'):
+            for v in dev.get(data, {}).values():
+                if name in bytearray(v):
+                    return True
+        return False
+
+    def find(self, bus, hci, hci_path):
+        # The adapter already knows the devices seen recently, check them
+        # (cached addresses first) and then discover until one of them
+        # advertises the BlueLightMeter name.
+        found = []
+        addresses = self.load_cache().get('addresses', {})
+
+        def check(path, interfaces):
+            dev = interfaces.get('org.bluez.Device1')
+            if (not found and dev is not None and
+                    path.startswith(hci_path + '/') and self.is_blm(dev)):
+                found.append(path)
+
+        def changed(interface, props, invalidated, path=None):
+            check(path, {interface: props})
+
+        receivers = [
+            bus.add_signal_receiver(check, signal_name='InterfacesAdded',
+                                    dbus_interface='org.freedesktop.DBus.ObjectManager'),
+            bus.add_signal_receiver(changed, signal_name='PropertiesChanged',
+                                    dbus_interface='org.freedesktop.DBus.Properties',
+                                    arg0='org.bluez.Device1', path_keyword='path')]
+        manager = dbus.Interface(bus.get_object(self.BLUEZ, '/'),
+                                 'org.freedesktop.DBus.ObjectManager')
+        objects = manager.GetManagedObjects()
+        for address in addresses.get(self.args.name, []):
+            path = hci_path + '/dev_' + address.replace(':', '_')
+            if path in objects:
+                found.append(path)
+                break
+        for path, interfaces in objects.items():
+            check(path, interfaces)
+        if not found:
+            hci.StartDiscovery(dbus_interface='org.bluez.Adapter1')
+            tick = gobject.timeout_add(self.NOTIFY_TICK_MS, lambda: True)
+            start = time.time()
+            while time.time() < start + self.args.timeout and not found:
+                self.context_.iteration(True)
+            gobject.source_remove(tick)
+            self.stop_discovery(hci)
+        for r in receivers:
+            r.remove()
+        return found[0] if found else None
+
+    def start_notify(self, bus, gatt_read_path):
+        self.pending_ = collections.deque()
+        # byte_arrays: values as one string instead of a dbus.Byte each.
+        receiver = bus.add_signal_receiver(self.properties_changed,
+                                           signal_name='PropertiesChanged',
+                                           dbus_interface='org.freedesktop.DBus.Properties',
+                                           path=gatt_read_path, byte_arrays=True)
+        try:
+            self.gatt_read_.StartNotify()
+        except dbus.exceptions.DBusException as e:
+            print('Notifications not available, polling: %s' % e)
+            receiver.remove()
+            return
+        gobject.timeout_add(self.NOTIFY_TICK_MS, lambda: True)
+        self.notify_ = True
+
+    def properties_changed(self, interface, changed, invalidated):
+        if interface != 'org.bluez.GattCharacteristic1' or 'Value' not in changed:
+            return
+        self.pending_.append(bytearray(changed['Value']))
+
+    def prop_get(self, prop):
+        return self.blmp_.Get('org.bluez.Device1', prop)
+
+    def close(self):
+        if self.notify_:
+            try:
+                self.gatt_read_.StopNotify()
+            except dbus.exceptions.DBusException:
+                pass
+        self.blmd_.Disconnect()
+        print('Disconnected')
+
+    def read_raw(self):
+        raw = None
+        if self.notify_:
+            deadline = time.time() + self.NOTIFY_TIMEOUT_S
+            while not self.pending_ and time.time() < deadline:
+                self.context_.iteration(True)
+            if self.pending_:
+                raw = self.pending_.popleft()
+        if raw is None:
+            raw = bytearray(self.gatt_read_.ReadValue(byte_arrays=True))
+        if self.first_reading_s is None:
+            self.first_reading_s = time.time() - self.start_
+            print('First reading after %.2f s' % self.first_reading_s)
+        return raw
+
+    def read(self):
+        return self.decoder_.decode(self.read_raw())
+
+    def clock(self):
+        return time.time()
+
+    def write(self, conf):
+        self.gatt_write_.WriteValue(list(blm_packet.encode_config(conf)))
@@ -0,0 +1,106 @@
+# Headless acquisition, for unattended logging stations.
+#
+# Runs the BLMThread pipeline (lux, window statistics and autorange) in
+# this process, without GTK, and writes every reading to a stream:
+#
+#   ndjson: one JSON object per line, with time, lux, max_lux, med_lux,
+#           min_lux, var_lux and state (ch0, ch1, mode, higain,
+#           int_time, seq and lost), as published by BLMThread, and seq,
+#           the number of the reading.
+#   binary: frames made of a length byte followed by FRAME, little
+#           endian, with time to int_time in the same order and seq.
+#
+# With --serve the readings go to blm_server instead, for many clients.
+
+import errno
+import json
+import signal
+import socket
+import struct
+import sys
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from blm_thread import BLMThread
+
+FRAME = struct.Struct('<6dHHBBHI')
+
+
+def encode_ndjson(data):
+    # A Sample is a tuple, json would write it as a list.
+    data = dict(data, state=data['state'].asdict())
+    return (json.dumps(data, separators=(',', ':'), sort_keys=True) +
+            '\n').encode('utf-8')
+
+
+def encode_binary(data):
+    s = data['state']
+    return bytearray([FRAME.size]) + FRAME.pack(
+        data['time'], data['lux'], data['max_lux'], data['med_lux'],
+        data['min_lux'], data['var_lux'], s.ch0, s.ch1, s.mode, s.higain,
+        s.int_time, data['seq'] & 0xffffffff)
+
+
+ENCODERS = {
+    'ndjson': encode_ndjson,
+    'binary': encode_binary,
+}
+
+
+def open_output(spec):
+    if spec == '-':
+        return getattr(sys.stdout, 'buffer', sys.stdout)
+    if spec.startswith('unix:'):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(spec[len('unix:'):])
+        return sock.makefile('wb')
+    return open(spec, 'ab')
+
+
+class Writer:
+    """Stands for the BLMThread queue, writing each reading to out."""
+
+    def __init__(self, out, encode, cmds):
+        self.out = out
+        self.encode = encode
+        self.cmds = cmds
+        self.seq = 0
+
+    def put_nowait(self, data):
+        data = dict(data, seq=self.seq)
+        self.seq += 1
+        try:
+            self.out.write(self.encode(data))
+            self.out.flush()
+        except IOError as e:
+            if e.errno != errno.EPIPE:
+                raise
+            # Nobody is reading anymore.
+            self.cmds.put({'cmd': 'quit'})
+
+
+def run(args, device):
+    cmds = queue.Queue()
+    if args.serve:
+        import blm_server
+        out = blm_server.Server(args.serve, args.format, args.frame)
+        sink = out
+    else:
+        out = open_output(args.output)
+        sink = Writer(out, ENCODERS[args.format], cmds)
+    bt = BLMThread(cmds, sink, device, args.mean_time, args.record)
+    bt.profile = args.profile
+
+    def quit(signum, frame):
+        cmds.put({'cmd': 'quit'})
+
+    signal.signal(signal.SIGINT, quit)
+    signal.signal(signal.SIGTERM, quit)
+    bt.run()
+    try:
+        out.close()
+    except IOError:
+        pass
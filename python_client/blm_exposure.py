@@ -0,0 +1,155 @@
+# Exposure calculator: aperture, shutter time and ISO for an EV.
+#
+# Everything works in stops, where an exposure is right when
+# av + tv - iso == ev (ev at ISO 100, as blm_lux.ev() returns it):
+#
+#   av = log2(N ** 2) for f/N, tv = log2(1 / t) for t seconds,
+#   iso = log2(ISO / 100).
+#
+# Scale holds the nominal camera values of full, 1/2 and 1/3 stop
+# increments with their stops computed once, and finds the nearest one
+# with a single bisect. The solve_*() functions give the nearest setting
+# of one scale and the EV it really corresponds to, grid() and tv_grid()
+# do the same for all the combinations at once with NumPy.
+
+import bisect
+import math
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+STEPS = ('full', 'half', 'third')
+
+
+def parse(label):
+    """Value of a label like '5.6', '1/125' or '30'."""
+    if label.startswith('1/'):
+        return 1.0 / float(label[2:])
+    return float(label)
+
+
+def av_stop(n):
+    return 2.0 * math.log(n, 2)
+
+
+def tv_stop(t):
+    return -math.log(t, 2)
+
+
+def iso_stop(iso):
+    return math.log(iso / 100.0, 2)
+
+
+class Scale:
+    """Nominal values of a setting, in stop order."""
+
+    def __init__(self, labels, to_stop):
+        self.labels = tuple(labels)
+        self.values = tuple(parse(l) for l in self.labels)
+        self.stops = tuple(to_stop(v) for v in self.values)
+        # Boundaries between the stops of consecutive values.
+        self.bounds = [(a + b) / 2.0 for a, b in zip(self.stops, self.stops[1:])]
+        if np is not None:
+            self.stops_array = np.array(self.stops)
+            self.bounds_array = np.array(self.bounds)
+
+    def __len__(self):
+        return len(self.labels)
+
+    def nearest(self, stop):
+        """Index of the value nearest to stop, in stops."""
+        return bisect.bisect(self.bounds, stop)
+
+    def index(self, label):
+        return self.labels.index(label)
+
+
+AV = {
+    'full': Scale(('1', '1.4', '2', '2.8', '4', '5.6', '8', '11', '16', '22',
+                   '32'), av_stop),
+    'half': Scale(('1', '1.2', '1.4', '1.7', '2', '2.4', '2.8', '3.3', '4',
+                   '4.8', '5.6', '6.7', '8', '9.5', '11', '13', '16', '19',
+                   '22', '27', '32'), av_stop),
+    'third': Scale(('1', '1.1', '1.2', '1.4', '1.6', '1.8', '2', '2.2', '2.5',
+                    '2.8', '3.2', '3.5', '4', '4.5', '5', '5.6', '6.3', '7.1',
+                    '8', '9', '10', '11', '13', '14', '16', '18', '20', '22',
+                    '25', '29', '32'), av_stop),
+}
+
+TV = {
+    'full': Scale(('30', '15', '8', '4', '2', '1', '1/2', '1/4', '1/8',
+                   '1/15', '1/30', '1/60', '1/125', '1/250', '1/500',
+                   '1/1000', '1/2000', '1/4000', '1/8000'), tv_stop),
+    'half': Scale(('30', '20', '15', '10', '8', '6', '4', '3', '2', '1.5',
+                   '1', '0.7', '1/2', '1/3', '1/4', '1/6', '1/8', '1/10',
+                   '1/15', '1/20', '1/30', '1/45', '1/60', '1/90', '1/125',
+                   '1/180', '1/250', '1/350', '1/500', '1/750', '1/1000',
+                   '1/1500', '1/2000', '1/3000', '1/4000', '1/6000',
+                   '1/8000'), tv_stop),
+    'third': Scale(('30', '25', '20', '15', '13', '10', '8', '6', '5', '4',
+                    '3.2', '2.5', '2', '1.6', '1.3', '1', '0.8', '0.6', '0.5',
+                    '0.4', '0.3', '1/4', '1/5', '1/6', '1/8', '1/10', '1/13',
+                    '1/15', '1/20', '1/25', '1/30', '1/40', '1/50', '1/60',
+                    '1/80', '1/100', '1/125', '1/160', '1/200', '1/250',
+                    '1/320', '1/400', '1/500', '1/640', '1/800', '1/1000',
+                    '1/1250', '1/1600', '1/2000', '1/2500', '1/3200',
+                    '1/4000', '1/5000', '1/6400', '1/8000'), tv_stop),
+}
+
+ISO = {
+    'full': Scale(('100', '200', '400', '800', '1600', '3200', '6400'),
+                  iso_stop),
+    'half': Scale(('100', '140', '200', '280', '400', '560', '800', '1100',
+                   '1600', '2200', '3200', '4500', '6400'), iso_stop),
+    'third': Scale(('100', '125', '160', '200', '250', '320', '400', '500',
+                    '640', '800', '1000', '1250', '1600', '2000', '2500',
+                    '3200', '4000', '5000', '6400'), iso_stop),
+}
+
+
+def solve_tv(ev, av, iso, scale=TV['full']):
+    """Shutter time for ev with av and iso: (index in scale, its ev)."""
+    i = scale.nearest(ev + iso - av)
+    return i, av + scale.stops[i] - iso
+
+
+def solve_av(ev, tv, iso, scale=AV['full']):
+    """Aperture for ev with tv and iso: (index in scale, its ev)."""
+    i = scale.nearest(ev + iso - tv)
+    return i, scale.stops[i] + tv - iso
+
+
+def solve_iso(ev, av, tv, scale=ISO['full']):
+    """ISO for ev with av and tv: (index in scale, its ev)."""
+    i = scale.nearest(av + tv - ev)
+    return i, av + tv - scale.stops[i]
+
+
+def grid(ev, av=AV['full'], tv=TV['full'], iso=ISO['full']):
+    """Exposure error in stops of every aperture, time and ISO for ev.
+
+    The result has shape shape(ev) + (len(av), len(tv), len(iso)), 0 is
+    the right exposure, positive is underexposed.
+    """
+    if np is None:
+        raise ImportError('grid needs numpy')
+    ev = np.asarray(ev, dtype=np.float64)[..., None, None, None]
+    return (av.stops_array[:, None, None] + tv.stops_array[None, :, None] -
+            iso.stops_array[None, None, :]) - ev
+
+
+def tv_grid(ev, av=AV['full'], iso=ISO['full'], tv=TV['full']):
+    """solve_tv() for every aperture and ISO.
+
+    Returns the indexes in tv and their ev, both with shape
+    shape(ev) + (len(av), len(iso)).
+    """
+    if np is None:
+        raise ImportError('tv_grid needs numpy')
+    ev = np.asarray(ev, dtype=np.float64)[..., None, None]
+    av_stops = av.stops_array[:, None]
+    iso_stops = iso.stops_array[None, :]
+    i = np.searchsorted(tv.bounds_array, ev + iso_stops - av_stops, side='right')
+    return i, av_stops + tv.stops_array[i] - iso_stops
@@ -0,0 +1,105 @@
+# Flash capture.
+#
+# FlashCapture gets every sample, taken with the shortest integration
+# (13.7 ms), and keeps the last PRE samples in a ring: their mean is the
+# ambient light. A sample RISE times above the ambient starts a flash,
+# the first one back below ends it and the flash is returned right away,
+# at most one integration after its end:
+#
+#   time:        start of the first integration with the flash
+#   ambient_lux: mean lux before the flash
+#   peak_lux:    highest sample lux
+#   exposure:    flash exposure in lux s, the light above the ambient
+#                summed over the samples, which does not depend on how
+#                the flash falls across the integrations
+#   saturated:   some sample was saturated, exposure is a lower bound
+#   trace:       (time, lux) of the samples in the ring and of the flash
+#
+# Every sample costs a constant time and the memory is bounded by PRE
+# and MAX_S. Light that stays up longer than MAX_S is not a flash, it
+# becomes the new ambient. The ambient is a running sum of the ring,
+# added up again from the ring after PRE samples have left it.
+
+import collections
+
+import blm_lux
+
+
+class FlashCapture:
+
+    # Samples before the flash kept for the ambient and the trace.
+    PRE = 16
+    RISE = 1.5
+    # Lux above the ambient needed anyway, for dark rooms.
+    MIN_LUX = 5.0
+    MAX_S = 0.5
+
+    def __init__(self, pre=PRE, rise=RISE, min_lux=MIN_LUX, max_s=MAX_S):
+        self.rise = rise
+        self.min_lux = min_lux
+        self.max_s = max_s
+        self.ring = collections.deque(maxlen=pre)
+        self.sum = 0.0
+        self.evicted = 0
+        self.event = None
+        self.flashes = 0
+
+    def ambient(self):
+        return self.sum / len(self.ring) if self.ring else 0.0
+
+    def add(self, t, lux, ms, saturated=False):
+        """Adds a sample ending at t, returns the flash when it ends."""
+        ambient = self.ambient()
+        lit = (len(self.ring) == self.ring.maxlen and
+               lux > ambient * self.rise + self.min_lux)
+        if self.event is not None:
+            if lit:
+                self.event.append((t, lux, ms, saturated))
+                if t - self.event[0][0] > self.max_s:
+                    self.rebase()
+                return None
+            flash = self.result(ambient)
+            self.event = None
+            self.push(t, lux)
+            return flash
+        if lit:
+            self.event = [(t, lux, ms, saturated)]
+            return None
+        self.push(t, lux)
+        return None
+
+    def push(self, t, lux):
+        if len(self.ring) == self.ring.maxlen:
+            self.sum -= self.ring[0][1]
+            self.evicted += 1
+        self.ring.append((t, lux))
+        self.sum += lux
+        if self.evicted >= self.ring.maxlen:
+            self.sum = sum(v for _, v in self.ring)
+            self.evicted = 0
+
+    def rebase(self):
+        # Not a flash, the light changed: start again from its level.
+        event = self.event
+        self.event = None
+        self.ring.clear()
+        self.sum = 0.0
+        self.evicted = 0
+        for t, lux, _, _ in event[-self.ring.maxlen:]:
+            self.push(t, lux)
+
+    def result(self, ambient):
+        self.flashes += 1
+        first_t, _, first_ms, _ = self.event[0]
+        return {
+            'time': first_t - first_ms / 1000.0,
+            'ambient_lux': ambient,
+            'peak_lux': max(e[1] for e in self.event),
+            'exposure': sum((e[1] - ambient) * e[2] / 1000.0 for e in self.event),
+            'saturated': any(e[3] for e in self.event),
+            'trace': list(self.ring) + [(e[0], e[1]) for e in self.event]}
+
+
+def flash_ev(flash, shutter_s):
+    """EV (ISO 100) of the flash and the ambient light with shutter_s."""
+    return blm_lux.ev(flash['ambient_lux'] + flash['exposure'] / shutter_s)
@@ -0,0 +1,277 @@
+# Copyright 2016 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# GTK user interface.
+
+from multiprocessing import Queue
+import pygtk
+pygtk.require('2.0')
+import gtk
+import gobject
+
+import blm_exposure
+import blm_flash
+import blm_lux
+import blm_ring
+from blm_thread import BLMThread
+
+
+class GUI:
+
+    AVc = blm_exposure.AV['full']
+    TVc = blm_exposure.TV['full']
+    ISOc = blm_exposure.ISO['full']
+
+    def setter(self, widget, key, value):
+        if widget and not widget.get_active():
+            return
+        if key:
+            self.mode[key] = value
+        self.mode['int_time'] = int(self.int_time.get_text())
+        try:
+            self.cmds.put_nowait(self.mode)
+            self.need_to_set = False
+        except:
+            self.need_to_set = True
+
+    def destroy(self, widget, data=None):
+        gtk.main_quit()
+
+    def new_val(self, label, where):
+        hbox = gtk.VBox()
+        frame = gtk.Frame()
+        frame.add(hbox)
+        where.pack_start(frame)
+        hbox.pack_start(gtk.Label(label))
+        val = gtk.Label('<span size="38000">0.0</span>')
+        val.set_use_markup(gtk.TRUE)
+        hbox.pack_start(val)
+        return val
+
+    def new_choices(self, where, what, vals, act):
+        self.but_choices[what] = []
+        c = gtk.VBox()
+        where.pack_start(c)
+        first = None
+        for label, setto in vals:
+            but = gtk.RadioButton(first, label)
+            self.but_choices[what].append(but)
+            if not first:
+                first = but
+            if label == act:
+                but.set_active(True)
+            but.connect('toggled', self.setter, what, setto)
+            c.pack_start(but)
+
+    def process_lux(self, source, condition, ring):
+        if self.need_to_set:
+            self.setter(None, None, None)
+        samples = ring.get_all()
+        self.samples += len(samples)
+        for data in samples:
+            if 'flash' in data:
+                self.flash = data['flash']
+        # All the samples are received, only the last one is shown.
+        if samples:
+            data = samples[-1]
+            s = data['state']
+            self.debug.set_text('ch: %d,%d mode: %d %s int: %d samples: %d dropped: %d' %
+                                (s['ch0'], s['ch1'], s['mode'], ('lo', 'hi')[s['higain']],
+                                 s['int_time'], self.samples, ring.dropped()))
+            if self.first_data:
+                self.higain.set_active(s['higain'])
+                self.but_choices['mode'][s['mode']].set_active(True)
+                self.int_time.set_text('%d' % s['int_time'])
+                self.first_data = False
+            self.cur_lux.set_markup('<span size="38000">%.2f</span>' % data['med_lux'])
+            self.max_lux.set_markup('<span size="38000">%.2f</span>' % data['max_lux'])
+            self.ev = blm_lux.ev(data['med_lux'])
+            self.ev_max = blm_lux.ev(data['max_lux'])
+            if self.flash:
+                self.debug.set_text(self.debug.get_text() +
+                                    '\nflash: %.0f lux %.3f lux s' %
+                                    (self.flash['peak_lux'], self.flash['exposure']))
+            self.cur_ev.set_markup('<span size="38000">%.1f</span>' % self.ev)
+            self.max_ev.set_markup('<span size="38000">%.1f</span>' % self.ev_max)
+            self.calc_goal()
+        return True
+
+    def create_list(self, scale, name, where):
+        scrolled_window = gtk.ScrolledWindow()
+        scrolled_window.set_policy(gtk.POLICY_AUTOMATIC, gtk.POLICY_ALWAYS)
+        clist = gtk.CList(1, (name,))
+        scrolled_window.add(clist)
+        clist.set_selection_mode(gtk.SELECTION_BROWSE)
+        for i in scale.labels:
+            row = clist.append(i)
+            clist.set_text(row, 0, i)
+        clist.connect('select_row', self.exp_setter, name)
+        self.exp_setter(clist, 0, 0, None, name)
+        where.pack_start(scrolled_window)
+
+    def exp_setter(self, clist, row, column, event, name):
+        # The rows are the scale labels, in order.
+        setattr(self, name, row)
+
+    def toggle_obj(self, widget, obj, o):
+        if widget.get_active():
+            setattr(self, obj, o)
+
+    def create_obj(self, obj, o, where):
+        base = getattr(self, obj + '_base')
+        but = gtk.RadioButton(base, o)
+        if not base:
+            setattr(self, obj + '_base', but)
+        where.pack_start(but)
+        but.connect('toggled', lambda w: self.toggle_obj(w, obj, o))
+
+    def calc_goal(self):
+        if self.which == 'Flash' and self.flash:
+            # The last flash of the flash profile, with the ambient
+            # light of the selected exposure time.
+            ev = blm_flash.flash_ev(self.flash, self.TVc.values[self.Tv])
+        elif self.which == 'Flash':
+            ev = self.ev_max
+        else:
+            ev = self.ev
+        av = self.AVc.stops[self.Av]
+        tv = self.TVc.stops[self.Tv]
+        iso = self.ISOc.stops[self.ISO]
+        if self.what == 'Tv':
+            i, ev = blm_exposure.solve_tv(ev, av, iso, self.TVc)
+            goal = '%s s' % self.TVc.labels[i]
+        elif self.what == 'Av':
+            i, ev = blm_exposure.solve_av(ev, tv, iso, self.AVc)
+            goal = 'f/%s' % self.AVc.labels[i]
+        elif self.what == 'ISO':
+            i, ev = blm_exposure.solve_iso(ev, av, tv, self.ISOc)
+            goal = '%s ISO' % self.ISOc.labels[i]
+        self.goal.set_markup('<span size="38000">%s</span>' % goal)
+        self.goal_ev.set_text('Ev=%.1f' % ev)
+
+    def __init__(self, cmds, lux):
+        self.first_data = True
+        self.need_to_set = False
+        self.samples = 0
+        self.cmds = cmds
+        self.mode = {
+            'cmd' : 'set',
+            'profile' : 'manual',
+            'mode' : 2,
+            'higain' : False,
+            'int_time': 500}
+        self.ev = 1.0
+        self.ev_max = 1.0
+        self.flash = None
+
+        self.window = gtk.Window(gtk.WINDOW_TOPLEVEL)
+        self.window.connect('destroy', self.destroy)
+        self.window.set_title('BlueLightMeter')
+        self.window.set_geometry_hints(min_width=400, min_height=500)
+
+        vals = gtk.VBox()
+        self.window.add(vals)
+        cur = gtk.HBox()
+        vals.pack_start(cur)
+        self.cur_lux = self.new_val('Cur Lux:', cur)
+        self.cur_ev = self.new_val('EV:', cur)
+        max = gtk.HBox()
+        vals.pack_start(max)
+        self.max_lux = self.new_val('Max Lux:', max)
+        self.max_ev = self.new_val('EV:', max)
+        self.debug = gtk.Label('Debug Info')
+        vals.pack_start(self.debug)
+
+        ctrl = gtk.HBox()
+        frame = gtk.Frame()
+        frame.add(ctrl)
+        vals.pack_start(frame)
+        ctrl_left = gtk.VBox()
+        ctrl.pack_start(ctrl_left)
+        ctrl_right = gtk.VBox()
+        ctrl.pack_start(ctrl_right)
+
+        self.but_choices = {}
+        self.new_choices(ctrl_left, 'profile',
+                         (('Manual', 'manual'), ('All Values', 'all'),
+                          ('Fast Modes', 'fast'), ('Low gain', 'logain'),
+                          ('Predictive', 'predict'), ('Flash', 'flash')),
+                         'Manual')
+        self.higain = gtk.CheckButton('High Gain')
+        ctrl_left.pack_start(self.higain)
+        self.higain.connect('toggled', lambda w: self.setter(None, 'higain', w.get_active()))
+
+        self.new_choices(ctrl_right, 'mode',
+                         (('13.7 ms', 0), ('101 ms', 1), ('402 ms', 2), ('Custom:', 3)),
+                         '402 ms')
+        self.int_time = gtk.Entry()
+        self.int_time.set_width_chars(6)
+        ctrl_right.pack_start(self.int_time)
+        self.int_time.set_text('500')
+        self.int_time.connect('activate', lambda w: self.setter(None, None, None))
+
+        calc = gtk.VBox()
+        frame = gtk.Frame()
+        vals.pack_start(frame)
+        frame.add(calc)
+
+        calc_inputs = gtk.HBox()
+        calc.pack_start(calc_inputs, expand=True)
+        self.create_list(self.AVc, 'Av', calc_inputs)
+        self.create_list(self.TVc, 'Tv', calc_inputs)
+        self.create_list(self.ISOc, 'ISO', calc_inputs)
+
+        calc_outputs = gtk.HBox()
+        calc.pack_start(calc_outputs, expand=False)
+
+        which = gtk.VBox()
+        calc_outputs.pack_start(which)
+        which.pack_start(gtk.Label('Calculate:'))
+        self.which = 'Normal'
+        self.which_base = None
+        self.create_obj('which', 'Normal', which)
+        self.create_obj('which', 'Flash', which)
+
+        what = gtk.VBox()
+        calc_outputs.pack_start(what)
+        self.what = 'Tv'
+        self.what_base = None
+        self.create_obj('what', 'Tv', what)
+        self.create_obj('what', 'Av', what)
+        self.create_obj('what', 'ISO', what)
+
+        goals = gtk.VBox()
+        calc_outputs.pack_start(goals)
+        self.goal = gtk.Label('<span size="38000">???</span>')
+        self.goal.set_use_markup(gtk.TRUE)
+        goals.pack_start(self.goal)
+        self.goal_ev = gtk.Label('Ev=???')
+        goals.pack_start(self.goal_ev)
+
+        self.window.show_all()
+        gobject.io_add_watch(lux.fileno(), gobject.IO_IN, self.process_lux, lux)
+
+    def main(self):
+        gtk.main()
+
+
+def run(args, device):
+    lux = blm_ring.Ring(policy=args.overflow)
+    cmds = Queue(1)
+    bt = BLMThread(cmds, lux, device, args.mean_time, args.record)
+    bt.start()
+    hello = GUI(cmds, lux)
+    hello.main()
+    cmds.put({'cmd': 'quit'})
+    bt.join()
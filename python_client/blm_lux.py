@@ -0,0 +1,109 @@
+# TSL2561 lux and EV calculations.
+#
+# lux() and ev() work on a single sample and are what BLMThread and GUI
+# use. lux_batch() does the same on NumPy arrays, for reprocessing
+# recorded data. Both use the same coefficient table and the same
+# operation order: saturated and dark samples give identical results,
+# the others can differ in the last bit as NumPy has its own pow/log.
+
+import math
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+SATURATED = 0xffff
+# Integration time in ms of the built-in modes, T_MANUAL uses int_time.
+MODE_MS = (13.7, 101.0, 402.0)
+T_MANUAL = 3
+HIGAIN = 16.0
+# Lux per datasheet equations. Each row is (upper bound of ch1/ch0,
+# ch0 coefficient, ch1 coefficient). In the first row the ch1 term is
+# replaced by ch0 * ratio ** 1.4. Above the last bound lux is 0.
+SEGMENTS = (
+    (0.5, 0.0304, 0.062),
+    (0.61, 0.0224, 0.031),
+    (0.80, 0.0128, 0.0153),
+    (1.30, 0.00146, 0.00112))
+# EV returned when there is no light (or the sensor is saturated).
+NO_EV = -100
+
+
+def integration_ms(mode, int_time):
+    if mode < T_MANUAL:
+        return MODE_MS[mode]
+    return int_time
+
+
+def lux(ch0, ch1, ms, higain):
+    if ch0 == SATURATED or ch1 == SATURATED:
+        return -1.0
+    if ch0 == 0 or ch1 == 0:
+        return 0.0
+    ratio = float(ch1) / ch0
+    d0 = ch0 * (402.0 / ms)
+    d1 = ch1 * (402.0 / ms)
+    if not higain:
+        d0 *= HIGAIN
+        d1 *= HIGAIN
+    bound, k0, k1 = SEGMENTS[0]
+    if ratio < bound:
+        return k0 * d0 - k1 * d0 * math.pow(ratio, 1.4)
+    for bound, k0, k1 in SEGMENTS[1:]:
+        if ratio < bound:
+            return k0 * d0 - k1 * d1
+    return 0.0
+
+
+def ev(lux):
+    if lux <= 0.0:
+        return NO_EV
+    return math.log(float(lux) / 2.5, 2)
+
+
+def integration_ms_batch(mode, int_time):
+    if np is None:
+        raise ImportError('integration_ms_batch needs numpy')
+    mode = np.asarray(mode)
+    table = np.array(MODE_MS + (0.0,))
+    return np.where(mode < T_MANUAL,
+                    table[np.minimum(mode, T_MANUAL)],
+                    np.asarray(int_time, dtype=np.float64))
+
+
+def lux_batch(ch0, ch1, ms, higain):
+    """Vectorized lux().
+
+    Arguments are arrays (or scalars) that broadcast together. Returns
+    the (lux, ev, saturated) arrays, saturated being a boolean mask.
+    """
+    if np is None:
+        raise ImportError('lux_batch needs numpy')
+    ch0, ch1, ms, higain = np.broadcast_arrays(*np.atleast_1d(
+        np.asarray(ch0, dtype=np.float64), np.asarray(ch1, dtype=np.float64),
+        np.asarray(ms, dtype=np.float64), np.asarray(higain, dtype=bool)))
+    saturated = (ch0 == SATURATED) | (ch1 == SATURATED)
+    dark = (ch0 == 0) | (ch1 == 0)
+    bounds = np.array([row[0] for row in SEGMENTS])
+    k0 = np.array([row[1] for row in SEGMENTS] + [0.0])
+    k1 = np.array([row[2] for row in SEGMENTS] + [0.0])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = ch1 / ch0
+        d0 = ch0 * (402.0 / ms)
+        d1 = ch1 * (402.0 / ms)
+        gain = np.where(higain, 1.0, HIGAIN)
+        d0 *= gain
+        d1 *= gain
+        seg = np.searchsorted(bounds, ratio, side='right')
+        lux = k0[seg] * d0 - k1[seg] * d1
+        first = seg == 0
+        d0_first = d0[first]
+        lux[first] = (k0[0] * d0_first -
+                      k1[0] * d0_first * np.power(ratio[first], 1.4))
+        lux[dark] = 0.0
+        lux[saturated] = -1.0
+        ev = np.full(lux.shape, float(NO_EV))
+        lit = lux > 0.0
+        ev[lit] = np.log(lux[lit] / 2.5) / math.log(2)
+    return lux, ev, saturated
@@ -0,0 +1,188 @@
+# Packets exchanged with the BlueLightMeter, as laid out in
+# rfduino_server/packet_format.h.
+#
+# Version 0x11 (struct blm_update) carries one sample, its run byte
+# counts the packets. Version 0x12 (struct blm_batch) carries up to
+# BATCH_MAX samples taken back to back with the same configuration and
+# the 16 bits sequence number of the first one, so at 13.7 ms there are
+# less notifications than samples. Decoder handles both and counts the
+# samples lost in between.
+#
+# Samples are decoded with precompiled structs into Sample tuples,
+# decode_array() decodes a whole buffer of 0x11 packets into a NumPy
+# structured array.
+
+import collections
+import struct
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+VERSION = 0x11
+BATCH_VERSION = 0x12
+HIGAIN = 0x10
+MODE_MASK = 0x3
+# struct blm_update.
+UPDATE = struct.Struct('<BBHHBH')
+# struct blm_batch up to the samples, and struct blm_sample.
+BATCH = struct.Struct('<BBHBH')
+SAMPLE = struct.Struct('<HH')
+BATCH_HEADER = BATCH.size
+# Samples that fit in a 20 bytes RFduino notification.
+BATCH_MAX = 3
+
+if np is not None:
+    UPDATE_DTYPE = np.dtype([('ver', 'u1'), ('run', 'u1'), ('ch0', '<u2'),
+                             ('ch1', '<u2'), ('conf', 'u1'),
+                             ('int_time', '<u2')])
+    SAMPLE_DTYPE = np.dtype([('ch0', '<u2'), ('ch1', '<u2'), ('mode', 'u1'),
+                             ('higain', '?'), ('int_time', '<u2'),
+                             ('seq', '<u2')])
+
+
+class Sample(collections.namedtuple(
+        'Sample', 'version seq ch0 ch1 conf int_time lost')):
+    """A decoded sample, a named tuple laid out as struct blm_update.
+
+    decode() makes one from the unpacked packet without converting any
+    field, that is what makes it faster than a dict: mode and higain are
+    read from conf when asked for. It is built and read as (ch0, ch1,
+    mode, higain, int_time, seq, lost), fields can also be read as
+    sample['ch0'], like the dicts used before.
+    """
+
+    __slots__ = ()
+    FIELDS = ('ch0', 'ch1', 'mode', 'higain', 'int_time', 'seq', 'lost')
+
+    def __new__(cls, ch0, ch1, mode, higain, int_time, seq=0, lost=0,
+                version=VERSION):
+        return tuple.__new__(cls, (version, seq, ch0, ch1,
+                                   mode | (HIGAIN if higain else 0),
+                                   int_time, lost))
+
+    def __getnewargs__(self):
+        return (self.ch0, self.ch1, self.mode, self.higain, self.int_time,
+                self.seq, self.lost, self.version)
+
+    def __repr__(self):
+        return 'Sample(%s)' % ', '.join('%s=%r' % (key, getattr(self, key))
+                                       for key in self.FIELDS)
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return getattr(self, key)
+        return tuple.__getitem__(self, key)
+
+    @property
+    def mode(self):
+        return self.conf & MODE_MASK
+
+    @property
+    def higain(self):
+        return self.conf & HIGAIN != 0
+
+    def keys(self):
+        return self.FIELDS
+
+    def asdict(self):
+        return dict((key, getattr(self, key)) for key in self.FIELDS)
+
+
+# The defaults are local names, faster than globals and attributes.
+def decode(raw, unpack=UPDATE.unpack_from, new=tuple.__new__, Sample=Sample,
+           lost=(0,)):
+    if raw[0] == VERSION:
+        return new(Sample, unpack(raw) + lost)
+
+
+def decode_array(buf):
+    """Decodes 0x11 packets back to back in buf into a SAMPLE_DTYPE array.
+
+    Packets of other versions are left out, seq is the run byte.
+    """
+    if np is None:
+        raise ImportError('decode_array needs numpy')
+    raw = np.frombuffer(buf, dtype=UPDATE_DTYPE)
+    raw = raw[raw['ver'] == VERSION]
+    ret = np.empty(len(raw), dtype=SAMPLE_DTYPE)
+    ret['ch0'] = raw['ch0']
+    ret['ch1'] = raw['ch1']
+    ret['mode'] = raw['conf'] & MODE_MASK
+    ret['higain'] = (raw['conf'] & HIGAIN) != 0
+    ret['int_time'] = raw['int_time']
+    ret['seq'] = raw['run']
+    return ret
+
+
+def encode(ch0, ch1, conf, run=0):
+    return bytearray([VERSION, run & 0xff, ch0 & 0xff, ch0 >> 8,
+                      ch1 & 0xff, ch1 >> 8]) + conf
+
+
+def encode_config(conf):
+    mode = conf['mode']
+    if 'higain' in conf and conf['higain']:
+        mode += HIGAIN
+    int_time = conf.get('int_time', 0)
+    return bytearray([mode, int_time % 256, int_time // 256])
+
+
+def encode_batch(samples, conf, seq):
+    """A 0x12 packet with the (ch0, ch1) pairs in samples."""
+    raw = bytearray([BATCH_VERSION, len(samples), seq & 0xff,
+                     (seq >> 8) & 0xff]) + conf
+    for ch0, ch1 in samples:
+        raw += bytearray([ch0 & 0xff, ch0 >> 8, ch1 & 0xff, ch1 >> 8])
+    return raw
+
+
+def decode_batch(raw):
+    if raw[0] != BATCH_VERSION:
+        return []
+    _, count, seq, conf, int_time = BATCH.unpack_from(raw)
+    ret = []
+    for i in range(count):
+        ch0, ch1 = SAMPLE.unpack_from(raw, BATCH_HEADER + SAMPLE.size * i)
+        ret.append(tuple.__new__(Sample, (BATCH_VERSION, (seq + i) & 0xffff,
+                                          ch0, ch1, conf, int_time, 0)))
+    return ret
+
+
+class Decoder:
+    """Decodes packets of both versions into lists of samples.
+
+    Each sample gets its sequence number in seq and the number of
+    samples missing right before it in lost. Packets seen again, as
+    when polling faster than the integration time, give no samples.
+    """
+
+    def __init__(self):
+        self.next = None
+        self.lost = 0
+        self.gaps = 0
+
+    def decode(self, raw):
+        if raw[0] == VERSION:
+            states, bits = [decode(raw)], 8
+        elif raw[0] == BATCH_VERSION:
+            states, bits = decode_batch(raw), 16
+        else:
+            return []
+        mask = (1 << bits) - 1
+        ret = []
+        for state in states:
+            lost = 0
+            if self.next is not None:
+                lost = (state.seq - self.next) & mask
+                if lost > mask // 2:
+                    # Older than the last one.
+                    continue
+            if lost:
+                self.lost += lost
+                self.gaps += 1
+                state = state._replace(lost=lost)
+            self.next = (state.seq + 1) & mask
+            ret.append(state)
+        return ret
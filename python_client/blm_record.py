@@ -0,0 +1,260 @@
+# Recording and replay of raw packets (blm_update and blm_batch).
+#
+# A recording is a 16 bytes header followed by variable length records:
+#
+#   header: 'BLMR', format version, 3 padding bytes, start time (double)
+#   record: varint(zigzag(dt) << 1 | full) and then either
+#           full:  varint(packet length), packet bytes
+#           delta: varint(zigzag(d ch0)), varint(zigzag(d ch1))
+#
+# dt is the time since the previous record in microseconds. A delta
+# record repeats the previous 0x11 packet with the run byte incremented
+# and only ch0/ch1 changed, it is used when everything else is the same
+# as before, which is almost always. In format version 1 the run byte
+# was not incremented. 0x12 packets are always full. All integers are
+# little endian, varints use 7 bits per byte with the high bit set on
+# all but the last byte.
+
+import mmap
+import os
+import struct
+import sys
+import time
+
+MAGIC = b'BLMR'
+VERSION = 2
+HEADER = struct.Struct('<4sB3xd')
+# Layout of struct blm_update in rfduino_server/packet_format.h.
+PACKET_LEN = 9
+RUN = 1
+CH0 = 2
+CH1 = 4
+FLUSH_S = 1.0
+
+
+def zigzag(v):
+    return (v << 1) ^ (v >> 63)
+
+
+def unzigzag(v):
+    return (v >> 1) ^ -(v & 1)
+
+
+def put_varint(out, v):
+    while v > 0x7f:
+        out.append(0x80 | (v & 0x7f))
+        v >>= 7
+    out.append(v)
+
+
+def get_varint(data, pos):
+    v = 0
+    shift = 0
+    while True:
+        b = data[pos]
+        pos += 1
+        v |= (b & 0x7f) << shift
+        if b < 0x80:
+            return v, pos
+        shift += 7
+
+
+def channels(packet):
+    return (packet[CH0] + packet[CH0 + 1] * 256,
+            packet[CH1] + packet[CH1 + 1] * 256)
+
+
+def same_but_channels(a, b, run_step):
+    return (len(a) == len(b) and a[0] == b[0] and
+            a[RUN] == (b[RUN] + run_step) & 0xff and
+            a[CH1 + 2:] == b[CH1 + 2:])
+
+
+class MappedBytes(object):
+    """A mmap indexed as bytes under Python 2, where it gives strings."""
+
+    def __init__(self, mm):
+        self.mm = mm
+
+    def __len__(self):
+        return len(self.mm)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return self.mm[i]
+        return ord(self.mm[i])
+
+
+class Reader:
+    """Iterates over the (time, packet) pairs of a recording.
+
+    The file is memory mapped and read in place, packets are returned
+    as bytearrays. A truncated last record (e.g. after a crash) is
+    ignored, end is the offset just after the last complete record.
+    """
+
+    def __init__(self, path):
+        self.f = open(path, 'rb')
+        size = os.fstat(self.f.fileno()).st_size
+        if size < HEADER.size:
+            raise IOError('%s: not a BLM recording' % path)
+        self.mm = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.start = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC or not 1 <= version <= VERSION:
+            raise IOError('%s: not a BLM recording' % path)
+        self.run_step = 1 if version >= 2 else 0
+        if sys.version_info[0] < 3:
+            self.data = MappedBytes(self.mm)
+        else:
+            self.data = self.mm
+        self.end = HEADER.size
+
+    def close(self):
+        self.data = None
+        self.mm.close()
+        self.f.close()
+
+    def __iter__(self):
+        data = self.data
+        size = len(data)
+        pos = HEADER.size
+        t_us = 0
+        packet = None
+        ch0 = ch1 = 0
+        while pos < size:
+            try:
+                v, pos = get_varint(data, pos)
+                t_us += unzigzag(v >> 1)
+                if v & 1:
+                    n, pos = get_varint(data, pos)
+                    if pos + n > size:
+                        return
+                    packet = bytearray(data[pos:pos + n])
+                    pos += n
+                    if n == PACKET_LEN:
+                        ch0, ch1 = channels(packet)
+                else:
+                    d0, pos = get_varint(data, pos)
+                    d1, pos = get_varint(data, pos)
+                    ch0 += unzigzag(d0)
+                    ch1 += unzigzag(d1)
+                    packet = bytearray(packet)
+                    packet[RUN] = (packet[RUN] + self.run_step) & 0xff
+                    packet[CH0] = ch0 & 0xff
+                    packet[CH0 + 1] = ch0 >> 8
+                    packet[CH1] = ch1 & 0xff
+                    packet[CH1 + 1] = ch1 >> 8
+            except IndexError:
+                return
+            self.end = pos
+            yield self.start + t_us * 1e-6, packet
+
+
+class Recorder:
+    """Appends packets to a recording, creating it if needed.
+
+    Records are encoded in memory and written through a buffered file
+    flushed every FLUSH_S seconds, so append() costs a few microseconds.
+    """
+
+    def __init__(self, path):
+        self.t_us = 0
+        self.packet = None
+        self.ch0 = self.ch1 = 0
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            reader = Reader(path)
+            t = reader.start
+            for t, packet in reader:
+                self.packet = packet
+            end = reader.end
+            self.start = reader.start
+            self.run_step = reader.run_step
+            self.t_us = int(round((t - self.start) * 1e6))
+            reader.close()
+            if self.packet is not None and len(self.packet) == PACKET_LEN:
+                self.ch0, self.ch1 = channels(self.packet)
+            self.f = open(path, 'r+b')
+            # Drop a partially written record.
+            self.f.truncate(end)
+            self.f.seek(end)
+        else:
+            self.start = time.time()
+            self.run_step = 1
+            self.f = open(path, 'wb')
+            self.f.write(HEADER.pack(MAGIC, VERSION, self.start))
+        self.flushed = time.time()
+        self.buf = bytearray()
+
+    def append(self, t, packet):
+        packet = bytearray(packet)
+        t_us = int(round((t - self.start) * 1e6))
+        dt = zigzag(t_us - self.t_us) << 1
+        self.t_us = t_us
+        buf = self.buf
+        if (self.packet is not None and len(packet) == PACKET_LEN and
+                same_but_channels(packet, self.packet, self.run_step)):
+            ch0, ch1 = channels(packet)
+            put_varint(buf, dt)
+            put_varint(buf, zigzag(ch0 - self.ch0))
+            put_varint(buf, zigzag(ch1 - self.ch1))
+            self.ch0 = ch0
+            self.ch1 = ch1
+        else:
+            put_varint(buf, dt | 1)
+            put_varint(buf, len(packet))
+            buf.extend(packet)
+            if len(packet) == PACKET_LEN:
+                self.ch0, self.ch1 = channels(packet)
+        self.packet = packet
+        if t - self.flushed > FLUSH_S:
+            self.flush()
+            self.flushed = t
+
+    def flush(self):
+        self.f.write(self.buf)
+        self.f.flush()
+        del self.buf[:]
+
+    def close(self):
+        self.flush()
+        self.f.close()
+
+
+class Replay:
+    """Device replaying a recording, see BLM for the interface.
+
+    With realtime packets are returned at the pace they were recorded,
+    otherwise as fast as possible. clock() is the time of the last
+    packet, for the statistics and autorange of BLMThread. Writes are
+    ignored, the sensor configuration is the recorded one.
+    """
+
+    def __init__(self, path, realtime=True):
+        self.reader = Reader(path)
+        self.packets = iter(self.reader)
+        self.realtime = realtime
+        self.t = self.reader.start
+        self.offset = None
+
+    def read_raw(self):
+        try:
+            self.t, packet = next(self.packets)
+        except StopIteration:
+            raise EOFError('end of recording')
+        if self.realtime:
+            now = time.time()
+            if self.offset is None:
+                self.offset = now - self.t
+            delay = self.t + self.offset - now
+            if delay > 0:
+                time.sleep(delay)
+        return packet
+
+    def clock(self):
+        return self.t
+
+    def write(self, conf):
+        pass
+
+    def close(self):
+        self.reader.close()
@@ -0,0 +1,186 @@
+# Lossless sample channel between BLMThread and its consumer.
+#
+# Ring is a ring buffer of fixed size records in an anonymous shared
+# mapping, so it must be created before forking the BLMThread process.
+# The producer calls put_nowait() with the dicts BLMThread publishes, the
+# consumer get_all() that returns them in order. Every put writes a byte
+# to a pipe: the consumer can wait on fileno() (e.g. with a GTK IO watch)
+# and uses no CPU when there are no samples. With wakeup=False nothing is
+# written, for a consumer that reads the ring on a timer of its own: a
+# put is then only a copy to the shared mapping.
+#
+# Shared header: write index, read index, dropped and coalesced
+# counters. Indexes only grow, the slot is the index modulo capacity.
+# Every slot starts with a generation, bumped before and after every
+# write of the slot so it is odd while the producer is writing, and the
+# index of the record in it. The consumer takes a record only if the
+# generation is even and the same before and after reading it, so it
+# never returns a record that is being overwritten, even by a COALESCE
+# that writes the same index again.
+#
+# A record has the time, lux and statistics and the whole sample,
+# with its seq and lost: with dropped() the consumer can tell every
+# sample it missed, in the ring or before it. The flash of the flash
+# profile (blm_flash) is carried too, without its trace. get_all() adds
+# the index of the record, the number of puts before it.
+#
+# When the ring is full:
+#   DROP_OLDEST: the oldest samples are overwritten (the consumer counts
+#                them as dropped when it notices).
+#   DROP_NEWEST: the new sample is discarded and counted as dropped.
+#   COALESCE:    the new sample replaces the newest one in the ring and
+#                is counted as coalesced.
+
+import errno
+import fcntl
+import mmap
+import os
+import struct
+
+import blm_packet
+
+DROP_OLDEST = 'drop_oldest'
+DROP_NEWEST = 'drop_newest'
+COALESCE = 'coalesce'
+POLICIES = (DROP_OLDEST, DROP_NEWEST, COALESCE)
+
+HEADER = struct.Struct('=QQQQ')
+WRITE = 0
+READ = 8
+DROPPED = 16
+COALESCED = 24
+# Generation and index.
+GEN = struct.Struct('=QQ')
+# time, lux, max_lux, med_lux, min_lux, var_lux, ch0, ch1, mode, higain,
+# int_time, seq, lost, then has a flash and its time, ambient_lux,
+# peak_lux, exposure and saturated.
+RECORD = struct.Struct('=6dHHBBHHIB4dB')
+NO_FLASH = (0, 0.0, 0.0, 0.0, 0.0, 0)
+SLOT = GEN.size + RECORD.size
+U64 = struct.Struct('=Q')
+
+
+def set_nonblocking(fd):
+    fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+
+class Ring:
+
+    def __init__(self, capacity=1024, policy=DROP_OLDEST, wakeup=True):
+        if policy not in POLICIES:
+            raise ValueError('Unknown overflow policy %s' % policy)
+        self.capacity = capacity
+        self.policy = policy
+        self.wake = wakeup
+        self.mm = mmap.mmap(-1, HEADER.size + capacity * SLOT)
+        self.rfd, self.wfd = os.pipe()
+        set_nonblocking(self.rfd)
+        set_nonblocking(self.wfd)
+
+    def get(self, offset):
+        return U64.unpack_from(self.mm, offset)[0]
+
+    def set(self, offset, value):
+        U64.pack_into(self.mm, offset, value)
+
+    def fileno(self):
+        return self.rfd
+
+    def dropped(self):
+        return self.get(DROPPED)
+
+    def coalesced(self):
+        return self.get(COALESCED)
+
+    def pending(self):
+        return self.get(WRITE) - self.get(READ)
+
+    def write_slot(self, idx, data):
+        s = data['state']
+        f = data.get('flash')
+        if f:
+            flash = (1, f['time'], f['ambient_lux'], f['peak_lux'],
+                     f['exposure'], f['saturated'])
+        else:
+            flash = NO_FLASH
+        off = HEADER.size + (idx % self.capacity) * SLOT
+        gen = self.get(off) + 1
+        GEN.pack_into(self.mm, off, gen, idx)
+        RECORD.pack_into(self.mm, off + GEN.size, data['time'],
+                         data['lux'], data['max_lux'], data['med_lux'],
+                         data['min_lux'], data['var_lux'],
+                         s.ch0, s.ch1, s.mode, s.higain, s.int_time,
+                         s.seq, s.lost, *flash)
+        self.set(off, gen + 1)
+
+    def put_nowait(self, data):
+        write = self.get(WRITE)
+        if write - self.get(READ) >= self.capacity:
+            if self.policy == DROP_NEWEST:
+                self.set(DROPPED, self.get(DROPPED) + 1)
+                return
+            if self.policy == COALESCE:
+                self.write_slot(write - 1, data)
+                self.set(COALESCED, self.get(COALESCED) + 1)
+                self.wakeup()
+                return
+        self.write_slot(write, data)
+        self.set(WRITE, write + 1)
+        self.wakeup()
+
+    def wakeup(self):
+        if not self.wake:
+            return
+        try:
+            os.write(self.wfd, b'\0')
+        except OSError as e:
+            # A full pipe already wakes up the consumer.
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def read_slot(self, idx):
+        off = HEADER.size + (idx % self.capacity) * SLOT
+        while True:
+            gen, written = GEN.unpack_from(self.mm, off)
+            if gen & 1 or written != idx:
+                return None
+            v = RECORD.unpack_from(self.mm, off + GEN.size)
+            if self.get(off) == gen:
+                break
+        data = {'index': idx, 'time': v[0], 'lux': v[1], 'max_lux': v[2],
+                'med_lux': v[3], 'min_lux': v[4], 'var_lux': v[5],
+                'state': blm_packet.Sample(v[6], v[7], v[8], bool(v[9]),
+                                           v[10], v[11], v[12])}
+        if v[13]:
+            data['flash'] = {'time': v[14], 'ambient_lux': v[15],
+                             'peak_lux': v[16], 'exposure': v[17],
+                             'saturated': bool(v[18])}
+        return data
+
+    def get_all(self):
+        """Returns all the samples in the ring, oldest first."""
+        try:
+            while os.read(self.rfd, 4096):
+                pass
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+        ret = []
+        read = self.get(READ)
+        while True:
+            write = self.get(WRITE)
+            if read == write:
+                break
+            if write - read > self.capacity:
+                self.set(DROPPED, self.get(DROPPED) + write - read - self.capacity)
+                read = write - self.capacity
+            data = self.read_slot(read)
+            if data is None:
+                # Overwritten while reading, the next loop counts it.
+                if self.get(WRITE) - read <= self.capacity:
+                    continue
+            else:
+                ret.append(data)
+                read += 1
+            self.set(READ, read)
+        return ret
@@ -0,0 +1,168 @@
+# Fan-out of the readings of one acquisition to many local clients.
+#
+# Server stands for the BLMThread queue, the fan-out runs in a process of
+# its own: put_nowait() only copies the reading to a blm_ring.Ring, so
+# the acquisition never waits for the clients nor for the GIL, and the
+# server process is not even woken up. It takes what is in the ring
+# every frame_s seconds and sends it as a batch. Each batch is encoded
+# once, in the blm_daemon formats, with the number of
+# the reading in seq, and queued to every client. A client whose queue
+# is above max_buffer bytes misses the batch instead of slowing down
+# the others: the gap in seq tells it, and the server counts it in
+# dropped. Readings the server process is too late for are overwritten
+# in the ring, a gap in seq for every client.
+#
+# Addresses are tcp:HOST:PORT or unix:PATH, the Unix socket is removed
+# by close(). Clients only receive, what they send is ignored.
+
+import errno
+import multiprocessing
+import os
+import select
+import signal
+import socket
+import time
+
+import blm_daemon
+import blm_ring
+
+
+def listen(spec):
+    if spec.startswith('unix:'):
+        path = spec[len('unix:'):]
+        if os.path.exists(path):
+            os.unlink(path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(path)
+    elif spec.startswith('tcp:'):
+        host, port = spec[len('tcp:'):].rsplit(':', 1)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((host, int(port)))
+    else:
+        raise ValueError('Unknown address %s, use tcp:HOST:PORT or unix:PATH' % spec)
+    sock.listen(128)
+    sock.setblocking(False)
+    return sock
+
+
+class Client:
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.out = bytearray()
+        self.dropped = 0
+
+
+class Server:
+
+    def __init__(self, spec, fmt='ndjson', frame_s=0.05, max_buffer=1 << 20,
+                 capacity=4096):
+        self.path = spec[len('unix:'):] if spec.startswith('unix:') else None
+        self.sock = listen(spec)
+        self.encode = blm_daemon.ENCODERS[fmt]
+        self.frame_s = frame_s
+        self.max_buffer = max_buffer
+        self.ring = blm_ring.Ring(capacity, wakeup=False)
+        # Readings dropped for slow clients, counted by the server process.
+        self.drops = multiprocessing.Value('L', 0)
+        self.rfd, self.wfd = os.pipe()
+        self.process = multiprocessing.Process(target=self.run)
+        self.process.daemon = True
+        self.process.start()
+
+    def put_nowait(self, data):
+        self.ring.put_nowait(data)
+
+    def close(self):
+        os.write(self.wfd, b'\0')
+        self.process.join()
+        self.sock.close()
+        if self.path is not None and os.path.exists(self.path):
+            os.unlink(self.path)
+        os.close(self.rfd)
+        os.close(self.wfd)
+
+    def dropped(self):
+        return self.drops.value
+
+    # The rest runs in the server process.
+
+    def accept(self):
+        while True:
+            try:
+                sock, _ = self.sock.accept()
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+            sock.setblocking(False)
+            self.clients[sock.fileno()] = Client(sock)
+            self.poll.register(sock, select.POLLIN)
+
+    def drop(self, c):
+        self.poll.unregister(c.sock)
+        del self.clients[c.sock.fileno()]
+        c.sock.close()
+
+    def send(self, c):
+        try:
+            n = c.sock.send(c.out)
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                n = 0
+            else:
+                self.drop(c)
+                return
+        del c.out[:n]
+        self.poll.modify(c.sock, select.POLLIN | (select.POLLOUT if c.out else 0))
+
+    def flush(self, batch):
+        frame = b''.join(self.encode(d) for d in batch)
+        for c in list(self.clients.values()):
+            if len(c.out) + len(frame) > self.max_buffer:
+                c.dropped += len(batch)
+                self.drops.value += len(batch)
+                continue
+            c.out += frame
+            self.send(c)
+
+    def run(self):
+        # Stopped by close(), not by the ^C meant for the acquisition.
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        self.clients = {}
+        self.poll = select.poll()
+        self.poll.register(self.sock, select.POLLIN)
+        self.poll.register(self.rfd, select.POLLIN)
+        due = time.time()
+        while True:
+            timeout = max(due - time.time(), 0.0) * 1000.0
+            for fd, event in self.poll.poll(timeout):
+                if fd == self.rfd:
+                    for c in list(self.clients.values()):
+                        c.sock.close()
+                    return
+                elif fd == self.sock.fileno():
+                    self.accept()
+                elif fd in self.clients:
+                    c = self.clients[fd]
+                    if event & select.POLLIN:
+                        try:
+                            if not c.sock.recv(4096):
+                                self.drop(c)
+                                continue
+                        except socket.error as e:
+                            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                                self.drop(c)
+                                continue
+                    if event & (select.POLLHUP | select.POLLERR):
+                        self.drop(c)
+                    elif event & select.POLLOUT:
+                        self.send(c)
+            if time.time() >= due:
+                due = max(due + self.frame_s, time.time())
+                batch = self.ring.get_all()
+                for data in batch:
+                    data['seq'] = data.pop('index')
+                if batch:
+                    self.flush(batch)
@@ -0,0 +1,273 @@
+# Simulated BlueLightMeter, for running the client without hardware.
+#
+# Simulator has the same read_raw()/read()/write()/clock()/close()
+# interface as BLM. It models the firmware loop and the TSL2561: each
+# read integrates the light of a script over the integration time of
+# the current configuration (13.7, 101, 402 ms or the custom time),
+# applies the gain and saturates the 16 bits counters at 0xffff. Time is
+# simulated, so unless realtime is set it runs as fast as possible.
+# With batch above 1 it sends 0x12 packets of up to batch samples, as a
+# firmware batching the samples would.
+
+import math
+import random
+import time
+
+import blm_lux
+import blm_packet
+
+
+class Light:
+    """A light level script, lux(t) with t in seconds from the start."""
+
+    # Samples used by the default mean().
+    STEPS = 16
+
+    def lux(self, t):
+        raise NotImplementedError
+
+    def mean(self, t0, t1):
+        dt = (t1 - t0) / self.STEPS
+        return sum(self.lux(t0 + (i + 0.5) * dt)
+                   for i in range(self.STEPS)) / self.STEPS
+
+
+class Constant(Light):
+
+    def __init__(self, lux):
+        self.level = lux
+
+    def lux(self, t):
+        return self.level
+
+    def mean(self, t0, t1):
+        return self.level
+
+
+class Step(Light):
+    """Light goes from before to after at time at."""
+
+    def __init__(self, before, after, at):
+        self.before = before
+        self.after = after
+        self.at = at
+
+    def lux(self, t):
+        return self.before if t < self.at else self.after
+
+    def mean(self, t0, t1):
+        if t1 <= self.at:
+            return self.before
+        if t0 >= self.at:
+            return self.after
+        return ((self.at - t0) * self.before +
+                (t1 - self.at) * self.after) / (t1 - t0)
+
+
+class Ramp(Light):
+    """Light goes from start to end over duration seconds, linear in EV."""
+
+    def __init__(self, start, end, duration, at=0.0):
+        self.start = start
+        self.end = end
+        self.duration = duration
+        self.at = at
+
+    def lux(self, t):
+        x = min(max((t - self.at) / self.duration, 0.0), 1.0)
+        return self.start * math.pow(float(self.end) / self.start, x)
+
+
+class Flash(Light):
+    """Rectangular pulses of peak lux over a base level.
+
+    The first starts at at and lasts duration seconds, if period is set
+    they repeat every period seconds.
+    """
+
+    def __init__(self, base, peak, at, duration=0.001, period=None):
+        self.base = base
+        self.peak = peak
+        self.at = at
+        self.duration = duration
+        self.period = period
+
+    def lit(self, t0, t1):
+        # Time in [t0, t1] with the flash on.
+        if t1 <= self.at:
+            return 0.0
+        if self.period:
+            n0 = max(int(math.floor((t0 - self.at) / self.period)), 0)
+            n1 = int(math.floor((t1 - self.at) / self.period))
+        else:
+            n0 = n1 = 0
+        on = 0.0
+        for n in range(n0, n1 + 1):
+            start = self.at + n * (self.period or 0.0)
+            on += max(min(t1, start + self.duration) - max(t0, start), 0.0)
+        return on
+
+    def lux(self, t):
+        return self.peak if self.lit(t, t + 1e-9) > 0 else self.base
+
+    def mean(self, t0, t1):
+        return self.base + (self.peak - self.base) * self.lit(t0, t1) / (t1 - t0)
+
+
+class Noise(Light):
+    """Adds gaussian noise with standard deviation rel * level."""
+
+    def __init__(self, light, rel=0.02, seed=None):
+        self.light = light
+        self.rel = rel
+        self.rnd = random.Random(seed)
+
+    def lux(self, t):
+        return max(self.light.lux(t) * (1.0 + self.rnd.gauss(0.0, self.rel)), 0.0)
+
+    def mean(self, t0, t1):
+        return max(self.light.mean(t0, t1) *
+                   (1.0 + self.rnd.gauss(0.0, self.rel)), 0.0)
+
+
+class Sequence(Light):
+    """Plays the lights one after the other, each for its duration."""
+
+    def __init__(self, *parts):
+        self.parts = parts
+
+    def find(self, t):
+        start = 0.0
+        for light, duration in self.parts[:-1]:
+            if t < start + duration:
+                return light, start
+            start += duration
+        return self.parts[-1][0], start
+
+    def lux(self, t):
+        light, start = self.find(t)
+        return light.lux(t - start)
+
+    def mean(self, t0, t1):
+        light, start = self.find(t0)
+        if self.find(t1)[1] != start:
+            return Light.mean(self, t0, t1)
+        return light.mean(t0 - start, t1 - start)
+
+
+LIGHTS = {
+    'constant': Constant,
+    'step': Step,
+    'ramp': Ramp,
+    'flash': Flash,
+}
+
+
+def parse_light(spec):
+    """Parses a light script like 'step:10,20000,5+noise:0.02'.
+
+    Arguments are the ones of the Light constructors, a trailing
+    +noise:rel adds noise.
+    """
+    light = None
+    for part in spec.split('+'):
+        name, _, values = part.partition(':')
+        values = [float(v) for v in values.split(',') if v]
+        if name == 'noise':
+            light = Noise(light, *values)
+        else:
+            light = LIGHTS[name](*values)
+    return light
+
+
+class Simulator:
+
+    def __init__(self, light, ratio=0.3, realtime=False, duration=None,
+                 start=None, batch=1):
+        self.light = light
+        self.ratio = ratio
+        self.realtime = realtime
+        self.duration = duration
+        self.start = time.time() if start is None else start
+        self.t = 0.0
+        self.run = 0
+        self.seq = 0
+        self.batch = batch
+        self.decoder = blm_packet.Decoder()
+        # Power on default of the firmware, T_402MS.
+        self.conf = blm_packet.encode_config({'mode': 2})
+        self.pending = None
+        # ch0 counts per lux at 402 ms and high gain.
+        self.per_lux = 1.0 / self.lux_per_count(ratio)
+
+    @staticmethod
+    def lux_per_count(ratio):
+        bound, k0, k1 = blm_lux.SEGMENTS[0]
+        if ratio < bound:
+            return k0 - k1 * math.pow(ratio, 1.4)
+        for bound, k0, k1 in blm_lux.SEGMENTS[1:]:
+            if ratio < bound:
+                return k0 - k1 * ratio
+        raise ValueError('no lux with ch1/ch0 = %f' % ratio)
+
+    def integration_s(self):
+        mode = self.conf[0] & blm_packet.MODE_MASK
+        int_time = self.conf[1] + self.conf[2] * 256
+        return blm_lux.integration_ms(mode, int_time) / 1000.0
+
+    def counts(self, lux, ms):
+        ch0 = lux * self.per_lux * ms / 402.0
+        if not self.conf[0] & blm_packet.HIGAIN:
+            ch0 /= blm_lux.HIGAIN
+        ch1 = ch0 * self.ratio
+        return min(int(round(ch0)), 0xffff), min(int(round(ch1)), 0xffff)
+
+    def integrate(self):
+        # One integration, None at the end of the simulation.
+        dt = self.integration_s()
+        if self.duration is not None and self.t + dt > self.duration:
+            return None
+        lux = self.light.mean(self.t, self.t + dt) if dt > 0 else 0.0
+        if self.realtime:
+            delay = self.start + self.t + dt - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        self.t += dt
+        return self.counts(lux, dt * 1000.0)
+
+    def read_raw(self):
+        samples = []
+        while len(samples) < self.batch:
+            if self.pending is not None:
+                if samples:
+                    # A batch has a single configuration.
+                    break
+                # New configurations are applied at the next integration.
+                self.conf = self.pending
+                self.pending = None
+            sample = self.integrate()
+            if sample is None:
+                break
+            samples.append(sample)
+        if not samples:
+            raise EOFError('end of simulation')
+        if self.batch > 1:
+            raw = blm_packet.encode_batch(samples, self.conf, self.seq)
+            self.seq += len(samples)
+        else:
+            raw = blm_packet.encode(samples[0][0], samples[0][1],
+                                    self.conf, self.run)
+        self.run += 1
+        return raw
+
+    def read(self):
+        return self.decoder.decode(self.read_raw())
+
+    def clock(self):
+        return self.start + self.t
+
+    def write(self, conf):
+        self.pending = blm_packet.encode_config(conf)
+
+    def close(self):
+        pass
@@ -0,0 +1,77 @@
+# Statistics over a sliding time window, O(1) amortized per sample.
+#
+# Max and min are kept with monotonic deques, mean and variance with
+# running sums. The sums are recomputed from the window once every
+# window length of evictions, so rounding errors cannot accumulate.
+
+import collections
+
+
+class WindowStats:
+
+    def __init__(self, length_s):
+        self.length_s = length_s
+        self.samples = collections.deque()
+        self.maxq = collections.deque()
+        self.minq = collections.deque()
+        self.sum = 0.0
+        self.sumsq = 0.0
+        self.evicted = 0
+
+    def __len__(self):
+        return len(self.samples)
+
+    def clear(self):
+        self.samples.clear()
+        self.maxq.clear()
+        self.minq.clear()
+        self.sum = 0.0
+        self.sumsq = 0.0
+        self.evicted = 0
+
+    def add(self, t, value):
+        self.samples.append((t, value))
+        self.sum += value
+        self.sumsq += value * value
+        maxq = self.maxq
+        while maxq and maxq[-1][1] < value:
+            maxq.pop()
+        maxq.append((t, value))
+        minq = self.minq
+        while minq and minq[-1][1] > value:
+            minq.pop()
+        minq.append((t, value))
+        self.expire(t - self.length_s)
+
+    def expire(self, oldest):
+        samples = self.samples
+        evicted = 0
+        while samples[0][0] < oldest:
+            t, value = samples.popleft()
+            self.sum -= value
+            self.sumsq -= value * value
+            evicted += 1
+        if not evicted:
+            return
+        while self.maxq[0][0] < oldest:
+            self.maxq.popleft()
+        while self.minq[0][0] < oldest:
+            self.minq.popleft()
+        self.evicted += evicted
+        if self.evicted >= len(samples):
+            self.sum = sum(v for _, v in samples)
+            self.sumsq = sum(v * v for _, v in samples)
+            self.evicted = 0
+
+    def max(self):
+        return self.maxq[0][1]
+
+    def min(self):
+        return self.minq[0][1]
+
+    def mean(self):
+        return self.sum / float(len(self.samples))
+
+    def variance(self):
+        mean = self.mean()
+        return max(self.sumsq / float(len(self.samples)) - mean * mean, 0.0)
@@ -0,0 +1,257 @@
+# Acquisition and sensor algorithms.
+#
+# Processor computes lux and statistics and drives the autorange of one
+# meter. BLMThread reads the sensor from a device, computes lux and statistics,
+# drives the autorange and publishes the results on a queue. A device is
+# created in the process by calling the device factory and must provide
+# read_raw(), clock(), write(conf) and close(), see BLM in blm_bluez.py,
+# blm_sim.Simulator and blm_record.Replay. Readings that do not fit in a
+# full queue are counted in dropped and reported when the thread ends.
+
+import math
+import sys
+import time
+from multiprocessing import Process
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import blm_flash
+import blm_lux
+import blm_packet
+import blm_record
+import blm_stats
+
+
+class Processor:
+
+  DEFAULT_MIN=100
+  DEFAULT_MAX=5000
+  PROFILES={
+      'all': {
+          'min': DEFAULT_MIN, 'max': DEFAULT_MAX,
+          'v': [[False, 0], [False, 1], [True, 0], [False, 2], [True, 1], [True, 2]]},
+      'fast': {
+          'min': DEFAULT_MIN, 'max': DEFAULT_MAX,
+          'v': [[False, 0], [True, 0], [True, 1], [True, 2]]},
+      'logain': {
+          'min': DEFAULT_MIN, 'max': DEFAULT_MAX,
+          'v': [[False, 0], [False, 1], [False, 2], [True, 2]]},
+      # Jumps to the setting predicted to give counts in range, see
+      # predict_step().
+      'predict': {
+          'min': DEFAULT_MIN, 'max': DEFAULT_MAX, 'predict': True,
+          'v': [[False, 0], [False, 1], [True, 0], [False, 2], [True, 1], [True, 2]]},
+      # 13.7 ms and low gain for flash capture, see blm_flash.
+      'flash': {
+          'min': DEFAULT_MIN, 'max': DEFAULT_MAX, 'flash': True,
+          'v': [[False, 0]]}}
+  MEAN_TIME_S = 3.0
+  # Custom integration times the predictive autorange can choose, in ms.
+  MANUAL_MIN_MS = 2
+  MANUAL_MAX_MS = 1000
+  # Full scale ADC counts per ms of integration of the TSL2561.
+  COUNTS_PER_MS = 368.1
+  # Sensitivity change tried when the counts are saturated or 0.
+  BLIND_STEP = 16.0
+
+  def __init__(self, mean_time_s=MEAN_TIME_S):
+    self.profile = 'manual'
+    self.pstep = 0
+    self.plast = 0.0
+    self.med = blm_stats.WindowStats(mean_time_s)
+    self.new_profile = True
+    self.prev_profile = 'none'
+    self.pwant = None
+    self.flash = None
+
+  def calc_lux(self):
+      return blm_lux.lux(self.ch0, self.ch1, self.ms, self.higain)
+
+  def calc_max_lux(self, lux, now=None):
+      if now is None:
+          now = time.time()
+      self.med.add(now, lux)
+      self.max_lux = self.med.max()
+      self.med_lux = self.med.mean()
+      self.min_lux = self.med.min()
+      self.var_lux = self.med.variance()
+
+  def next_step(self, now=None):
+      try:
+          cp = self.PROFILES[self.profile]
+      except:
+          self.new_profile = True
+          return None
+      if self.profile != self.prev_profile:
+          self.prev_profile = self.profile
+          self.new_profile = True
+          self.pwant = None
+          self.flash = None
+      if now is None:
+          now = time.time()
+      if cp.get('predict'):
+          self.new_profile = False
+          return self.predict_step(cp, now)
+      ch = self.new_profile
+      while self.pstep >= len(cp['v']):
+          self.pstep -= 1
+      if now > self.plast + 1.0:
+          if ((self.ch0 < cp['min'] or self.ch1 < cp['min'])
+              and self.pstep < (len(cp['v']) - 1)):
+              self.pstep += 1
+              ch = True
+          if ((self.ch0 > cp['max'] or self.ch1 > cp['max'])
+              and self.pstep > 0):
+              self.pstep -= 1
+              ch = True
+          self.plast = now
+      if ch:
+          self.new_profile = False
+          return {'higain': cp['v'][self.pstep][0],
+                  'mode': cp['v'][self.pstep][1]}
+      return None
+
+  def predict_step(self, cp, now):
+      # Counts are proportional to integration time and gain, so the
+      # counts of any setting follow from the current ones. The search
+      # is done on sensitivity, ms times the gain.
+      if self.pwant and self.pwant != (self.higain, self.ms) and now < self.plast + 1.0:
+          # Still reading with the previous setting.
+          return None
+      lo = min(self.ch0, self.ch1)
+      hi = max(self.ch0, self.ch1)
+      if cp['min'] <= lo and hi <= cp['max']:
+          return None
+      sens = self.ms * (blm_lux.HIGAIN if self.higain else 1.0)
+      if self.saturated():
+          low, high = 0.0, sens / self.BLIND_STEP
+          want = high
+      elif hi == 0:
+          low, high = sens * self.BLIND_STEP, float('inf')
+          want = low
+      else:
+          low = sens * cp['min'] / max(lo, 1)
+          high = sens * cp['max'] / hi
+          # As far as possible from both ends.
+          want = sens * math.sqrt(cp['min'] * cp['max'] / float(max(lo, 1) * hi))
+      candidates = []
+      for higain, mode in cp['v']:
+          gain = blm_lux.HIGAIN if higain else 1.0
+          candidates.append((blm_lux.MODE_MS[mode] * gain, higain, mode, 0))
+      if not any(low <= c[0] <= high for c in candidates):
+          for higain in (False, True):
+              gain = blm_lux.HIGAIN if higain else 1.0
+              ms = int(round(min(max(want / gain, self.MANUAL_MIN_MS),
+                                 self.MANUAL_MAX_MS)))
+              candidates.append((ms * gain, higain, blm_lux.T_MANUAL, ms))
+      best = min(candidates, key=lambda c: abs(math.log(c[0] / want)))
+      _, higain, mode, int_time = best
+      self.pwant = (higain, blm_lux.integration_ms(mode, int_time))
+      self.plast = now
+      if self.pwant == (self.higain, self.ms):
+          return None
+      return {'higain': higain, 'mode': mode, 'int_time': int_time}
+
+  def saturated(self):
+      return (max(self.ch0, self.ch1) >=
+              min(self.ms * self.COUNTS_PER_MS, blm_lux.SATURATED))
+
+  def capture_flash(self, lux, now):
+      if self.flash is None:
+          self.flash = blm_flash.FlashCapture()
+      if self.ms != blm_lux.MODE_MS[0]:
+          # The 13.7 ms configuration is not applied yet.
+          return None
+      saturated = self.saturated()
+      if saturated:
+          # At least the light of the highest counts.
+          lux = blm_lux.lux(min(self.ch0, blm_lux.SATURATED - 1),
+                            min(self.ch1, blm_lux.SATURATED - 1),
+                            self.ms, self.higain)
+      return self.flash.add(now, lux, self.ms, saturated)
+
+  def process(self, state, now):
+      self.ch0 = state.ch0
+      self.ch1 = state.ch1
+      self.ms = blm_lux.integration_ms(state.mode, state.int_time)
+      self.higain = state.higain
+      lux = self.calc_lux()
+      self.calc_max_lux(lux, now)
+      data = {'time': now,
+              'lux': lux,
+              'max_lux': self.max_lux,
+              'med_lux': self.med_lux,
+              'min_lux': self.min_lux,
+              'var_lux': self.var_lux,
+              'state': state}
+      if self.PROFILES.get(self.profile, {}).get('flash'):
+          flash = self.capture_flash(lux, now)
+          if flash:
+              data['flash'] = flash
+      return data
+
+
+class BLMThread(Processor, Process):
+
+  def __init__(self, cmds, lux, device, mean_time_s=Processor.MEAN_TIME_S,
+               record=None):
+    self.cmds = cmds
+    self.lux = lux
+    self.device = device
+    self.record = record
+    self.dropped = 0
+    Processor.__init__(self, mean_time_s)
+    Process.__init__(self)
+
+  def run(self):
+    blm = self.device()
+    decoder = blm_packet.Decoder()
+    recorder = None
+    if self.record:
+        recorder = blm_record.Recorder(self.record)
+    while True:
+
+        try:
+            raw = blm.read_raw()
+        except EOFError:
+            break
+        now = blm.clock()
+        if recorder:
+            recorder.append(now, raw)
+        states = decoder.decode(raw)
+        if not states:
+            continue
+        for i, state in enumerate(states):
+            # Batched samples were taken back to back, the last one ends now.
+            t = now - (len(states) - 1 - i) * blm_lux.integration_ms(
+                state.mode, state.int_time) / 1000.0
+            data = self.process(state, t)
+            try:
+                self.lux.put_nowait(data)
+            except queue.Full:
+                self.dropped += 1
+
+        next_state = self.next_step(now)
+        if next_state:
+            blm.write(next_state)
+
+        try:
+            cmd = self.cmds.get_nowait()
+        except queue.Empty:
+            cmd = None
+        if cmd:
+            if cmd['cmd'] == 'quit':
+                break
+            if cmd['cmd'] == 'set':
+                self.profile = cmd.get('profile', 'manual')
+                if self.profile == 'manual':
+                    blm.write(cmd)
+
+    if recorder:
+        recorder.close()
+    blm.close()
+    if self.dropped:
+        sys.stderr.write('%d readings dropped, the queue was full\n' % self.dropped)
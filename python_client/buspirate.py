@@ -1,6 +1,7 @@
 
 import ctypes
-from typing import List
+import struct
+from typing import List, Optional, Sequence, Tuple
 
 I2C_SPEED_400KHZ = 0x03
 I2C_SPEED_100KHZ = 0x02
@@ -17,14 +18,53 @@ I2C_PIN_READ = 0x03
 lib = ctypes.CDLL("../buspirate_client/libbuspirate.so")
 lib.i2c_new.argtypes = [ctypes.c_char_p, ctypes.c_int]
 lib.i2c_new.restype = ctypes.c_void_p
+# Buffers are c_void_p: bytes and ctypes arrays go through as they are.
 lib.i2c_cmd_recv.argtypes = [ctypes.c_void_p, ctypes.c_int, ctypes.c_ubyte,
-                             ctypes.POINTER(ctypes.c_ubyte), ctypes.c_int]
+                             ctypes.c_void_p, ctypes.c_int]
 lib.i2c_send.argtypes = [ctypes.c_void_p, ctypes.c_int,
-                         ctypes.POINTER(ctypes.c_ubyte), ctypes.c_int]
+                         ctypes.c_void_p, ctypes.c_int]
 lib.i2c_recv.argtypes = [ctypes.c_void_p, ctypes.c_int,
-                         ctypes.POINTER(ctypes.c_ubyte), ctypes.c_int]
+                         ctypes.c_void_p, ctypes.c_int]
+lib.i2c_error.argtypes = [ctypes.c_void_p]
+lib.i2c_transaction.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_int,
+                                ctypes.c_void_p, ctypes.c_int]
 lib.i2c_pin.argtypes = [ctypes.c_void_p, ctypes.c_int, ctypes.c_int]
 lib.i2c_fast.argtypes = [ctypes.c_void_p, ctypes.c_int]
+lib.i2c_vreg_read.argtypes = [ctypes.c_void_p, ctypes.c_int,
+                              ctypes.POINTER(ctypes.c_ubyte),
+                              ctypes.POINTER(ctypes.c_ubyte), ctypes.c_int]
+lib.i2c_vreg_write.argtypes = [ctypes.c_void_p, ctypes.c_int,
+                               ctypes.POINTER(ctypes.c_ubyte),
+                               ctypes.POINTER(ctypes.c_ubyte), ctypes.c_int]
+lib.i2c_vreg_wait.argtypes = [ctypes.c_void_p, ctypes.c_int, ctypes.c_ubyte,
+                              ctypes.c_ubyte, ctypes.c_int]
+
+
+def new_buffer(n: int):
+    """A buffer of n bytes the wrappers pass to the library as it is."""
+    return (ctypes.c_ubyte * n)()
+
+
+def buffer(data, writable: bool = False):
+    """(pointer, size) of a bytes-like object, without copying it.
+
+    bytes and ctypes arrays (new_buffer()) cost nothing, other objects
+    need a ctypes view of their memory made on every call.
+    """
+    if type(data) is bytes and not writable:
+        return data, len(data)
+    if isinstance(data, ctypes.Array):
+        return data, ctypes.sizeof(data)
+    n = len(data) if type(data) is bytearray else memoryview(data).nbytes
+    if not n:
+        return None, 0
+    try:
+        return ctypes.byref(ctypes.c_char.from_buffer(data)), n
+    except TypeError:
+        if writable:
+            raise
+        # Read-only, like a memoryview of bytes.
+        return bytes(data), n
 
 
 class I2C:
@@ -34,23 +74,100 @@ class I2C:
 
     def cmd_recv(self, addr: int, cmd: int, n: int):
         data = (ctypes.c_ubyte * n)()
-        lib.i2c_cmd_recv(self.b, addr, cmd, data, n)
+        err = lib.i2c_cmd_recv(self.b, addr, cmd, data, n)
+        if err:
+            raise IOError(err, "I2C read failed")
         return data[:]
 
-    def send(self, addr: int, data: List[int]):
-        n = len(data)
-        raw = (ctypes.c_ubyte * n)()
-        for i, v in enumerate(data):
-            raw[i] = data[i]
-        lib.i2c_send(self.b, addr, raw, n)
+    # data is a list of ints or any bytes-like object, used in place.
+    def send(self, addr: int, data):
+        if isinstance(data, list):
+            data = bytes(data)
+        raw, n = buffer(data)
+        err = lib.i2c_send(self.b, addr, raw, n)
+        if err:
+            raise IOError(err, "I2C write failed")
 
     def recv(self, addr: int, n: int):
         data = (ctypes.c_ubyte * n)()
-        lib.i2c_recv(self.b, addr, data, n)
+        err = lib.i2c_recv(self.b, addr, data, n)
+        if err:
+            raise IOError(err, "I2C read failed")
         return data[:]
 
+    # The _into versions read into a writable bytes-like buffer (all of
+    # it or its first n bytes), return the number of bytes and raise
+    # IOError on errors. A new_buffer() reused for every call is the
+    # cheapest.
+    def cmd_recv_into(self, addr: int, cmd: int, buf, n: int = None):
+        raw, size = buffer(buf, True)
+        n = size if n is None else min(n, size)
+        err = lib.i2c_cmd_recv(self.b, addr, cmd, raw, n)
+        if err:
+            raise IOError(err, "I2C read failed")
+        return n
+
+    def recv_into(self, addr: int, buf, n: int = None):
+        raw, size = buffer(buf, True)
+        n = size if n is None else min(n, size)
+        err = lib.i2c_recv(self.b, addr, raw, n)
+        if err:
+            raise IOError(err, "I2C read failed")
+        return n
+
+    # Runs the operations (addr, data to write or None, bytes to read)
+    # with one library call and returns the bytes read by each. depth
+    # operations are sent before waiting for the answers: 1 is the bus
+    # traffic of calling them one by one, more saves USB round trips if
+    # the Bus Pirate keeps up with them. Needs set_fast(1).
+    def transaction(self, ops: Sequence[Tuple[int, Optional[bytes], int]],
+                    depth: int = 1) -> List[bytes]:
+        parts = []
+        total = 0
+        for addr, data, n in ops:
+            data = data or b''
+            parts.append(struct.pack('>BHH', addr, len(data), n))
+            parts.append(bytes(data))
+            total += n
+        rx = bytearray(total)
+        ops_buf = b''.join(parts)
+        done = lib.i2c_transaction(self.b, ops_buf, len(ops_buf),
+                                   buffer(rx, True)[0], depth)
+        if done != len(ops):
+            raise IOError(lib.i2c_error(self.b),
+                          "I2C operation %d of %d failed" % (done, len(ops)))
+        ret = []
+        pos = 0
+        for _, _, n in ops:
+            ret.append(bytes(rx[pos:pos + n]))
+            pos += n
+        return ret
+
     def set_pin(self, aux: int, cs: int):
         lib.i2c_pin(self.b, aux, cs)
 
     def set_fast(self, fast: int):
         lib.i2c_fast(self.b, fast)
+
+    # AMS virtual registers (AS726x): each call is a single library call
+    # doing all the status polls, writes and reads. They need set_fast(1).
+    def vreg_read(self, addr: int, regs: List[int]):
+        n = len(regs)
+        data = (ctypes.c_ubyte * n)()
+        err = lib.i2c_vreg_read(self.b, addr, (ctypes.c_ubyte * n)(*regs),
+                                data, n)
+        if err:
+            raise IOError(err, "Virtual register read failed")
+        return data[:]
+
+    def vreg_write(self, addr: int, regs: List[int], vals: List[int]):
+        n = len(regs)
+        err = lib.i2c_vreg_write(self.b, addr, (ctypes.c_ubyte * n)(*regs),
+                                 (ctypes.c_ubyte * n)(*vals), n)
+        if err:
+            raise IOError(err, "Virtual register write failed")
+
+    def vreg_wait(self, addr: int, reg: int, mask: int, timeout_ms: int):
+        err = lib.i2c_vreg_wait(self.b, addr, reg, mask, timeout_ms)
+        if err:
+            raise IOError(err, "Virtual register wait failed")
@@ -0,0 +1,451 @@
+#!/usr/bin/python3
+
+# Bus Pirate emulator on a pty, to run buspirate.py and the sensor
+# drivers without hardware.
+#
+# It speaks the binary mode I2C protocol that libbuspirate uses: 0x00
+# (BBIO1), 0x02 (I2C1), 0x0f reset, the bit level commands (start,
+# stop, read byte, ack, nack, bulk write), pins (0x4x), speed (0x6x)
+# and 0x08 write then read. The I2C devices are objects with write(data)
+# and read(n), one per 7 bit address: register models of the TSL2561,
+# the TCS34725 and the AS7262/AS7263 virtual registers.
+#
+# Timing is the one of a real Bus Pirate behind USB: every burst of
+# bytes from the host costs latency_s, a USB round trip, every byte on
+# the serial line byte_s, 115200 baud by default, and every I2C byte 9
+# clocks at the speed chosen with 0x6x. The counters tell how many
+# bursts (round trips), 0x08 commands and I2C bytes the host needed.
+#
+# As a script it prints the pty to use and runs till interrupted:
+#   ./buspirate_emu.py --tsl2561 --as7262
+#   ../buspirate_client/tester tsl2651 /dev/pts/N 0x39 0 1
+
+import argparse
+import os
+import select
+import signal
+import struct
+import threading
+import time
+import tty
+
+BAUD_BYTE_S = 10.0 / 115200
+# I2C clock of the 0x6x speeds.
+I2C_HZ = (5000.0, 50000.0, 100000.0, 400000.0)
+
+
+class TSL2561:
+    """TSL2561 light sensor, channel counts from a constant light.
+
+    Powered up (CONTROL 3) it integrates all the time for 13.7, 101 or
+    402 ms, or while the MANUAL bit of TIMING is set. ch0 and ch1 are the
+    counts per ms at high gain (16x), clipped like the real ADC.
+    """
+
+    ADDR = 0x39
+    CONTROL = 0x00
+    TIMING = 0x01
+    ID = 0x0a
+    DATA0LOW = 0x0c
+    MS = (13.7, 101.0, 402.0)
+    FULL = (5047, 37177, 65535)
+
+    def __init__(self, ch0=40.0, ch1=20.0):
+        self.ch0 = ch0
+        self.ch1 = ch1
+        self.regs = bytearray(0x10)
+        self.regs[self.TIMING] = 0x02
+        self.regs[self.ID] = 0x50
+        self.pointer = 0
+        self.started = None
+        self.manual = None
+
+    def counts(self, ms, full=65535):
+        gain = 1.0 if self.regs[self.TIMING] & 0x10 else 1.0 / 16
+        for i, rate in enumerate((self.ch0, self.ch1)):
+            count = min(int(rate * gain * ms), full)
+            self.regs[self.DATA0LOW + 2 * i] = count & 0xff
+            self.regs[self.DATA0LOW + 2 * i + 1] = count >> 8
+
+    def update(self):
+        timing = self.regs[self.TIMING]
+        if self.started is None or timing & 0x03 == 3:
+            return
+        ms = self.MS[timing & 0x03]
+        if (time.monotonic() - self.started) * 1000.0 >= ms:
+            self.counts(ms, self.FULL[timing & 0x03])
+
+    def write(self, data):
+        cmd = data[0]
+        if not cmd & 0x80:
+            return
+        self.pointer = cmd & 0x0f
+        for v in data[1:]:
+            if self.pointer == self.CONTROL:
+                self.started = time.monotonic() if v & 3 == 3 else None
+            elif self.pointer == self.TIMING:
+                if v & 0x08 and not self.regs[self.TIMING] & 0x08:
+                    self.manual = time.monotonic()
+                elif not v & 0x08 and self.regs[self.TIMING] & 0x08:
+                    self.counts((time.monotonic() - self.manual) * 1000.0)
+                elif v & 0x03 != self.regs[self.TIMING] & 0x03:
+                    self.started = time.monotonic()
+            self.regs[self.pointer] = v
+            self.pointer = (self.pointer + 1) & 0x0f
+
+    def read(self, n):
+        self.update()
+        data = bytes(self.regs[(self.pointer + i) & 0x0f] for i in range(n))
+        self.pointer = (self.pointer + n) & 0x0f
+        return data
+
+
+class AS726x:
+    """AS7262 or AS7263 behind its virtual registers.
+
+    Writing WRITE_REG keeps TX_VALID up for busy_polls status reads, then
+    the register is written or its value is ready in READ_REG. A one-shot
+    reading (mode 3) sets DATA_RDY after the integration time.
+    """
+
+    ADDR = 0x49
+    AS7262 = 0x3E
+    AS7263 = 0x3F
+    STATUS_REG = 0x00
+    WRITE_REG = 0x01
+    READ_REG = 0x02
+    TX_VALID = 0x02
+    RX_VALID = 0x01
+    CONTROL_SETUP = 0x04
+    INT_T = 0x05
+    CALIBRATED = 0x14
+    GAINS = (1.0, 3.7, 16.0, 64.0)
+
+    def __init__(self, channels=(10.0, 20.0, 30.0, 40.0, 50.0, 60.0),
+                 busy_polls=1, version=AS7262):
+        self.channels = channels
+        self.busy_polls = busy_polls
+        self.vregs = bytearray(0x80)
+        self.vregs[0x00] = 0x40
+        self.vregs[0x01] = version
+        self.vregs[self.CONTROL_SETUP] = 2 << 2
+        self.vregs[self.INT_T] = 0xff
+        self.pointer = 0
+        self.busy = 0
+        self.pending = None
+        self.target = None
+        self.rx = None
+        self.ready_at = None
+        self.calibrate()
+
+    def calibrate(self):
+        gain = self.GAINS[(self.vregs[self.CONTROL_SETUP] >> 4) & 3]
+        scale = gain * self.vregs[self.INT_T] * 2.8 / 100.0
+        self.vregs[self.CALIBRATED:self.CALIBRATED + 24] = struct.pack(
+            '>6f', *(c * scale for c in self.channels))
+
+    def update(self):
+        if self.ready_at is not None and time.monotonic() >= self.ready_at:
+            self.ready_at = None
+            self.calibrate()
+            self.vregs[self.CONTROL_SETUP] |= 1 << 1
+
+    def execute(self):
+        v = self.pending
+        self.pending = None
+        if self.target is not None:
+            reg, self.target = self.target, None
+            if reg == self.CONTROL_SETUP:
+                if v & 0x80:
+                    v = 2 << 2
+                if (v >> 2) & 3 == 3 and not v & (1 << 1):
+                    self.ready_at = (time.monotonic() +
+                                     self.vregs[self.INT_T] * 0.0028)
+            self.vregs[reg] = v
+        elif v & 0x80:
+            self.target = v & 0x7f
+        else:
+            self.update()
+            self.rx = self.vregs[v]
+
+    def status(self):
+        if self.busy:
+            self.busy -= 1
+            if not self.busy:
+                self.execute()
+        return ((self.TX_VALID if self.busy else 0) |
+                (self.RX_VALID if self.rx is not None else 0))
+
+    def write(self, data):
+        self.pointer = data[0]
+        if self.pointer == self.WRITE_REG and len(data) > 1:
+            if self.busy:
+                return
+            self.pending = data[1]
+            self.busy = self.busy_polls
+            if not self.busy:
+                self.execute()
+
+    def read(self, n):
+        out = bytearray()
+        for _ in range(n):
+            if self.pointer == self.STATUS_REG:
+                out.append(self.status())
+            elif self.pointer == self.READ_REG:
+                out.append(self.rx if self.rx is not None else 0)
+                self.rx = None
+            else:
+                out.append(0)
+        return bytes(out)
+
+
+class TCS34725:
+    """TCS34725 color sensor, RGBC counts from a constant light.
+
+    With PON and AEN in ENABLE it integrates all the time, 2.4 ms after
+    AEN is set, (256 - ATIME) * 2.4 ms per integration, and AVALID is
+    set after the first one. rgbc are the counts per ms at 1x gain plus
+    the number of the integration modulo 256, like noise would, so that
+    reading the same integration twice shows. skew is the period of the
+    internal oscillator over the nominal one.
+    """
+
+    ADDR = 0x29
+    ENABLE = 0x00
+    ATIME = 0x01
+    CONTROL = 0x0f
+    ID = 0x12
+    STATUS = 0x13
+    CDATAL = 0x14
+    GAINS = (1, 4, 16, 60)
+
+    def __init__(self, rgbc=(4.0, 2.0, 1.5, 1.0), skew=1.0):
+        self.rgbc = rgbc
+        self.skew = skew
+        self.regs = bytearray(0x20)
+        self.regs[self.ATIME] = 0xff
+        self.regs[self.ID] = 0x44
+        self.pointer = 0
+        self.auto = False
+        self.started = None
+
+    def period(self):
+        return (256 - self.regs[self.ATIME]) * 0.0024 * self.skew
+
+    def integrations(self):
+        if self.started is None:
+            return 0
+        return max(int((time.monotonic() - self.started) / self.period()), 0)
+
+    def update(self):
+        n = self.integrations()
+        if not n:
+            return
+        self.regs[self.STATUS] |= 0x01
+        gain = self.GAINS[self.regs[self.CONTROL] & 3]
+        cycles = 256 - self.regs[self.ATIME]
+        full = min(1024 * cycles, 65535)
+        ms = cycles * 2.4
+        for i, v in enumerate((self.rgbc[3], self.rgbc[0], self.rgbc[1],
+                               self.rgbc[2])):
+            count = min(int(v * ms * gain) + n % 256, full)
+            self.regs[self.CDATAL + 2 * i] = count & 0xff
+            self.regs[self.CDATAL + 2 * i + 1] = count >> 8
+
+    def write(self, data):
+        cmd = data[0]
+        if not cmd & 0x80:
+            return
+        self.pointer = cmd & 0x1f
+        self.auto = (cmd >> 5) & 3 == 1
+        for v in data[1:]:
+            if self.pointer == self.ENABLE:
+                if v & 3 == 3 and self.regs[self.ENABLE] & 3 != 3:
+                    self.started = time.monotonic() + 0.0024
+                elif v & 3 != 3:
+                    self.started = None
+                    self.regs[self.STATUS] &= ~0x01
+            self.regs[self.pointer] = v
+            if self.auto:
+                self.pointer += 1
+
+    def read(self, n):
+        self.update()
+        if not self.auto:
+            return bytes([self.regs[self.pointer]]) * n
+        data = bytes(self.regs[self.pointer:self.pointer + n])
+        self.pointer += n
+        return data
+
+
+class BusPirate:
+
+    def __init__(self, devices=None, latency_s=0.001, byte_s=BAUD_BYTE_S):
+        self.devices = {}
+        for dev in devices or ():
+            self.devices[dev.ADDR] = dev
+        self.latency_s = latency_s
+        self.byte_s = byte_s
+        self.speed = 0
+        self.bus_s = 0.0
+        self.reset_counters()
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+        self.buf = bytearray()
+        self.out = bytearray()
+        self.protocol = self.bbio()
+        next(self.protocol)
+        self.rfd, self.wfd = os.pipe()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        os.write(self.wfd, b'\0')
+        self.thread.join()
+        for fd in (self.master, self.slave, self.rfd, self.wfd):
+            os.close(fd)
+
+    def reset_counters(self):
+        self.bursts = 0
+        self.commands = 0
+        self.bus_bytes = 0
+
+    def bus(self, n):
+        self.bus_bytes += n
+        self.bus_s += n * 9 / I2C_HZ[self.speed]
+
+    def run(self):
+        while True:
+            r, _, _ = select.select((self.master, self.rfd), (), ())
+            if self.rfd in r:
+                return
+            data = os.read(self.master, 4096)
+            self.buf += data
+            self.bursts += 1
+            next(self.protocol)
+            time.sleep(self.latency_s + (len(data) + len(self.out)) * self.byte_s +
+                       self.bus_s)
+            self.bus_s = 0.0
+            if self.out:
+                os.write(self.master, self.out)
+                del self.out[:]
+
+    def take(self, n):
+        while len(self.buf) < n:
+            yield
+        data = bytes(self.buf[:n])
+        del self.buf[:n]
+        return data
+
+    def bbio(self):
+        while True:
+            cmd = (yield from self.take(1))[0]
+            if cmd == 0x00:
+                self.out += b'BBIO1'
+            elif cmd == 0x02:
+                self.out += b'I2C1'
+                yield from self.i2c()
+            elif cmd == 0x0f:
+                self.out += b'\x01'
+
+    def i2c(self):
+        # Bit level transaction: address and written bytes till the
+        # next start or stop.
+        addr = None
+        ack = False
+        written = bytearray()
+
+        def end():
+            dev = self.device(addr)
+            if dev is not None and not addr & 1 and written:
+                dev.write(bytes(written))
+            del written[:]
+
+        while True:
+            cmd = (yield from self.take(1))[0]
+            if cmd == 0x00:
+                self.out += b'BBIO1'
+                return
+            elif cmd == 0x01:
+                self.out += b'I2C1'
+            elif cmd == 0x0f:
+                self.out += b'\x01'
+                return
+            elif cmd in (0x02, 0x03):
+                end()
+                addr = None
+                self.out += b'\x01'
+            elif cmd == 0x04:
+                self.bus(1)
+                dev = self.device(addr)
+                self.out += dev.read(1) if dev else b'\xff'
+            elif cmd in (0x06, 0x07):
+                self.out += b'\x01'
+            elif cmd & 0xf0 == 0x10:
+                self.out += b'\x01'
+                self.bus((cmd & 0x0f) + 1)
+                for b in (yield from self.take((cmd & 0x0f) + 1)):
+                    if addr is None:
+                        addr = b
+                        ack = self.device(addr) is not None
+                    else:
+                        written.append(b)
+                    self.out += b'\x00' if ack else b'\x01'
+            elif cmd & 0xf0 == 0x40:
+                self.out += b'\x01'
+            elif cmd & 0xf0 == 0x60:
+                self.speed = cmd & 0x03
+                self.out += b'\x01'
+            elif cmd == 0x08:
+                yield from self.write_then_read()
+
+    def write_then_read(self):
+        self.commands += 1
+        m, n = struct.unpack('>HH', (yield from self.take(4)))
+        data = yield from self.take(m)
+        # Address and data, then address again and the bytes read.
+        self.bus(m + (n + 1 if n else 0))
+        dev = self.device(data[0])
+        if dev is None:
+            self.out += b'\x00'
+            return
+        if not data[0] & 1 and m > 1:
+            dev.write(data[1:])
+        self.out += b'\x01'
+        if n:
+            self.out += dev.read(n)
+
+    def device(self, addr):
+        if addr is None:
+            return None
+        return self.devices.get(addr >> 1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Emulates a Bus Pirate with I2C sensors.')
+    parser.add_argument('--tsl2561', action='store_true', help='TSL2561 at 0x39.')
+    parser.add_argument('--tcs34725', action='store_true', help='TCS34725 at 0x29.')
+    parser.add_argument('--as7262', action='store_true', help='AS7262 at 0x49.')
+    parser.add_argument('--as7263', action='store_true', help='AS7263 at 0x49.')
+    parser.add_argument('--latency', type=float, default=0.001,
+                        help='USB round trip in s.')
+    parser.add_argument('--byte', type=float, default=BAUD_BYTE_S,
+                        help='Time of a byte on the serial line in s.')
+    args = parser.parse_args()
+    devices = []
+    if args.tsl2561:
+        devices.append(TSL2561())
+    if args.tcs34725:
+        devices.append(TCS34725())
+    if args.as7262 or args.as7263:
+        devices.append(AS726x(version=AS726x.AS7263 if args.as7263 else AS726x.AS7262))
+    pirate = BusPirate(devices, args.latency, args.byte)
+    print(pirate.port, flush=True)
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda signum, frame: None)
+    signal.pause()
+    print('round trips: %d commands: %d I2C bytes: %d' %
+          (pirate.bursts, pirate.commands, pirate.bus_bytes))
+    pirate.close()
@@ -0,0 +1,84 @@
+#!/usr/bin/python3
+
+# Samples of many sensors with their integrations overlapped.
+#
+# A sensor has three phases:
+#   start_sample()  starts an integration and returns the monotonic time
+#                   it should be over, without waiting
+#   sample_ready()  true when the reading is there, without waiting
+#   read_sample()   the reading, in the form of the driver
+# TSL2561, TCS34725, AS726x_I2C and AS726x_SERIAL have them. Scheduler
+# starts all the sensors, sleeps till the first is due, then polls and
+# reads each one as it completes: a sample of all of them takes about
+# the longest integration instead of the sum. The I2C sensors can share
+# one Bus Pirate (the i2c argument of their constructors), the bus is
+# only used to start and to read, a sensor that is late is polled every
+# POLL_S.
+
+import time
+from typing import Dict
+
+
+class Scheduler:
+
+    POLL_S = 0.002
+    # Time past its due time after which a sensor is given up.
+    TIMEOUT_S = 2.0
+
+    def __init__(self, sensors: Dict[str, object], poll_s: float = POLL_S,
+                 timeout_s: float = TIMEOUT_S):
+        self.sensors = sensors
+        self.poll_s = poll_s
+        self.timeout_s = timeout_s
+        # Polls that found a sensor not ready.
+        self.polls = 0
+
+    def sample(self):
+        """Readings of all the sensors, a dict by name."""
+        due = {}
+        for name, sensor in self.sensors.items():
+            due[name] = sensor.start_sample()
+        limit = max(due.values(), default=0.0) + self.timeout_s
+        readings = {}
+        while due:
+            now = time.monotonic()
+            first = min(due.values())
+            if first > now:
+                time.sleep(first - now)
+                continue
+            for name in sorted(due, key=due.get):
+                if due[name] > now:
+                    break
+                sensor = self.sensors[name]
+                if sensor.sample_ready():
+                    readings[name] = sensor.read_sample()
+                    del due[name]
+                else:
+                    self.polls += 1
+                    due[name] = now + self.poll_s
+            if due and now > limit:
+                raise IOError("No reading from %s" % ", ".join(sorted(due)))
+        return readings
+
+    def run(self, count: int = None):
+        """Yields (time, readings) for count samples or forever."""
+        while count is None or count > 0:
+            readings = self.sample()
+            if count is not None:
+                count -= 1
+            yield time.time(), readings
+
+
+if __name__ == '__main__':
+    import buspirate as bp
+    import tcs34725
+    import tsl2561
+    i2c = bp.I2C("/dev/ttyUSB0", bp.I2C_SPEED_400KHZ)
+    tsl = tsl2561.TSL2561(i2c=i2c)
+    tsl.set_mode(0, tsl.MODE_101MS)
+    tcs = tcs34725.TCS34725(i2c=i2c)
+    tcs.power_on()
+    tcs.integration_ms(100)
+    for t, r in Scheduler({'tsl2561': tsl, 'tcs34725': tcs}).run():
+        print("%.3f %10.2f lux crgb: %s" % (t, r['tsl2561'][0], r['tcs34725']),
+              end="\r")
@@ -0,0 +1,106 @@
+# Write-through shadow of the configuration registers of a sensor.
+#
+# Registers are read from the device once, then their value is known:
+# field updates only write. Bits in volatile (like DATA_RDY or a self
+# clearing reset) are never cached: reading them always goes to the
+# device and they are written only by the update that sets them. Inside
+# batch() the updates of a register are merged and each register is
+# written once, at the end. Drivers call invalidate() after a reset.
+#
+# Registers are any key the read and write functions understand: an
+# address for I2C, a command name for AT commands.
+
+import contextlib
+from typing import Callable, Dict, Hashable
+
+
+class ShadowRegisters:
+
+    def __init__(self, read: Callable[[Hashable], int],
+                 write: Callable[[Hashable, int], None],
+                 volatile: Dict[Hashable, int] = None, width: int = 8):
+        self.read_ = read
+        self.write_ = write
+        self.volatile = volatile or {}
+        self.full = (1 << width) - 1
+        self.values = {}
+        # Volatile bits to write with the next write of the register.
+        self.once = {}
+        self.dirty = {}
+        self.depth = 0
+        self.reads = 0
+        self.writes = 0
+
+    def get(self, reg: Hashable, mask: int = None):
+        """Value of reg, from the device if mask has volatile bits."""
+        if mask is None:
+            mask = self.full
+        if reg in self.values and not mask & self.volatile.get(reg, 0):
+            return self.values[reg]
+        value = self.read_(reg)
+        self.reads += 1
+        if reg not in self.dirty:
+            self.values[reg] = value & ~self.volatile.get(reg, 0)
+        return value
+
+    def cached(self, reg: Hashable, default: int = None):
+        """Value of reg if known, without reading it."""
+        return self.values.get(reg, default)
+
+    def update(self, reg: Hashable, mask: int, bits: int):
+        """Sets the bits of mask in reg to the ones of bits."""
+        vol = self.volatile.get(reg, 0)
+        if mask == self.full:
+            old = 0
+        else:
+            self.get(reg, 0)
+            old = self.values[reg]
+        new = (old & ~mask) | (bits & mask)
+        self.values[reg] = new & ~vol
+        self.once[reg] = (self.once.get(reg, 0) & ~mask) | (new & vol)
+        self.dirty[reg] = True
+        if not self.depth:
+            self.flush()
+
+    def set(self, reg: Hashable, value: int):
+        self.update(reg, self.full, value)
+
+    def written(self, reg: Hashable, value: int):
+        """Records value, written to reg by other means."""
+        self.values[reg] = value & ~self.volatile.get(reg, 0)
+
+    def flush(self):
+        dirty = self.dirty
+        self.dirty = {}
+        for reg in dirty:
+            self.write_(reg, self.values[reg] | self.once.pop(reg, 0))
+            self.writes += 1
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Merges the updates inside into one write per register."""
+        self.depth += 1
+        try:
+            yield self
+        except BaseException:
+            self.depth -= 1
+            if not self.depth:
+                # Nothing was written: forget what was not.
+                for reg in self.dirty:
+                    self.invalidate(reg)
+                self.dirty = {}
+            raise
+        self.depth -= 1
+        if not self.depth:
+            self.flush()
+
+    def invalidate(self, reg: Hashable = None):
+        """Forgets reg, or all the registers."""
+        if reg is None:
+            self.values.clear()
+            self.once.clear()
+            self.dirty.clear()
+        else:
+            self.values.pop(reg, None)
+            self.once.pop(reg, None)
+            self.dirty.pop(reg, None)
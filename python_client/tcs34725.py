@@ -1,15 +1,44 @@
 #!/usr/bin/python3
 
 import buspirate as bp
+import shadow
+import struct
+import time
 from time import sleep
 
 
 class TCS34725:
 
-    def __init__(self):
+    ENABLE = 0x00
+    ATIME = 0x01
+    CONFIG = 0x0d
+    CONTROL = 0x0f
+    STATUS = 0x13
+    AVALID = 0x01
+    # Time between AEN and the start of the first integration.
+    INIT_S = 0.0024
+    # Margin after the end of an integration before reading it.
+    MARGIN_S = 0.0005
+    # stream() reads this part of a period before the expected end of an
+    # integration and polls every POLL_S till the new reading is there.
+    EARLY = 0.03
+    POLL_S = 0.0005
+
+    # i2c is a bp.I2C shared with other sensors, then its pins are left
+    # alone.
+    def __init__(self, port: str = "/dev/ttyUSB0",
+                 speed: int = bp.I2C_SPEED_50KHZ, i2c: bp.I2C = None):
         self.addr = 0x29
-        self.i2c = bp.I2C("/dev/ttyUSB0", bp.I2C_SPEED_50KHZ)
-        self.i2c.set_pin(0, 0)
+        if i2c is None:
+            i2c = bp.I2C(port, speed)
+            i2c.set_pin(0, 0)
+        self.i2c = i2c
+        self.regs = shadow.ShadowRegisters(
+            lambda reg: self.read_reg(reg, 1)[0], self.write_reg)
+        self.started = None
+        self.missed = 0
+        self.resyncs = 0
+        self.sample = bp.new_buffer(9)
 
     def light(self, on: int):
         if on != 0:
@@ -23,25 +52,32 @@ class TCS34725:
         return self.i2c.cmd_recv(self.addr, 0xa0 | reg, n)
 
     def power_on(self):
-        self.write_reg(0, 1)
+        self.started = None
+        self.regs.set(self.ENABLE, 1)
         sleep(0.0024)
-        self.write_reg(0xd, 0)
+        self.regs.set(self.CONFIG, 0)
 
     def start(self):
-        self.write_reg(0, 3)
+        if self.started is not None:
+            return
+        if self.regs.get(self.ENABLE) & 2:
+            # Running since who knows when: restart it to know the phase.
+            self.regs.update(self.ENABLE, 2, 0)
+        self.regs.update(self.ENABLE, 3, 3)
+        self.started = time.monotonic() + self.INIT_S
 
     def integration_ms(self, t: int):
         t = int(t / 2.4)
         if t > 255:
             t = 255
-        self.write_reg(1, 255 - t)
+        self.regs.set(self.ATIME, 255 - t)
 
     def gain(self, g: int):
         if g < 0:
             g = 0
         if g > 3:
             g = 3
-        self.write_reg(0xf, g)
+        self.regs.set(self.CONTROL, g)
 
     def read_crgb(self):
         status = self.read_reg(0x13, 1)
@@ -55,18 +91,93 @@ class TCS34725:
             data[6] + data[7] * 256,
         ]
 
+    def period_s(self):
+        return (256 - self.regs.get(self.ATIME)) * 0.0024
+
+    # Yields (time, [c, r, g, b]) for every integration, count of them or
+    # forever. It sleeps till just before the expected end of each
+    # integration and reads STATUS and the counts with one auto
+    # increment read. AVALID stays set after the first integration, so a
+    # reading is only new when the counts changed. The same counts again
+    # are polled for till they change, which is then the end of the
+    # integration; new counts before the expected end move the next read
+    # earlier. Either way the stream follows the internal oscillator,
+    # slower or faster than the nominal period, instead of drifting off
+    # it, and the adjustments are counted in resyncs. Counts that stay
+    # the same for half a period more (no light, saturated) are taken as
+    # new. Integrations that ended while the caller was busy are skipped
+    # and counted in missed. Changes of ATIME during the stream are not
+    # seen.
+    def stream(self, count: int = None):
+        self.start()
+        period = self.period_s()
+        n = int((time.monotonic() - self.started) / period)
+        due = self.started + max(n, 1) * period
+        data = bp.new_buffer(9)
+        last = None
+        early = False
+        while count is None or count > 0:
+            delay = due + self.MARGIN_S - self.EARLY * period - time.monotonic()
+            if delay > 0:
+                sleep(delay)
+            now = time.monotonic()
+            self.i2c.cmd_recv_into(self.addr, 0xa0 | self.STATUS, data)
+            counts = bytes(data)[1:]
+            if not data[0] & self.AVALID:
+                sleep(self.POLL_S)
+                continue
+            if counts == last and now < due + period / 2:
+                early = True
+                sleep(self.POLL_S)
+                continue
+            if counts != last and early:
+                # It ended since the last read.
+                self.resyncs += 1
+                due = now
+            elif now < due:
+                # Already there, it ended some time before: read
+                # earlier next time, till the previous one is seen.
+                self.resyncs += 1
+                due = now - self.EARLY * period
+            early = False
+            last = counts
+            late = int((now - due) / period)
+            self.missed += late
+            due += (late + 1) * period
+            if count is not None:
+                count -= 1
+            yield (time.time(), list(struct.unpack("<4H", counts)))
+
+    # Sensor interface of scheduler.py: restart the integrations, then
+    # STATUS and the counts are read with one transaction once the
+    # first one is due.
+    def start_sample(self):
+        self.started = None
+        self.start()
+        return self.started + self.period_s() + self.MARGIN_S
+
+    def sample_ready(self):
+        if time.monotonic() < self.started + self.period_s() + self.MARGIN_S:
+            return False
+        self.i2c.cmd_recv_into(self.addr, 0xa0 | self.STATUS, self.sample)
+        return self.sample[0] & self.AVALID
+
+    def read_sample(self):
+        return list(struct.unpack_from("<4H", self.sample, 1))
+
     def dump(self):
         data = self.read_reg(0, 0x1b + 1)
         for i, v in enumerate(data):
             print("0x{:0>2x}=0x{:0>2x}".format(i, v))
 
 
-tcs34725 = TCS34725()
-tcs34725.power_on()
-tcs34725.gain(2)
-tcs34725.integration_ms(100)
-tcs34725.start()
-tcs34725.dump()
-while True:
-    print("{0[0]:0>5d} {0[1]:0>5d} {0[2]:0>5d} {0[3]:0>5d}".format(
-        tcs34725.read_crgb()), end="\r")
+if __name__ == '__main__':
+    tcs34725 = TCS34725()
+    tcs34725.power_on()
+    tcs34725.gain(2)
+    tcs34725.integration_ms(100)
+    tcs34725.start()
+    tcs34725.dump()
+    for _, crgb in tcs34725.stream():
+        print("{0[0]:0>5d} {0[1]:0>5d} {0[2]:0>5d} {0[3]:0>5d}".format(
+            crgb), end="\r")
@@ -0,0 +1,219 @@
+# BLM (blm_bluez.py) against a fake bluetoothd: a D-Bus system bus with
+# one adapter, a connected BlueLightMeter and its two characteristics,
+# and a main loop delivering the signals queued by the test.
+#
+# Run with: python3 -m unittest test_blm_bluez (or pytest).
+
+import argparse
+import collections
+import os
+import struct
+import sys
+import tempfile
+import types
+import unittest
+
+HCI = '/org/bluez/hci0'
+MAC = '11:22:33:44:55:66'
+DEV = HCI + '/dev_11_22_33_44_55_66'
+READ_PATH = DEV + '/service000c/char000d'
+WRITE_PATH = DEV + '/service000c/char0010'
+READ_UUID = '00002221-0000-1000-8000-00805f9b34fb'
+WRITE_UUID = '00002222-0000-1000-8000-00805f9b34fb'
+
+
+class DBusException(Exception):
+    pass
+
+
+class Receiver:
+
+    def __init__(self, bus, handler, signal_name, path):
+        self.bus = bus
+        self.handler = handler
+        self.signal_name = signal_name
+        self.path = path
+
+    def remove(self):
+        self.bus.receivers.remove(self)
+
+
+class Object:
+    """A BlueZ object: every interface method is a method of it."""
+
+    def __init__(self, bus, path):
+        self.bus = bus
+        self.path = path
+
+    def Get(self, interface, prop, dbus_interface=None):
+        return self.bus.props[self.path][prop]
+
+    def StartDiscovery(self, dbus_interface=None):
+        self.bus.calls.append('StartDiscovery')
+
+    def StopDiscovery(self, dbus_interface=None):
+        self.bus.calls.append('StopDiscovery')
+
+    def Connect(self):
+        self.bus.calls.append('Connect')
+
+    def Disconnect(self):
+        self.bus.calls.append('Disconnect')
+
+    def GetManagedObjects(self):
+        objects = {}
+        for path, props in self.bus.props.items():
+            name = ('org.bluez.GattCharacteristic1' if 'UUID' in props else
+                    'org.bluez.Device1')
+            objects[path] = {name: props}
+        return objects
+
+    def StartNotify(self):
+        self.bus.calls.append('StartNotify')
+        if not self.bus.can_notify:
+            raise DBusException('org.bluez.Error.NotSupported')
+
+    def StopNotify(self):
+        self.bus.calls.append('StopNotify')
+
+    def ReadValue(self, byte_arrays=False):
+        self.bus.calls.append('ReadValue')
+        return self.bus.value
+
+    def WriteValue(self, value):
+        self.bus.calls.append('WriteValue')
+
+
+class Bus:
+
+    def __init__(self, can_notify=True):
+        self.can_notify = can_notify
+        self.receivers = []
+        self.calls = []
+        self.events = collections.deque()
+        self.value = b''
+        self.props = {
+            DEV: {'Connected': True, 'ServicesResolved': True, 'Address': MAC},
+            READ_PATH: {'UUID': READ_UUID},
+            WRITE_PATH: {'UUID': WRITE_UUID}}
+
+    def add_signal_receiver(self, handler, signal_name=None, dbus_interface=None,
+                            path=None, arg0=None, path_keyword=None,
+                            byte_arrays=False):
+        receiver = Receiver(self, handler, signal_name, path)
+        self.receivers.append(receiver)
+        return receiver
+
+    def get_object(self, service, path):
+        return Object(self, path)
+
+    def notify(self, value):
+        # A notification, delivered by the next main loop iteration.
+        def emit():
+            for r in list(self.receivers):
+                if r.signal_name == 'PropertiesChanged' and r.path == READ_PATH:
+                    r.handler('org.bluez.GattCharacteristic1', {'Value': value}, [])
+        self.events.append(emit)
+
+    def iteration(self, block):
+        if self.events:
+            self.events.popleft()()
+
+
+def fake_modules(bus):
+    dbus = types.ModuleType('dbus')
+    dbus.SystemBus = lambda name=None: bus
+    dbus.Interface = lambda obj, interface: obj
+    dbus.exceptions = types.SimpleNamespace(DBusException=DBusException)
+    dbus.mainloop = types.ModuleType('dbus.mainloop')
+    dbus.mainloop.glib = types.ModuleType('dbus.mainloop.glib')
+    dbus.mainloop.glib.DBusGMainLoop = lambda set_as_default=False: None
+    gobject = types.ModuleType('gobject')
+    gobject.MainLoop = lambda: types.SimpleNamespace(get_context=lambda: bus)
+    gobject.timeout_add = lambda ms, fn: 1
+    gobject.source_remove = lambda tag: None
+    return {'dbus': dbus, 'dbus.mainloop': dbus.mainloop,
+            'dbus.mainloop.glib': dbus.mainloop.glib, 'gobject': gobject}
+
+
+def packet(seq, ch0, ch1):
+    return struct.pack('<BBHHBH', 0x11, seq, ch0, ch1, 2, 0)
+
+
+def connect(bus, cache, poll=False):
+    """A blm_bluez.BLM connected through bus, built by its constructor."""
+    saved = dict(sys.modules)
+    sys.modules.pop('blm_bluez', None)
+    sys.modules.update(fake_modules(bus))
+    try:
+        import blm_bluez
+        args = argparse.Namespace(hci_interface='hci0', mac_address=MAC,
+                                  timeout=1, name='RFduino', cache=cache,
+                                  poll=poll)
+        return blm_bluez.BLM(args)
+    finally:
+        sys.modules.clear()
+        sys.modules.update(saved)
+
+
+class BLMTest(unittest.TestCase):
+
+    def connect(self, bus, poll=False):
+        return connect(bus, self.cache, poll)
+
+    def setUp(self):
+        fd, self.cache = tempfile.mkstemp(suffix='.json')
+        os.close(fd)
+
+    def tearDown(self):
+        os.unlink(self.cache)
+
+    def receivers(self, bus):
+        return [r for r in bus.receivers if r.path == READ_PATH]
+
+    def test_notify(self):
+        bus = Bus()
+        blm = self.connect(bus)
+        self.assertTrue(blm.notify_)
+        self.assertEqual(len(self.receivers(bus)), 1)
+        bus.notify(packet(1, 1000, 300))
+        bus.notify(packet(2, 1001, 301))
+        self.assertEqual([s.ch0 for s in blm.read()], [1000])
+        self.assertEqual([s.ch1 for s in blm.read()], [301])
+        self.assertNotIn('ReadValue', bus.calls)
+        blm.close()
+        self.assertIn('StopNotify', bus.calls)
+
+    def test_polling_fallback(self):
+        bus = Bus(can_notify=False)
+        blm = self.connect(bus)
+        self.assertFalse(blm.notify_)
+        # Nothing is left listening for notifications.
+        self.assertEqual(self.receivers(bus), [])
+        bus.value = packet(7, 500, 100)
+        self.assertEqual([s.ch0 for s in blm.read()], [500])
+        self.assertIn('ReadValue', bus.calls)
+
+    def test_mac_address_stops_discovery(self):
+        bus = Bus()
+        self.connect(bus)
+        self.assertEqual([c for c in bus.calls if 'Discovery' in c or c == 'Connect'],
+                         ['StartDiscovery', 'Connect', 'StopDiscovery'])
+
+    def test_connect_timeout_stops_discovery(self):
+        bus = Bus()
+        bus.props[DEV]['Connected'] = False
+        with self.assertRaises(IOError):
+            self.connect(bus)
+        self.assertIn('StopDiscovery', bus.calls)
+
+    def test_poll(self):
+        bus = Bus()
+        blm = self.connect(bus, poll=True)
+        self.assertFalse(blm.notify_)
+        self.assertNotIn('StartNotify', bus.calls)
+        self.assertEqual(bus.receivers, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,137 @@
+# Recorder and Reader (blm_record.py): the varint and zigzag encoding of
+# the deltas at their extremes, a recording cut in the middle of a
+# record and a Recorder resuming it.
+#
+# Run with: python3 -m unittest test_blm_record (or pytest).
+
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+import blm_record
+
+
+def packet(run, ch0, ch1, conf=2):
+    return bytearray(struct.pack('<BBHHBH', 0x11, run & 0xff, ch0, ch1, conf, 0))
+
+
+def batch(seq):
+    return bytearray(struct.pack('<BBHHHHHHBH', 0x12, seq, 1, 2, 3, 4, 5, 6, 2, 0))
+
+
+class RecordTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'session.blmr')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def record(self, packets):
+        rec = blm_record.Recorder(self.path)
+        times = []
+        for i, p in enumerate(packets):
+            times.append(rec.start + 0.0137 * i)
+            rec.append(times[-1], p)
+        rec.close()
+        return times
+
+    def read(self):
+        reader = blm_record.Reader(self.path)
+        try:
+            return [(t, bytes(p)) for t, p in reader]
+        finally:
+            reader.close()
+
+    def test_varint_zigzag(self):
+        for v in (0, 1, -1, 63, -64, 64, 0xffff, -0xffff, 2 ** 62, -2 ** 62):
+            buf = bytearray()
+            blm_record.put_varint(buf, blm_record.zigzag(v))
+            u, pos = blm_record.get_varint(buf, 0)
+            self.assertEqual(pos, len(buf))
+            self.assertEqual(blm_record.unzigzag(u), v)
+
+    def test_extreme_deltas(self):
+        channels = [(0, 0), (0xffff, 0), (0, 0xffff), (0xffff, 0xffff), (0, 0)]
+        packets = [packet(n, ch0, ch1) for n, (ch0, ch1) in enumerate(channels)]
+        times = self.record(packets)
+        read = self.read()
+        self.assertEqual([p for _, p in read], [bytes(p) for p in packets])
+        for (t, _), expected in zip(read, times):
+            self.assertAlmostEqual(t, expected, delta=1e-6)
+        # One full record, then deltas of at most 3 bytes per varint.
+        size = os.path.getsize(self.path) - blm_record.HEADER.size
+        self.assertLessEqual(size, 2 + blm_record.PACKET_LEN + 4 * (3 + 3 + 3))
+
+    def test_full_records(self):
+        # A new conf byte, a broken run and 0x12 batches are not deltas.
+        packets = [packet(0, 10, 10), packet(1, 10, 10, conf=3),
+                   packet(5, 10, 10), batch(6), batch(7), packet(8, 1, 1)]
+        self.record(packets)
+        self.assertEqual([p for _, p in self.read()], [bytes(p) for p in packets])
+
+    def test_version_1(self):
+        # Version 1 deltas repeat the run byte instead of incrementing it.
+        with open(self.path, 'wb') as f:
+            f.write(blm_record.HEADER.pack(blm_record.MAGIC, 1, 100.0))
+            buf = bytearray()
+            blm_record.put_varint(buf, 1)
+            blm_record.put_varint(buf, blm_record.PACKET_LEN)
+            buf.extend(packet(7, 100, 50))
+            blm_record.put_varint(buf, blm_record.zigzag(1000) << 1)
+            blm_record.put_varint(buf, blm_record.zigzag(-100))
+            blm_record.put_varint(buf, blm_record.zigzag(5))
+            f.write(buf)
+        read = self.read()
+        self.assertEqual([p for _, p in read],
+                         [bytes(packet(7, 100, 50)), bytes(packet(7, 0, 55))])
+        self.assertAlmostEqual(read[1][0], 100.001)
+
+    def test_truncated(self):
+        packets = [packet(n, 1000 * n, 0xffff - 1000 * n) for n in range(4)]
+        self.record(packets)
+        whole = os.path.getsize(self.path)
+        # Cut the last record in the middle of its varints.
+        with open(self.path, 'r+b') as f:
+            f.truncate(whole - 2)
+        read = self.read()
+        self.assertEqual([p for _, p in read], [bytes(p) for p in packets[:3]])
+        reader = blm_record.Reader(self.path)
+        list(reader)
+        end = reader.end
+        reader.close()
+        self.assertLess(end, whole - 2)
+        # A cut full record is ignored too.
+        with open(self.path, 'r+b') as f:
+            f.truncate(end + 2)
+        self.assertEqual(len(self.read()), 3)
+
+    def test_resume(self):
+        packets = [packet(n, 0xffff * (n % 2), 0) for n in range(4)]
+        times = self.record(packets[:3])
+        with open(self.path, 'ab') as f:
+            f.write(b'\x81')
+        # The partial record is dropped, the next packet is a delta of
+        # the last complete one and the times go on from the old start.
+        rec = blm_record.Recorder(self.path)
+        self.assertAlmostEqual(rec.start, times[0])
+        size = os.path.getsize(self.path)
+        rec.append(times[0] + 0.0137 * 3, packets[3])
+        rec.close()
+        read = self.read()
+        self.assertEqual([p for _, p in read], [bytes(p) for p in packets])
+        self.assertAlmostEqual(read[3][0], times[0] + 0.0137 * 3, delta=1e-6)
+        self.assertLessEqual(os.path.getsize(self.path) - size, 3 + 3 + 3)
+
+    def test_not_a_recording(self):
+        with open(self.path, 'wb') as f:
+            f.write(b'not a recording!')
+        with self.assertRaises(IOError):
+            blm_record.Reader(self.path)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,147 @@
+# Ring (blm_ring.py) in one process: the overflow policies, the wakeup
+# pipe and a producer that writes a slot while the consumer reads it.
+#
+# Run with: python3 -m unittest test_blm_ring (or pytest).
+
+import select
+import unittest
+
+import blm_packet
+import blm_ring
+
+
+def reading(n, flash=False):
+    data = {'time': float(n), 'lux': 10.0 * n, 'max_lux': 10.0 * n,
+            'med_lux': 10.0 * n, 'min_lux': 10.0 * n, 'var_lux': 0.0,
+            'state': blm_packet.Sample(n, n, 0, False, 13, seq=n % 256)}
+    if flash:
+        data['flash'] = {'time': n - 0.5, 'ambient_lux': 1.0,
+                         'peak_lux': 100.0, 'exposure': 2.0,
+                         'saturated': True}
+    return data
+
+
+def times(ring):
+    return [d['time'] for d in ring.get_all()]
+
+
+class RacingRing(blm_ring.Ring):
+    """A Ring whose producer puts race the read of the slot at offset
+    race: they are written after the record is read and before its
+    generation is checked again."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.race = None
+        self.racing = []
+        self.reading = False
+
+    def get(self, offset):
+        if offset == self.race and self.racing and self.reading:
+            self.reading = False
+            self.put_nowait(self.racing.pop(0))
+        return super().get(offset)
+
+    def read_slot(self, idx):
+        self.reading = True
+        return super().read_slot(idx)
+
+
+def slot(idx, capacity):
+    return blm_ring.HEADER.size + (idx % capacity) * blm_ring.SLOT
+
+
+class RingTest(unittest.TestCase):
+
+    def test_roundtrip(self):
+        ring = blm_ring.Ring(4)
+        ring.put_nowait(reading(1))
+        ring.put_nowait(reading(2, flash=True))
+        first, second = ring.get_all()
+        self.assertEqual(first['index'], 0)
+        self.assertEqual(first['state'], reading(1)['state'])
+        self.assertNotIn('flash', first)
+        self.assertEqual(second['index'], 1)
+        self.assertEqual(second['flash'], reading(2, flash=True)['flash'])
+        self.assertEqual(ring.get_all(), [])
+        self.assertEqual(ring.pending(), 0)
+
+    def test_drop_oldest(self):
+        ring = blm_ring.Ring(2, blm_ring.DROP_OLDEST)
+        for n in range(5):
+            ring.put_nowait(reading(n))
+        self.assertEqual(times(ring), [3.0, 4.0])
+        self.assertEqual(ring.dropped(), 3)
+        self.assertEqual(ring.coalesced(), 0)
+
+    def test_drop_newest(self):
+        ring = blm_ring.Ring(2, blm_ring.DROP_NEWEST)
+        for n in range(5):
+            ring.put_nowait(reading(n))
+        self.assertEqual(times(ring), [0.0, 1.0])
+        self.assertEqual(ring.dropped(), 3)
+        ring.put_nowait(reading(5))
+        self.assertEqual(times(ring), [5.0])
+
+    def test_coalesce(self):
+        ring = blm_ring.Ring(2, blm_ring.COALESCE)
+        for n in range(5):
+            ring.put_nowait(reading(n))
+        data = ring.get_all()
+        self.assertEqual([d['time'] for d in data], [0.0, 4.0])
+        self.assertEqual([d['index'] for d in data], [0, 1])
+        self.assertEqual(ring.coalesced(), 3)
+        self.assertEqual(ring.dropped(), 0)
+
+    def test_wakeup(self):
+        ring = blm_ring.Ring(4)
+        self.assertEqual(select.select([ring], [], [], 0)[0], [])
+        ring.put_nowait(reading(1))
+        self.assertEqual(select.select([ring], [], [], 0)[0], [ring])
+        ring.get_all()
+        self.assertEqual(select.select([ring], [], [], 0)[0], [])
+
+    def test_no_wakeup(self):
+        ring = blm_ring.Ring(4, wakeup=False)
+        ring.put_nowait(reading(1))
+        self.assertEqual(select.select([ring], [], [], 0)[0], [])
+        self.assertEqual(times(ring), [1.0])
+
+    def test_slot_being_written(self):
+        ring = blm_ring.Ring(4)
+        ring.put_nowait(reading(1))
+        off = slot(0, 4)
+        ring.set(off, ring.get(off) + 1)
+        self.assertIsNone(ring.read_slot(0))
+        ring.set(off, ring.get(off) + 1)
+        self.assertEqual(ring.read_slot(0)['time'], 1.0)
+
+    def test_overwritten_while_reading(self):
+        # The producer wraps around onto the slot being read: the record
+        # is dropped, not returned torn or with the new sample in it.
+        ring = RacingRing(2, blm_ring.DROP_OLDEST)
+        ring.put_nowait(reading(0))
+        ring.put_nowait(reading(1))
+        ring.race = slot(0, 2)
+        ring.racing = [reading(2)]
+        data = ring.get_all()
+        self.assertEqual([d['time'] for d in data], [1.0, 2.0])
+        self.assertEqual([d['index'] for d in data], [1, 2])
+        self.assertEqual(ring.dropped(), 1)
+
+    def test_coalesced_while_reading(self):
+        # The same index is written again: the read is retried and
+        # returns the new sample whole.
+        ring = RacingRing(1, blm_ring.COALESCE)
+        ring.put_nowait(reading(0))
+        ring.race = slot(0, 1)
+        ring.racing = [reading(1)]
+        data = ring.get_all()
+        self.assertEqual([d['time'] for d in data], [1.0])
+        self.assertEqual(data[0]['index'], 0)
+        self.assertEqual(data[0]['state'], reading(1)['state'])
+        self.assertEqual(ring.coalesced(), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+#!/usr/bin/python3
+
+# TSL2561 on the Bus Pirate, the Python version of tsl2561sparkfun.c
+# without the autorange: fixed gain and integration time, lux with the
+# formula of the BlueLightMeter (blm_lux).
+
+import blm_lux
+import buspirate as bp
+import time
+
+
+class TSL2561:
+
+    ADDR = 0x39
+    CONTROL = 0x00
+    TIMING = 0x01
+    DATA0LOW = 0x0c
+    DATA1LOW = 0x0e
+    CMD = 0x80
+    WORD = 0x20
+    MODE_13_7MS = 0
+    MODE_101MS = 1
+    MODE_402MS = 2
+    # Margin after the end of an integration before reading it.
+    MARGIN_S = 0.001
+
+    def __init__(self, port: str = "/dev/ttyUSB0",
+                 speed: int = bp.I2C_SPEED_50KHZ, addr: int = ADDR,
+                 i2c: bp.I2C = None):
+        self.addr = addr
+        self.i2c = i2c or bp.I2C(port, speed)
+        self.hi_gain = 0
+        self.mode = self.MODE_402MS
+        self.started = None
+        self.power(1)
+
+    def write_reg(self, reg: int, val: int):
+        self.i2c.send(self.addr, bytes((self.CMD | reg, val)))
+
+    def power(self, on: int):
+        self.write_reg(self.CONTROL, 3 if on else 0)
+        self.started = time.monotonic() if on else None
+
+    def set_mode(self, hi_gain: int, mode: int):
+        self.hi_gain = 1 if hi_gain else 0
+        self.mode = min(max(mode, self.MODE_13_7MS), self.MODE_402MS)
+        self.write_reg(self.TIMING, (self.hi_gain << 4) | self.mode)
+        self.started = time.monotonic()
+
+    def integration_s(self):
+        return blm_lux.MODE_MS[self.mode] / 1000.0
+
+    def channels(self):
+        """ch0 and ch1 of the last integration, in one library call."""
+        ch = self.i2c.transaction(
+            [(self.addr, bytes((self.CMD | self.WORD | self.DATA0LOW,)), 2),
+             (self.addr, bytes((self.CMD | self.WORD | self.DATA1LOW,)), 2)], 2)
+        return ch[0][0] | ch[0][1] << 8, ch[1][0] | ch[1][1] << 8
+
+    def lux(self):
+        """(lux, ch0, ch1) of the last integration, waits for the first."""
+        delay = (self.started + self.integration_s() + self.MARGIN_S -
+                 time.monotonic())
+        if delay > 0:
+            time.sleep(delay)
+        return self.read_sample()
+
+    # Sensor interface of scheduler.py. The TSL2561 has no data valid
+    # bit: a power cycle restarts the integration and the time tells
+    # when it is over.
+    def start_sample(self):
+        self.power(0)
+        self.power(1)
+        return self.started + self.integration_s() + self.MARGIN_S
+
+    def sample_ready(self):
+        return (time.monotonic() >=
+                self.started + self.integration_s() + self.MARGIN_S)
+
+    def read_sample(self):
+        ch0, ch1 = self.channels()
+        return (blm_lux.lux(ch0, ch1, blm_lux.MODE_MS[self.mode], self.hi_gain),
+                ch0, ch1)
+
+    def close(self):
+        self.power(0)
+
+
+if __name__ == '__main__':
+    tsl2561 = TSL2561()
+    tsl2561.set_mode(0, TSL2561.MODE_101MS)
+    while True:
+        print("%10.2f lux ch0: %5d ch1: %5d" % tsl2561.lux(), end="\r")
+        time.sleep(tsl2561.integration_s())
@@ -39,4 +39,23 @@ struct blm_update {
   struct blm_config conf;
 } __attribute__((packed));
 
+/* Version 0x12: up to BLM_BATCH_MAX samples integrated back to back
+   with the same configuration, seq is the sequence number of the
+   first one. Only count samples are sent. */
+#define BLM_BATCH_VERSION 0x12
+#define BLM_BATCH_MAX 3
+
+struct blm_sample {
+  uint16_t ch0;
+  uint16_t ch1;
+} __attribute__((packed));
+
+struct blm_batch {
+  uint8_t ver;
+  uint8_t count;
+  uint16_t seq;
+  struct blm_config conf;
+  struct blm_sample samples[BLM_BATCH_MAX];
+} __attribute__((packed));
+
 #endif	/* _PACKET_FORMAT_H_ */